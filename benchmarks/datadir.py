@@ -0,0 +1,189 @@
+'''Generate synthetic DATA_DIR trees that look like a busy server:
+
+  python3 -m benchmarks.datadir /tmp/bya-data --jobs 100 --builds 200
+
+Completed builds are written straight to disk so large trees can be made
+quickly. Queued runs and hosts go through the models so they look exactly
+like the real thing. The same seed always produces the same tree.
+'''
+import argparse
+import json
+import os
+import random
+import time
+
+import yaml
+
+from bya import models, settings
+from bya.lazy import Counter
+from bya.models import Host, Run, get_heartbeats
+
+DIRS = {
+    'JOBS_DIR': 'job-defs',
+    'BUILDS_DIR': 'builds',
+    'QUEUE_DIR': 'run-queue',
+    'RUNNING_DIR': 'active-runs',
+    'IN_FLIGHT_DIR': 'in-flight',
+    'HOSTS_DIR': 'hosts',
+    'TRIGGERS_DIR': 'triggers',
+    'TRASH_DIR': 'trash',
+}
+
+LOG_LINE = '+ make -j8 V=1 2>&1 | tee build.log  # some typical output\n'
+
+
+def use_data_dir(root):
+    '''Point settings, and the models, at the data directory "root"'''
+    settings.DATA_DIR = root
+    for attr, name in DIRS.items():
+        path = os.path.join(root, name)
+        os.makedirs(path, exist_ok=True)
+        setattr(settings, attr, path)
+    settings.STORAGE_SQLITE_DB = os.path.join(root, 'bya.db')
+    settings.METRICS_FILE = os.path.join(root, 'metrics')
+    settings.HEARTBEAT_FILE = os.path.join(root, 'heartbeats')
+    settings.PROFILE_DIR = os.path.join(root, 'profiles')
+    settings.LOG_SEARCH_DB = os.path.join(root, 'search.db')
+    settings.SECRETS_FILE = os.path.join(root, 'secrets.yml')
+    Host.PROPS_DIR = settings.HOSTS_DIR
+    models.jobs._jobs = None  # drop anything cached from another data dir
+
+
+def _job_path(i, depth):
+    '''Spread jobs over groups nested "depth" levels deep, 4 to a level'''
+    parts = ['group%d' % ((i // 4 ** x) % 4) for x in range(depth)]
+    return '/'.join(parts + ['job%d' % i])
+
+
+def _write_job(path, tags, runs, retention):
+    jobdef = {
+        'description': 'synthetic job %s' % path,
+        'script': 'make -j8\n',
+        'timeout': 30,
+        'containers': [
+            {'image': 'image%d' % x, 'host_tag': 'tag%d' % x}
+            for x in range(tags)],
+    }
+    if retention:
+        jobdef['retention'] = {'unit': 'builds', 'value': retention}
+    fname = os.path.join(settings.JOBS_DIR, path + '.yml')
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as f:
+        yaml.dump(jobdef, f)
+
+
+def _write_build(rand, builds_dir, num, runs, tags, log_lines, completed):
+    build_dir = os.path.join(builds_dir, str(num))
+    os.mkdir(build_dir)
+    os.mkdir(os.path.join(build_dir, 'runs'))
+    usage = 0
+    statuses = []
+    for r in range(runs):
+        status = Run.PASSED if rand.random() > 0.1 else Run.FAILED
+        statuses.append(status)
+        path = os.path.join(build_dir, 'runs', 'run%d' % r)
+        os.mkdir(path)
+        Run.get_storage().create(path, {
+            'container': 'image%d' % (r % tags),
+            'host_tag': 'tag%d' % (r % tags),
+            'params': None,
+            'api_key': '%016x' % rand.getrandbits(64),
+            'status': status,
+        }, 'Run')
+        with open(os.path.join(path, 'console.log'), 'w') as f:
+            f.write(LOG_LINE * log_lines)
+            usage += f.tell()
+    with open(os.path.join(build_dir, 'trigger_data'), 'w') as f:
+        json.dump({}, f)
+        usage += f.tell()
+    with open(os.path.join(build_dir, 'summary.log'), 'w') as f:
+        f.write('%s UTC: Build queued\n' % time.ctime(completed))
+        usage += f.tell()
+    status = 'Completed'
+    if Run.FAILED in statuses:
+        status = 'Completed with Failure(s)'
+    status_file = os.path.join(build_dir, 'status')
+    with open(status_file, 'w') as f:
+        f.write(status)
+    os.utime(status_file, (completed, completed))
+    Counter(os.path.join(build_dir, 'disk_usage')).add(usage)
+    return usage
+
+
+def generate(root, jobs=20, depth=2, builds=50, runs=3, queued=100, tags=4,
+             hosts=10, pings=1000, log_lines=100, retention=0, seed=0):
+    '''Create a synthetic data directory under root and point settings at
+       it. Builds complete one an hour working back from now. Returns a
+       summary of what was created.'''
+    rand = random.Random(seed)
+    use_data_dir(root)
+    now = time.time()
+
+    job_paths = [_job_path(i, depth) for i in range(jobs)]
+    for path in job_paths:
+        _write_job(path, tags, runs, retention)
+        builds_dir = os.path.join(settings.BUILDS_DIR, path.replace('/', '#'))
+        os.mkdir(builds_dir)
+        usage = 0
+        for num in range(1, builds + 1):
+            completed = now - 3600 * (builds - num + 1)
+            usage += _write_build(
+                rand, builds_dir, num, runs, tags, log_lines, completed)
+        Counter(os.path.join(builds_dir, 'build_number')).add(builds)
+        Counter(os.path.join(builds_dir, 'disk_usage')).add(usage)
+
+    # queue up "queued" runs in new builds of randomly chosen jobs
+    left = queued
+    while left > 0:
+        job = models.jobs.find_jobdef(rand.choice(job_paths))
+        count = min(left, runs)
+        job.create_build([
+            {'name': 'run%d' % r,
+             'container': 'image%d' % rand.randrange(tags)}
+            for r in range(count)])
+        left -= count
+
+    for h in range(hosts):
+        name = 'host%d' % h
+        Host.create(name, {
+            'distro': 'ubuntu',
+            'mem_total': 16 * 1024 ** 3,
+            'cpu_total': 8,
+            'cpu_type': 'x86_64',
+            'enlisted': True,
+            'api_key': 'key%d' % h,
+            'concurrent_runs': 2,
+            'host_tags': 'tag%d' % (h % tags),
+        })
+        for p in range(pings):
+            get_heartbeats().beat(name, now - 60 * (pings - p))
+
+    return {
+        'root': root,
+        'jobs': jobs,
+        'builds': jobs * builds,
+        'runs': jobs * builds * runs,
+        'queued': queued,
+        'host_tags': tags,
+        'hosts': hosts,
+    }
+
+
+def add_arguments(parser):
+    defaults = generate.__defaults__
+    names = generate.__code__.co_varnames[1:len(defaults) + 1]
+    for name, default in zip(names, defaults):
+        parser.add_argument('--' + name.replace('_', '-'), type=int,
+                            default=default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', help='Directory to create the data under')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    print(json.dumps(generate(**args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
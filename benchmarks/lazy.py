@@ -0,0 +1,100 @@
+'''Micro-benchmarks for the compiled PROPS handling in bya.lazy.
+
+The interpreted versions below are how PropsFile used to look up default
+values and validate data. They are kept here as the baseline to compare the
+compiled descriptors and validators against:
+
+  python3 -m benchmarks.lazy
+'''
+import json
+import timeit
+import tracemalloc
+
+from bya.lazy import ModelError
+from bya.models import Host, Run
+
+RUN_DATA = {
+    'container': 'ubuntu',
+    'host_tag': 'amd64',
+    'params': {'foo': 'bar'},
+    'api_key': '1234567890123456',
+    'status': 'RUNNING',
+}
+
+
+def interpreted_validate(props, data):
+    for prop in props:
+        val = data.get(prop.name)
+        if not val and prop.required:
+            raise ModelError('Missing required attribute: "%s".' % prop.name)
+        elif val:
+            data[prop.name] = prop.validate(val)
+
+
+def interpreted_prop(props, data, name):
+    v = data.get(name)
+    if not v:
+        for p in props:
+            if p.name == name:
+                return p.def_value
+    return v
+
+
+class DictRun(object):
+    '''What a Run instance carried before it used __slots__'''
+    def __init__(self, path, data):
+        self.name = path.rsplit('/', 1)[-1]
+        self.path = path
+        self._file = path
+        self._data = data
+        self._storage = None
+
+
+def _compare(compiled, interpreted, number):
+    c = min(timeit.repeat(compiled, number=number, repeat=3))
+    i = min(timeit.repeat(interpreted, number=number, repeat=3))
+    return {'compiled': c, 'interpreted': i, 'speedup': i / c}
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    objs = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del objs
+    return peak
+
+
+def bench_validate(number):
+    data = dict(RUN_DATA)
+    Run.validate(data)
+    return _compare(lambda: Run.validate(data),
+                    lambda: interpreted_validate(Run.PROPS, data), number)
+
+
+def bench_default(number):
+    h = Host('/nonexistent/host', data={'distro': 'ubuntu'})
+    props = Host.PROPS
+    data = h._data
+    return _compare(lambda: h.enlisted,
+                    lambda: interpreted_prop(props, data, 'enlisted'), number)
+
+
+def bench_memory(count):
+    slots = _peak_memory(
+        lambda: [Run('/b/1/runs/%d' % x, data=RUN_DATA) for x in range(count)])
+    dicts = _peak_memory(
+        lambda: [DictRun('/b/1/runs/%d' % x, RUN_DATA) for x in range(count)])
+    return {'slots': slots, 'dict': dicts, 'saved': dicts - slots}
+
+
+def run(number=100000, count=10000):
+    return {
+        'validate': bench_validate(number),
+        'default_value': bench_default(number),
+        'memory_%d_runs' % count: bench_memory(count),
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,241 @@
+'''Simulate a farm of workers hitting the dispatch API concurrently:
+
+  python3 -m benchmarks.load --hosts 200 --queued 2000 --processes 4
+
+Each simulated host checks in like bya_worker and, when it's handed a run,
+streams log chunks and a final status like bya_runner. Everything goes
+through the real WSGI app. With --processes the hosts are split across
+processes, each with their own copy of the app, just like gunicorn workers
+sharing a data directory.
+
+The report includes dispatch throughput, latency percentiles per endpoint,
+any run that was dispatched more than once or never dispatched at all, and
+the rate logs were ingested at.
+'''
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from bya import settings
+
+from benchmarks import datadir
+
+LOG_CHUNK = datadir.LOG_LINE * 20
+
+
+def _arg(args, name):
+    return args[args.index(name) + 1]
+
+
+class SimulatedHost(threading.Thread):
+    def __init__(self, name, api_key, opts, stop):
+        super(SimulatedHost, self).__init__(daemon=True)
+        self.name = name
+        self.opts = opts
+        self.stop = stop
+        self.latency = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.dispatched = []
+        self.log_bytes = 0
+        self.url = '/api/v1/host/%s/?available_runners=1' % name
+        self.headers = [('Authorization', 'Token ' + api_key)]
+
+    def _request(self, endpoint, func, *args, **kwargs):
+        start = time.perf_counter()
+        resp = func(*args, **kwargs)
+        self.latency[endpoint].append(time.perf_counter() - start)
+        if resp.status_code != 200:
+            self.errors[endpoint] += 1
+        return resp
+
+    def _execute(self, client, rundef):
+        args = rundef['args']
+        run = '%s/%s/%s' % (_arg(args, '--build_name'),
+                            _arg(args, '--build_num'), _arg(args, '--run'))
+        self.dispatched.append(run)
+        url = urllib.parse.quote('/api/v1/build/%s/' % run)
+        headers = [('Authorization', 'Token ' + _arg(args, '--api_key'))]
+        for _ in range(self.opts.log_chunks):
+            self._request('run_update', client.post, url, data=LOG_CHUNK,
+                          headers=headers, content_type='text/plain')
+            self.log_bytes += len(LOG_CHUNK)
+        self._request('run_update', client.post, url, data='done\n',
+                      headers=headers + [('X-BYA-STATUS', 'PASSED')],
+                      content_type='text/plain')
+
+    def run(self):
+        from bya.views import app
+        client = app.test_client()
+        while not self.stop.is_set():
+            resp = self._request('host_get', client.get, self.url,
+                                 headers=self.headers)
+            runs = json.loads(resp.data.decode()).get('runs', [])
+            for rundef in runs:
+                self._execute(client, rundef)
+            if not runs:
+                time.sleep(self.opts.idle_sleep)
+
+
+def _simulate(hosts, opts):
+    '''Run the given hosts in threads until the queue drains or the
+       duration expires. Returns the raw results.'''
+    stop = threading.Event()
+    threads = [SimulatedHost(name, key, opts, stop) for name, key in hosts]
+    for t in threads:
+        t.start()
+    end = time.time() + opts.duration
+    while time.time() < end and os.listdir(settings.QUEUE_DIR):
+        time.sleep(0.05)
+    stop.set()
+    results = {
+        'latency': collections.defaultdict(list),
+        'errors': collections.Counter(),
+        'dispatched': [],
+        'log_bytes': 0,
+    }
+    for t in threads:
+        t.join()
+        for k, v in t.latency.items():
+            results['latency'][k].extend(v)
+        results['errors'].update(t.errors)
+        results['dispatched'].extend(t.dispatched)
+        results['log_bytes'] += t.log_bytes
+    return results
+
+
+def _simulate_process(root, engine, hosts, opts, queue):
+    datadir.use_data_dir(root)
+    settings.STORAGE_ENGINE = engine
+    results = _simulate(hosts, opts)
+    results['latency'] = dict(results['latency'])
+    results['errors'] = dict(results['errors'])
+    queue.put(results)
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+    return {
+        'count': len(values),
+        'p50': pct(50),
+        'p90': pct(90),
+        'p99': pct(99),
+        'max': values[-1],
+    }
+
+
+def _queued_runs():
+    runs = set()
+    for e in os.scandir(settings.QUEUE_DIR):
+        # <build name>/<build num>/runs/<run>
+        parts = os.readlink(e.path).split('/')
+        runs.add('%s/%s/%s' % (parts[-4], parts[-3], parts[-1]))
+    return runs
+
+
+def simulate(opts):
+    '''Run the simulation against the current data directory'''
+    from bya.models import Host
+    hosts = [(h.name, h.api_key) for h in Host.list()]
+    queued = _queued_runs()
+
+    start = time.perf_counter()
+    if opts.processes > 1:
+        queue = multiprocessing.Queue()
+        procs = []
+        for i in range(opts.processes):
+            p = multiprocessing.Process(target=_simulate_process, args=(
+                settings.DATA_DIR, settings.STORAGE_ENGINE,
+                hosts[i::opts.processes], opts, queue))
+            p.start()
+            procs.append(p)
+        parts = [queue.get() for p in procs]
+        for p in procs:
+            p.join()
+    else:
+        parts = [_simulate(hosts, opts)]
+    elapsed = time.perf_counter() - start
+
+    latency = collections.defaultdict(list)
+    errors = collections.Counter()
+    dispatched = collections.Counter()
+    log_bytes = 0
+    for part in parts:
+        for k, v in part['latency'].items():
+            latency[k].extend(v)
+        errors.update(part['errors'])
+        dispatched.update(part['dispatched'])
+        log_bytes += part['log_bytes']
+
+    remaining = _queued_runs()
+    return {
+        'elapsed': elapsed,
+        'hosts': len(hosts),
+        'processes': opts.processes,
+        'queued': len(queued),
+        'dispatched': sum(dispatched.values()),
+        'dispatch_rate': sum(dispatched.values()) / elapsed,
+        'duplicate_dispatches': sorted(
+            k for k, v in dispatched.items() if v > 1),
+        'lost_runs': sorted(queued - set(dispatched) - remaining),
+        'still_queued': len(remaining),
+        'log_bytes': log_bytes,
+        'log_ingest_rate': log_bytes / elapsed,
+        'errors': dict(errors),
+        'latency': {k: _percentiles(v) for k, v in latency.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Split the hosts across this many processes')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Give up after this many seconds')
+    parser.add_argument('--log-chunks', type=int, default=5,
+                        help='Log chunks each run streams before finishing')
+    parser.add_argument('--idle-sleep', type=float, default=0.1,
+                        help='Seconds a host waits after an empty check-in')
+    parser.add_argument('--engine', choices=('file', 'sqlite'),
+                        default=settings.STORAGE_ENGINE)
+    parser.add_argument('-o', '--output', help='Write JSON results here')
+    datadir.add_arguments(parser)
+    parser.set_defaults(hosts=100, queued=1000, builds=5, pings=10)
+    args = parser.parse_args()
+    settings.get_logger().getLogger().setLevel(logging.WARNING)
+    settings.STORAGE_ENGINE = args.engine
+
+    gen_args = {}
+    for name in datadir.generate.__code__.co_varnames[1:]:
+        if hasattr(args, name):
+            gen_args[name] = getattr(args, name)
+    root = tempfile.mkdtemp(prefix='bya-load-')
+    try:
+        data = datadir.generate(root, **gen_args)
+        results = simulate(args)
+        results['data'] = data
+    finally:
+        shutil.rmtree(root)
+
+    results = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+'''Timing suites for the scheduler, models and views, run against a data
+directory made by benchmarks.datadir:
+
+  python3 -m benchmarks.suite --jobs 100 --builds 200 -o before.json
+  git checkout <other commit>
+  python3 -m benchmarks.suite --jobs 100 --builds 200 -o after.json
+
+Every suite reports seconds per operation so results from different commits
+and data sizes can be compared directly.
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+from bya import settings
+from bya.clean import clean_builds
+from bya.models import Host, JobGroup, Run, RunQueue, jobs
+
+from benchmarks import datadir
+
+
+def _time(func, number, repeat):
+    '''Return per-call timings of func over "repeat" runs of "number" calls'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def bench_queue(number, repeat):
+    '''Push, take and complete "number" runs, timing each step'''
+    runs = []
+    for job in jobs:
+        for run in job.get_last_build().list_runs():
+            runs.append(run)
+            if len(runs) == number:
+                break
+        if len(runs) == number:
+            break
+    number = len(runs)
+    results = {'push': [], 'take': [], 'complete': []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for r in runs:
+            RunQueue.push(r, 'bench')
+        results['push'].append((time.perf_counter() - start) / number)
+
+        start = time.perf_counter()
+        taken = [RunQueue.take('bench-host', ['bench']) for r in runs]
+        results['take'].append((time.perf_counter() - start) / number)
+
+        start = time.perf_counter()
+        for r in taken:
+            RunQueue.complete(r, Run.PASSED)
+        results['complete'].append((time.perf_counter() - start) / number)
+    return {k: {'min': min(v), 'median': statistics.median(v),
+                'number': number, 'repeat': repeat}
+            for k, v in results.items()}
+
+
+def bench_list_builds(number, repeat):
+    job = next(iter(jobs))
+    return _time(lambda: list(job.list_builds()), number, repeat)
+
+
+def bench_build_status(number, repeat):
+    job = next(iter(jobs))
+    builds = list(job.list_builds())
+
+    def status():
+        for b in builds:
+            b.status
+    result = _time(status, number, repeat)
+    result['builds'] = len(builds)
+    return result
+
+
+def bench_jobgroup(number, repeat):
+    return _time(lambda: list(JobGroup()), number, repeat)
+
+
+def _client():
+    from bya.views import app
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+def bench_host_get(number, repeat):
+    client = _client()
+    host = next(Host.list())
+    url = '/api/v1/host/%s/?available_runners=0' % host.name
+    headers = [('Authorization', 'Token ' + host.api_key)]
+    return _time(lambda: client.get(url, headers=headers), number, repeat)
+
+
+def bench_queues_view(number, repeat):
+    client = _client()
+
+    def view():
+        RunQueue.invalidate()  # time the scan rather than the cache
+        client.get('/queues/')
+    return {
+        'uncached': _time(view, number, repeat),
+        'cached': _time(lambda: client.get('/queues/'), number, repeat),
+    }
+
+
+def bench_clean_builds(number, repeat):
+    '''Time a clean that has builds to delete and then one that doesn't.
+       The data directory is copied first so it isn't changed.'''
+    root = settings.DATA_DIR
+    copy = tempfile.mkdtemp(prefix='bya-clean-')
+    try:
+        shutil.copytree(root, copy, dirs_exist_ok=True, symlinks=True)
+        datadir.use_data_dir(copy)
+        for job in jobs:
+            if not job.retention:
+                job._data['retention'] = {'unit': 'builds', 'value': 10}
+        start = time.perf_counter()
+        clean_builds()
+        first = time.perf_counter() - start
+        return {
+            'purge': first,
+            'steady_state': _time(clean_builds, number, repeat),
+        }
+    finally:
+        datadir.use_data_dir(root)
+        shutil.rmtree(copy)
+
+
+SUITES = (
+    ('queue', bench_queue, 100),
+    ('list_builds', bench_list_builds, 10),
+    ('build_status', bench_build_status, 10),
+    ('jobgroup_iter', bench_jobgroup, 10),
+    ('host_get', bench_host_get, 100),
+    ('queues_view', bench_queues_view, 10),
+    ('clean_builds', bench_clean_builds, 1),
+)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data, suites=None, repeat=3):
+    '''Run the suites against the data directory described by "data", the
+       return value of datadir.generate'''
+    results = {}
+    for name, func, number in SUITES:
+        if suites and name not in suites:
+            continue
+        results[name] = func(number, repeat)
+    return {
+        'revision': _revision(),
+        'storage_engine': settings.STORAGE_ENGINE,
+        'data': data,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir',
+                        help='Generate into this directory and keep it')
+    parser.add_argument('--suite', action='append', dest='suites',
+                        choices=[x[0] for x in SUITES],
+                        help='Only run this suite. Can be repeated')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--engine', choices=('file', 'sqlite'),
+                        default=settings.STORAGE_ENGINE)
+    parser.add_argument('-o', '--output', help='Write JSON results here')
+    datadir.add_arguments(parser)
+    args = vars(parser.parse_args())
+    settings.get_logger().getLogger().setLevel(logging.WARNING)
+
+    root = args.pop('data_dir')
+    suites = args.pop('suites')
+    repeat = args.pop('repeat')
+    settings.STORAGE_ENGINE = args.pop('engine')
+    output = args.pop('output')
+    tmp = None
+    if not root:
+        root = tmp = tempfile.mkdtemp(prefix='bya-bench-')
+    try:
+        data = datadir.generate(root, **args)
+        results = json.dumps(run(data, suites, repeat), indent=2)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+    if output:
+        with open(output, 'w') as f:
+            f.write(results)
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
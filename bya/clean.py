@@ -1,44 +1,238 @@
+import heapq
+import os
+import threading
 import time
 
-from bya import settings
-from bya.models import jobs
-
-log = settings.get_logger()
+from concurrent.futures import ThreadPoolExecutor
 
+from bya import search, settings
+from bya.models import Run, jobs
 
-def _keep_by_build(b, data):
-    if data[0] > 0:
-        data[0] -= 1
-        return False
-    return True
+log = settings.get_logger()
 
 
-def _keep_by_days(b, data):
-    return b.completion_time < data
+def _expired_builds(job_def, unit, value):
+    '''Yield the completed builds of a job that fall outside its retention
+       policy. Only the "bytes" policy has to look at every build. Build
+       numbers only go up, so the others can tell where to stop from the
+       order of the builds alone.'''
+    # always keep the most recent build. Jobs that predate the build
+    # number counter will use it to seed their next build number
+    builds = list(job_def.list_builds())[1:]
+    if unit == 'builds':
+        for b in builds[value:]:
+            if b.completion_time != 0:
+                yield b
+    elif unit == 'bytes':
+        for b in builds:
+            if b.completion_time != 0:
+                value -= b.disk_usage
+                if value < 0:
+                    yield b
+    else:
+        # oldest first, up to the first build completed inside the window
+        cutoff = time.time() - (24 * 60 * 60 * value)
+        for b in reversed(builds):
+            completed = b.completion_time
+            if completed >= cutoff:
+                break
+            if completed != 0:
+                yield b
 
 
 def clean_builds():
+    '''Selects the builds that fall outside of each job's retention policy
+       and moves them into the trash. This is fast because it only has to
+       rename directories. TrashReaper then handles the slow part.'''
     for job_def in jobs:
         log.debug('scanning %r', job_def)
         unit = job_def.retention.get('unit')
         if unit:
             value = job_def.retention['value']
             log.debug('retention unit(%s) value(%s)', unit, value)
+            for b in _expired_builds(job_def, unit, value):
+                log.info('deleting build: %r - %r', job_def, b)
+                b.delete()
+    purge_high_water()
+
+
+def _oldest_builds(job_def):
+    '''Yield the completed builds of a job, oldest first, skipping the most
+       recent one for the same reason as clean_builds.'''
+    builds = list(job_def.list_builds())[1:]
+    for b in reversed(builds):
+        if b.completion_time != 0:
+            yield b
+
+
+def purge_high_water():
+    '''Delete the oldest completed builds across every job while the total
+       disk usage is over settings.DISK_HIGH_WATER_MARK. The total comes from
+       the per-job counters so this doesn't require walking the builds.'''
+    high = settings.DISK_HIGH_WATER_MARK
+    if not high:
+        return
+    low = settings.DISK_LOW_WATER_MARK or int(high * 0.9)
+
+    job_defs = list(jobs)
+    usage = sum(x.get_disk_usage() for x in job_defs)
+    log.debug('disk usage: %d high water mark: %d', usage, high)
+    if usage <= high:
+        return
+
+    # merge the per-job oldest-first listings so we only look at as many
+    # builds as we need to delete
+    heap = []
+    for i, job_def in enumerate(job_defs):
+        builds = _oldest_builds(job_def)
+        for b in builds:
+            heap.append((b.completion_time, i, b, builds))
+            break
+    heapq.heapify(heap)
+    while heap and usage > low:
+        _, i, b, builds = heapq.heappop(heap)
+        log.info('disk usage %d over %d, deleting build: %r - %r',
+                 usage, low, job_defs[i], b)
+        usage -= b.disk_usage
+        b.delete()
+        for b in builds:
+            heapq.heappush(heap, (b.completion_time, i, b, builds))
+            break
+
+
+def compress_logs():
+    '''Compress the logs of completed runs. This is the background sweeper
+       for settings.LOG_COMPRESS = "sweep" and also catches up on runs that
+       completed before logs were compressed.'''
+    saved = 0
+    for job_def in jobs:
+        for b in job_def.list_builds():
+            for run in b.list_runs():
+                if run.status in Run.COMPLETED_STATES:
+                    saved += run.compress_log()
+    log.info('compressing logs saved %d bytes', saved)
+    return saved
+
+
+def index_logs():
+    '''Add the logs of completed runs that aren't in the search index yet.
+       Build numbers only go up, so each job's builds are walked newest
+       first and only down to the last build that had completed when it
+       was indexed.'''
+    if not settings.LOG_SEARCH_INDEX:
+        return 0
+    count = 0
+    index = search.get_index()
+    for job_def in jobs:
+        job = through = None
+        for b in job_def.list_builds():
+            if job is None:
+                job = b.name.replace('#', '/')
+                done = index.indexed_through(job)
+                through = b.number
+            if b.number <= done:
+                break
+            completed = b.completion_time
+            if not completed:
+                # look at it again next time, its runs are still going
+                through = b.number - 1
+            indexed = index.indexed(job, b.number)
+            for run in b.list_runs():
+                if run.name in indexed or \
+                        run.status not in Run.COMPLETED_STATES:
+                    continue
+                try:
+                    run.index_log(completed or None)
+                    count += 1
+                except:
+                    log.exception('unable to index log of %s', run.path)
+        if job is not None and through > done:
+            index.set_indexed_through(job, through)
+    log.info('indexed %d logs', count)
+    return count
+
+
+class RateLimiter(object):
+    '''A token bucket shared by the reaper threads to limit the number of
+       filesystem operations per second. A rate of 0 means unlimited.'''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self, ops=1):
+        if not self.rate or not ops:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._next < now:
+                self._next = now
+            delay = self._next - now
+            self._next += ops / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _ignore_missing(func, path):
+    try:
+        func(path)
+    except FileNotFoundError:
+        pass
 
-            if unit == 'builds':
-                filter_func = _keep_by_build
-                filter_data = [value]
+
+class TrashReaper(object):
+    '''Removes builds that clean_builds has moved into settings.TRASH_DIR.
+
+    The trash is laid out as TRASH_DIR/<job>/<tmpdir>/build. Each job is
+    reaped by its own worker thread and all threads share one RateLimiter.
+    Everything is driven by what's on disk, so a reaper that crashes or is
+    killed simply picks up where it left off the next time it runs.'''
+
+    def __init__(self, rate=None, workers=None):
+        if rate is None:
+            rate = settings.CLEAN_REAP_RATE
+        if workers is None:
+            workers = settings.CLEAN_REAP_WORKERS
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+
+    def _remove_tree(self, path):
+        for root, dirs, files in os.walk(path, topdown=False):
+            self.limiter.wait(len(dirs) + len(files))
+            for name in files:
+                _ignore_missing(os.unlink, os.path.join(root, name))
+            for name in dirs:
+                p = os.path.join(root, name)
+                if os.path.islink(p):
+                    _ignore_missing(os.unlink, p)
+                else:
+                    _ignore_missing(os.rmdir, p)
+        self.limiter.wait()
+        _ignore_missing(os.rmdir, path)
+
+    def _reap_job(self, path):
+        for entry in os.scandir(path):
+            log.info('reaping: %s', entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                self._remove_tree(entry.path)
             else:
-                filter_func = _keep_by_days
-                filter_data = time.time() - (24 * 60 * 60 * value)
-
-            # we don't want to delete the most recent or it will screw up
-            # our model's logic for numbering the next build
-            last_build = True
-            for b in job_def.list_builds():
-                log.debug('build: %r, data: %r', b, filter_data)
-                if not last_build and b.completion_time != 0:
-                    if filter_func(b, filter_data):
-                        log.info('deleting build: %r - %r', job_def, b)
-                        b.delete()
-                last_build = False
+                _ignore_missing(os.unlink, entry.path)
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass  # clean_builds has put something new here
+
+    def _reap_job_safe(self, path):
+        try:
+            self._reap_job(path)
+        except:
+            log.exception('unable to reap: %s', path)
+
+    def run(self):
+        if not os.path.exists(settings.TRASH_DIR):
+            return
+        paths = [e.path for e in os.scandir(settings.TRASH_DIR)
+                 if e.is_dir(follow_symlinks=False)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._reap_job_safe, paths))
@@ -1,7 +1,17 @@
-import functools
+import collections
+import contextlib
+import fcntl
 import json
+import mmap
 import os
 import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from bya.storage import FileStorage, VersionError, get_storage
 
 
 class ModelError(Exception):
@@ -11,6 +21,10 @@ class ModelError(Exception):
 
 
 class Property(object):
+    # empty values like 0 or "" are treated as unset and aren't validated,
+    # unless this is set
+    validate_empty = False
+
     def __init__(self, name, data_type, def_value=None, required=True):
         self.name = name
         self.required = required
@@ -28,6 +42,19 @@ class Property(object):
                 'Property(%s) must be: %r' % (self.name, self.data_type), 400)
         return value
 
+    def compile(self, ref, ns):
+        '''Return the lines of code PropsFile's generated validator uses to
+           check a non-empty "val" for this property. "ref" is the name this
+           property has been given in the validator's namespace "ns".'''
+        if type(self).validate is not Property.validate:
+            return ['data[%r] = %s.validate(val)' % (self.name, ref)]
+        ns[ref + '_type'] = self.data_type
+        msg = 'Property(%s) must be: %r' % (self.name, self.data_type)
+        return [
+            'if type(val) != %s_type:' % ref,
+            '    raise ModelError(%r, 400)' % msg,
+        ]
+
 
 class StrChoiceProperty(Property):
     def __init__(self, name, vals, def_value=None):
@@ -41,84 +68,713 @@ class StrChoiceProperty(Property):
                 'Property(%s) must be in: %r' % (self.name, self.vals), 400)
         return value
 
+    def compile(self, ref, ns):
+        if type(self).validate is not StrChoiceProperty.validate:
+            return super(StrChoiceProperty, self).compile(ref, ns)
+        ns[ref + '_vals'] = tuple(self.vals)
+        msg = 'Property(%s) must be in: %r' % (self.name, self.vals)
+        return [
+            'if val not in %s_vals:' % ref,
+            '    raise ModelError(%r, 400)' % msg,
+        ]
+
+
+class Counter(object):
+    '''An integer kept in a small file that multiple processes can safely
+    modify. Updates are done under an flock and written as a fixed width
+    string so that readers never need to take the lock.'''
+
+    WIDTH = 20
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def value(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def add(self, delta, initial=0):
+        '''Add delta to the counter and return the new value. "initial" can
+           be a callable that will be run under the lock when the counter
+           hasn't been created yet.'''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            buf = os.pread(fd, self.WIDTH, 0).strip()
+            if buf:
+                val = int(buf)
+            elif callable(initial):
+                val = initial()
+            else:
+                val = initial
+            val += delta
+            os.pwrite(fd, str(val).rjust(self.WIDTH).encode(), 0)
+            return val
+        finally:
+            os.close(fd)
+
+
+class SlotsFullError(RuntimeError):
+    pass
+
+
+class SlotFile(object):
+    '''A fixed size file of records that every process maps and shares.
+    It's an open addressed hash table: each slot holds a KEY_SIZE key
+    followed by VALUE_SIZE bytes of value. Updates lock just the slot they
+    touch and readers can copy the whole table in one go.
+
+    The first slot is a header holding a version, which is bumped whenever
+    a key is added or removed, and the number of tombstones left by removed
+    keys. New keys reuse tombstones and once too many pile up the table is
+    rebuilt without them.'''
+
+    KEY_SIZE = 120
+    VALUE_SIZE = 8
+    HEADER = struct.Struct('=QQ')  # version, tombstones
+    TOMBSTONE = 0xff
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.slot_size = self.KEY_SIZE + self.VALUE_SIZE
+        self._slot_cache = {}
+        self._lock = threading.Lock()
+        self.created = False
+        size = (slots + 1) * self.slot_size
+        self._remove_mismatched(path, size)
+        if not os.path.exists(path):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                os.ftruncate(fd, size)
+                os.close(fd)
+                os.link(tmp, path)
+                self.created = True
+            except FileExistsError:
+                pass  # another process beat us to it
+            finally:
+                os.unlink(tmp)
+        self.fd = os.open(path, os.O_RDWR)
+        self.mm = mmap.mmap(self.fd, size)
+
+    @staticmethod
+    def _remove_mismatched(path, size):
+        '''A file made without a header or with a different number of slots
+           can't be used, so it's removed to be created again'''
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            # without the lock, a second process could remove the new file
+            # the first one creates
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            cur = os.stat(path)
+            if st.st_size != size and st.st_ino == cur.st_ino:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def _locked(self, offset, size=None):
+        # lockf only excludes other processes, so threads need the mutex
+        size = size or self.slot_size
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, size, offset)
+
+    def _header(self):
+        return self.HEADER.unpack_from(self.mm, 0)
+
+    def _version(self):
+        '''Return the version, waiting for any compaction to finish. The
+           version is odd while a compaction is moving keys.'''
+        while True:
+            version = self._header()[0]
+            if not version % 2:
+                return version
+            time.sleep(0.001)
+
+    def _bump(self, expected=None, tombstones=0):
+        '''Bump the version before a key is written or removed. Returns False
+           if the version has moved on from the expected one. The caller
+           must hold the lock of the slot it's changing.'''
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.HEADER.size, 0)
+        try:
+            version, count = self._header()
+            if expected is not None and version != expected:
+                return False
+            self.HEADER.pack_into(
+                self.mm, 0, version + 2, count + tombstones)
+            return True
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.HEADER.size, 0)
+
+    def _key_bytes(self, key):
+        return key.encode()[:self.KEY_SIZE].ljust(self.KEY_SIZE, b'\0')
+
+    def _probe(self, kb):
+        '''Return the offset of kb's slot, or None, and the offset of the
+           first slot a new key could take, or None'''
+        free = None
+        start = zlib.crc32(kb)
+        for i in range(self.slots):
+            offset = ((start + i) % self.slots + 1) * self.slot_size
+            first = self.mm[offset]
+            if first == 0:
+                return None, offset if free is None else free
+            if first == self.TOMBSTONE:
+                if free is None:
+                    free = offset
+            elif self.mm[offset:offset + self.KEY_SIZE] == kb:
+                return offset, None
+        return None, free
+
+    def _find(self, key, create=True):
+        '''Return the offset of key's slot. If the key isn't in the table
+           it's added, unless create is False in which case None is
+           returned. The key can be removed or moved once the offset is
+           returned, so it must be checked again under the slot's lock.'''
+        kb = self._key_bytes(key)
+        offset = self._slot_cache.get(key)
+        if offset is not None and self.mm[offset:offset + self.KEY_SIZE] == kb:
+            return offset
+        while True:
+            version = self._version()
+            offset, free = self._probe(kb)
+            if offset is not None:
+                break
+            if not create:
+                # a compaction could have moved the key while probing
+                if self._header()[0] == version:
+                    return None
+                continue
+            if free is None:
+                raise SlotsFullError('No free slots left in %s' % self.path)
+            with self._locked(free):
+                # a changed version means a key was added or removed while
+                # probing, possibly this one, so the probe has to be redone
+                first = self.mm[free]
+                if first in (0, self.TOMBSTONE) and \
+                        self._bump(version, -1 if first else 0):
+                    self.mm[free:free + self.slot_size] = \
+                        kb + bytes(self.VALUE_SIZE)
+                    offset = free
+                    break
+        self._slot_cache[key] = offset
+        return offset
+
+    @contextlib.contextmanager
+    def _slot(self, key):
+        '''Lock key's slot, adding the key if needed, and yield the offset
+           of its value'''
+        kb = self._key_bytes(key)
+        while True:
+            offset = self._find(key)
+            with self._locked(offset):
+                if self.mm[offset:offset + self.KEY_SIZE] == kb:
+                    yield offset + self.KEY_SIZE
+                    return
+            # removed or moved by a compaction since it was found
+            self._slot_cache.pop(key, None)
+
+    def _read(self, key):
+        '''Return a copy of key's value or None if it isn't in the table'''
+        kb = self._key_bytes(key)
+        while True:
+            version = self._version()
+            offset = self._probe(kb)[0]
+            value = None
+            if offset is not None:
+                value = self.mm[offset + self.KEY_SIZE:offset + self.slot_size]
+            if self._header()[0] == version:
+                return value
+
+    def remove(self, key):
+        '''Remove key, leaving a tombstone in its slot for a new key to
+           reuse'''
+        kb = self._key_bytes(key)
+        while True:
+            offset = self._find(key, create=False)
+            self._slot_cache.pop(key, None)
+            if offset is None:
+                break
+            with self._locked(offset):
+                if self.mm[offset:offset + self.KEY_SIZE] == kb:
+                    self._bump(tombstones=1)
+                    self.mm[offset:offset + self.slot_size] = \
+                        bytes([self.TOMBSTONE]) + bytes(self.slot_size - 1)
+                    break
+        # tombstones are never empty, so they lengthen probes. Rebuild the
+        # table once they're a quarter of it.
+        if self._header()[1] > self.slots // 4:
+            self._compact()
+
+    def _compact(self):
+        '''Rebuild the table without its tombstones'''
+        with self._locked(0, len(self.mm)):
+            version, tombstones = self._header()
+            if tombstones <= self.slots // 4:
+                return  # another process beat us to it
+            self.HEADER.pack_into(self.mm, 0, version + 1, 0)
+            live = [(self.mm[x:x + self.KEY_SIZE],
+                     self.mm[x + self.KEY_SIZE:x + self.slot_size])
+                    for x in range(self.slot_size, len(self.mm),
+                                   self.slot_size)
+                    if self.mm[x] not in (0, self.TOMBSTONE)]
+            self.mm[self.slot_size:] = bytes(len(self.mm) - self.slot_size)
+            for kb, value in live:
+                offset = self._probe(kb)[1]
+                self.mm[offset:offset + self.slot_size] = kb + value
+            self.HEADER.pack_into(self.mm, 0, version + 2, 0)
+        self._slot_cache.clear()
+
+    def records(self):
+        '''Yield (key, value bytes) for every slot in use'''
+        while True:
+            version = self._version()
+            data = self.mm[self.slot_size:]
+            if self._header()[0] == version:
+                break
+        for offset in range(0, len(data), self.slot_size):
+            if data[offset] not in (0, self.TOMBSTONE):
+                key = data[offset:offset + self.KEY_SIZE].rstrip(b'\0')
+                yield (key.decode(errors='replace'),
+                       data[offset + self.KEY_SIZE:offset + self.slot_size])
+
+
+class FilePool(object):
+    '''Keeps up to "size" files open for appending, so files written
+    over and over, like the logs of active runs, aren't reopened for every
+    write. Writes go straight to the kernel with O_APPEND. Nothing is
+    buffered in the process, so several processes can safely append to the
+    same file.
+
+    "sync" decides when data is fsync'd: "none" leaves it to the OS,
+    "close" syncs when a file is closed, "interval" syncs a file at most
+    every sync_interval seconds and on close, and "always" syncs every
+    write.'''
+
+    def __init__(self, size, sync='none', sync_interval=1.0):
+        self.size = size
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # path -> [fd, users, last sync, close when released]
+        self._files = collections.OrderedDict()
+
+    @staticmethod
+    def _stale(entry, path):
+        '''True if the file was replaced, moved or deleted by something else,
+           like another process compressing a log, since it was opened'''
+        st = os.fstat(entry[0])
+        if st.st_nlink == 0:
+            return True
+        try:
+            cur = os.stat(path)
+        except FileNotFoundError:
+            return True
+        return (st.st_ino, st.st_dev) != (cur.st_ino, cur.st_dev)
+
+    def _acquire(self, path):
+        victims = []
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and self._stale(entry, path):
+                # writes to it would be lost, so reopen the path
+                del self._files[path]
+                if entry[1]:
+                    entry[3] = True  # close once its writers are done
+                else:
+                    victims.append(entry)
+                entry = None
+            if entry is None:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                             0o644)
+                entry = self._files[path] = [fd, 0, time.monotonic(), False]
+                # close the least recently used files nobody is writing to
+                extra = len(self._files) - self.size
+                lru = []
+                for p, e in self._files.items():
+                    if extra <= 0:
+                        break
+                    if e[1] == 0:
+                        lru.append(p)
+                        extra -= 1
+                victims.extend(self._files.pop(p) for p in lru)
+            else:
+                self._files.move_to_end(path)
+            entry[1] += 1
+        for e in victims:
+            self._close(e)
+        return entry
+
+    def _release(self, entry, path):
+        with self._lock:
+            entry[1] -= 1
+            close = entry[3] and entry[1] == 0
+            if close and self._files.get(path) is entry:
+                del self._files[path]
+        if close:
+            self._close(entry)
+
+    def _close(self, entry):
+        if self.sync != 'none':
+            os.fsync(entry[0])
+        os.close(entry[0])
+
+    def write(self, path, data):
+        '''Append bytes or an iterable of bytes to the file at path. Returns
+           the number of bytes written.'''
+        if isinstance(data, bytes):
+            data = (data,)
+        entry = self._acquire(path)
+        try:
+            fd = entry[0]
+            written = 0
+            for buf in data:
+                view = memoryview(buf)
+                while view:
+                    n = os.write(fd, view)
+                    view = view[n:]
+                    written += n
+            sync = self.sync == 'always'
+            if self.sync == 'interval':
+                sync = time.monotonic() - entry[2] >= self.sync_interval
+            if sync:
+                os.fsync(fd)
+                entry[2] = time.monotonic()
+            return written
+        finally:
+            self._release(entry, path)
+
+    def close(self, path):
+        '''Close the file at path once nothing is writing to it'''
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None:
+                return
+            if entry[1]:
+                entry[3] = True
+                return
+            del self._files[path]
+        self._close(entry)
+
+
+class FileTailer(object):
+    '''Follows a growing file on behalf of any number of readers. One thread
+    reads each new chunk of the file and every reader is handed the same
+    chunk, so the cost of an append doesn't depend on how many readers
+    there are. The last BUFFER chunks are kept in memory and readers that
+    start, or fall, further behind than that read the file themselves.'''
+
+    BUFFER = 64
+    MAX_READ = 1024 * 1024
+
+    def __init__(self, tailers, path, opener, done):
+        self.tailers = tailers
+        self.path = path
+        self.opener = opener
+        self.done = done
+        self.readers = 0
+        self.offset = 0
+        self.finished = False
+        self.chunks = collections.deque(maxlen=self.BUFFER)
+        self.cond = threading.Condition()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def _open(self, first):
+        try:
+            f = self.opener()
+        except FileNotFoundError:
+            return None  # nothing has been written yet
+        if first:
+            # readers catch up on what's already there from the file
+            try:
+                f.seek(0, os.SEEK_END)
+            except ValueError:
+                # compressed files can't seek from the end
+                while f.read(self.MAX_READ):
+                    pass
+            with self.cond:
+                self.offset = f.tell()
+                self.cond.notify_all()
+        else:
+            f.seek(self.offset)
+        return f
+
+    def _run(self):
+        f = None
+        first = True
+        try:
+            while True:
+                # check before reading so the last chunk isn't missed
+                finished = self.done()
+                if f is None:
+                    f = self._open(first)
+                first = False
+                data = f.read(self.MAX_READ) if f else b''
+                if data or finished:
+                    with self.cond:
+                        if data:
+                            self.chunks.append((self.offset, data))
+                            self.offset += len(data)
+                        self.finished = finished and len(data) < self.MAX_READ
+                        self.cond.notify_all()
+                if self.finished or not self.tailers._release_thread(self):
+                    break
+                if len(data) < self.MAX_READ:
+                    self.wake.wait(self.tailers.interval)
+                    self.wake.clear()
+        except:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+            raise
+        finally:
+            self.tailers._release_thread(self, True)
+            if f:
+                f.close()
+
+    def _read_file(self, offset, end):
+        with self.opener() as f:
+            f.seek(offset)
+            while offset < end:
+                data = f.read(min(65536, end - offset))
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+    def follow(self, offset=0, keepalive=None):
+        '''Yield (offset, bytes) chunks of the file starting at offset until
+           the file is done. If nothing new arrives within keepalive
+           seconds an empty chunk is yielded.'''
+        while True:
+            with self.cond:
+                if self.offset <= offset and not self.finished:
+                    self.cond.wait(keepalive)
+                chunks = [c for c in self.chunks if c[0] + len(c[1]) > offset]
+                end = self.offset
+                finished = self.finished
+            start = chunks[0][0] if chunks else end
+            sent = offset
+            if offset < start:
+                for chunk in self._read_file(offset, start):
+                    yield chunk
+                offset = start
+            for o, data in chunks:
+                yield offset, data[offset - o:]
+                offset = o + len(data)
+            if finished and offset >= end:
+                return
+            if offset == sent:
+                yield offset, b''  # keepalive
+
+
+class FileTailers(object):
+    '''Hands out a shared FileTailer for each file being followed. Tailers
+    notice appends from other processes by polling every "interval"
+    seconds. Appends made in this process can wake them up right away
+    with notify.'''
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._tailers = {}
+
+    def follow(self, path, opener, done, offset=0, keepalive=None):
+        '''Yield (offset, bytes) chunks of the file at path, read through
+           "opener", until "done" returns True and it's been read to the
+           end. See FileTailer.follow.'''
+        with self._lock:
+            tailer = self._tailers.get(path)
+            if tailer is None:
+                tailer = FileTailer(self, path, opener, done)
+                self._tailers[path] = tailer
+            tailer.readers += 1
+            if tailer.thread is None:
+                tailer.thread = threading.Thread(
+                    target=tailer._run, name='tail:' + path, daemon=True)
+                tailer.thread.start()
+        try:
+            for chunk in tailer.follow(offset, keepalive):
+                yield chunk
+        finally:
+            with self._lock:
+                tailer.readers -= 1
+
+    def notify(self, path):
+        tailer = self._tailers.get(path)
+        if tailer:
+            tailer.wake.set()
+
+    def _release_thread(self, tailer, force=False):
+        '''Called by a tailer's thread after each read. Returns True if the
+           thread should keep going.'''
+        with self._lock:
+            if not force and tailer.readers and not tailer.finished:
+                return True
+            tailer.thread = None
+            if self._tailers.get(tailer.path) is tailer:
+                del self._tailers[tailer.path]
+            return False
+
+
+def compile_validator(props):
+    '''Generate a function that validates a dict against a list of
+       Property objects without interpreting the list on each call'''
+    ns = {'ModelError': ModelError}
+    lines = ['def validate(data):']
+    for i, prop in enumerate(props):
+        ref = 'p%d' % i
+        ns[ref] = prop
+        lines.append('    val = data.get(%r)' % prop.name)
+        if prop.validate_empty:
+            lines.append('    if val is not None:')
+        else:
+            lines.append('    if val:')
+        lines.extend('        ' + x for x in prop.compile(ref, ns))
+        if prop.required:
+            lines.append('    else:')
+            lines.append('        raise ModelError(%r)' % (
+                         'Missing required attribute: "%s".' % prop.name))
+    lines.append('    return None')
+    exec('\n'.join(lines), ns)
+    return ns['validate']
+
+
+class LazyProperty(object):
+    '''Descriptor for the properties of a PropsFile. The object's data is
+    loaded on first access and the default is returned for empty values.'''
+
+    __slots__ = ('name', 'default')
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, clazz):
+        if obj is None:
+            return self
+        data = obj._data
+        if data is None:
+            # lazy load the definition
+            data = obj._data = obj._storage.load(obj._file)
+        v = data.get(self.name)
+        if not v:
+            return self.default
+        return v
+
 
 class PropsFile(object):
     '''Makes an easy way to build an object model based on a json/yaml file.
 
     The properties themselves are lazily loaded, so that I/O isn't required
-    until its required.'''
+    until its required. Each class's PROPS are compiled once into
+    LazyProperty descriptors and a generated validator.'''
+
+    __slots__ = ('name', '_file', '_data', '_storage')
 
     PROPS = ()
 
     @classmethod
     def validate(clazz, data):
-        for prop in clazz.PROPS:
-            val = data.get(prop.name)
-            if not val and prop.required:
-                raise ModelError(
-                    'Missing required attribute: "%s".' % prop.name)
-            elif val:
-                data[prop.name] = prop.validate(val)
-
-    @staticmethod
-    def _prop(prop, self):
-        if self._data is None:
-            # lazy load the definition
-            with open(self._file) as f:
-                self._data = self._loader(f)
-        v = self._data.get(prop)
-        if not v:
-            for p in self.PROPS:
-                if p.name == prop:
-                    return p.def_value
-        return v
+        clazz._class_init()
+        return clazz._validator(data)
 
     @classmethod
     def _class_init(clazz):
-        # a clever way to give us lazy-loadable object properies
-        flag = clazz.__name__ + '_fields_set'
-        if getattr(clazz, flag, None):
+        if '_validator' in clazz.__dict__:
             return
         for prop in clazz.PROPS:
-            setattr(clazz, prop.name,
-                    property(functools.partial(clazz._prop, prop.name)))
-        setattr(clazz, flag, True)
+            setattr(clazz, prop.name, LazyProperty(prop.name, prop.def_value))
+        clazz._validator = staticmethod(compile_validator(clazz.PROPS))
 
-    def __init__(self, name, props_file, loader=json.load):
-        if not os.path.exists(props_file):
+    def __init__(self, name, props_file, loader=json.load, storage=None,
+                 data=None):
+        if storage is None:
+            storage = FileStorage(loader=loader)
+        if data is None and not storage.exists(props_file):
             raise ModelError('%s does not exist' % name, 404)
         self._class_init()
         self.name = name
         self._file = props_file
-        self._data = None
-        self._loader = loader
+        self._data = data
+        self._storage = storage
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, self.name)
 
-    def update(self, **kwargs):
-        with open(self._file) as f:
-            orig = self._loader(f)
-        orig.update(kwargs)
-        self.validate(orig)
-        with open(self._file, 'w') as f:
-            json.dump(orig, f)
+    @property
+    def version(self):
+        '''An opaque token that changes every time the object is updated'''
+        return self._storage.version(self._file)
+
+    def update(self, expected_version=None, **kwargs):
+        '''Atomically update any number of properties. If expected_version
+           is given, the update fails when the object has changed since.'''
+        def apply(data):
+            data.update(kwargs)
+            self.validate(data)
+            return data
+        try:
+            self._data = self._storage.modify(
+                self._file, apply, expected_version)
+        except VersionError:
+            raise ModelError('%r has been modified' % self, 409)
 
 
 class PropsDir(PropsFile):
     '''Same as a PropsFile but the object lives in a directory so other
-    artifacts can be stored with it'''
+    artifacts can be stored with it. The properties themselves are kept by
+    the storage engine, see bya.storage.'''
+
+    __slots__ = ('path',)
+
+    STORAGE = None  # None means use settings.STORAGE_ENGINE
+
+    _caches = ()  # PropsCaches holding objects of this class
+
+    @classmethod
+    def get_storage(clazz):
+        if clazz.STORAGE is not None:
+            return clazz.STORAGE
+        return get_storage()
 
-    def __init__(self, path, loader=json.load):
-        fname = os.path.join(path, 'props')
+    def __init__(self, path, loader=json.load, data=None):
         name = os.path.basename(path)
-        super(PropsDir, self).__init__(name, fname, loader)
+        super(PropsDir, self).__init__(
+            name, path, loader, self.get_storage(), data)
         self.path = path
 
     def open_file(self, name, mode='r'):
         return open(os.path.join(self.path, name), mode)
 
+    def _invalidate(self):
+        for cache in self._caches:
+            cache.invalidate(self.path)
+
+    def update(self, expected_version=None, **kwargs):
+        try:
+            super(PropsDir, self).update(expected_version, **kwargs)
+        finally:
+            self._invalidate()
+
     def delete(self):
+        self._invalidate()
+        self._storage.delete(self.path)
         shutil.rmtree(self.path)
 
     @classmethod
@@ -130,27 +786,83 @@ class PropsDir(PropsFile):
         base = getattr(clazz, 'PROPS_DIR', None)
         if base:
             path = os.path.join(base, path)
-        if os.path.exists(path):
+        try:
+            os.mkdir(path)
+            clazz.get_storage().create(path, data, clazz.__name__)
+        except FileExistsError:
             raise ModelError('%s(%s) already exists' % (
                 clazz.__name__, os.path.basename(path)), 409)
-        os.mkdir(path)
-        with open(os.path.join(path, 'props'), 'w') as f:
-            json.dump(data, f)
 
     @classmethod
     def list(clazz, path=None):
         if path is None:
             path = clazz.PROPS_DIR
-        for entry in os.scandir(path):
-            if entry.is_dir():
-                yield clazz(entry.path)
+        for p, data in clazz.get_storage().list(path):
+            yield clazz(p, data=data)
+
+    @classmethod
+    def query(clazz, path=None, **filters):
+        '''Yield the objects under path whose properties match filters. The
+           sqlite engine answers this with a single indexed query.'''
+        if path is None:
+            path = getattr(clazz, 'PROPS_DIR', None)
+        storage = clazz.get_storage()
+        for p, data in storage.query(path, clazz.__name__, **filters):
+            yield clazz(p, data=data)
 
     @classmethod
     def get(clazz, name, path=None):
         if path is None:
             path = clazz.PROPS_DIR
         path = os.path.join(path, name)
-        if not os.path.exists(path):
+        if not clazz.get_storage().exists(path):
             raise ModelError(
                 '%s(%s) does not exist' % (clazz.__name__, name), 404)
         return clazz(path)
+
+
+class PropsCache(object):
+    '''An LRU cache of the properties of PropsDir objects. Entries are
+    checked against the storage engine's version on every lookup, which for
+    files is a stat rather than an open and a json parse, so changes made by
+    other processes are always seen.'''
+
+    def __init__(self, clazz, size):
+        self.clazz = clazz
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        clazz._caches = clazz._caches + (self,)
+
+    def get(self, path):
+        storage = self.clazz.get_storage()
+        try:
+            version = storage.version(path)
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry and entry[0] == version:
+                    self._entries.move_to_end(path)
+                    data = entry[1]
+                else:
+                    entry = None
+            if entry is None:
+                # the version was read first. If the object changes before
+                # it's loaded, the next lookup sees a new version and
+                # simply loads it again
+                data = storage.load(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise ModelError('%s(%s) does not exist' % (
+                self.clazz.__name__, os.path.basename(path)), 404)
+        if entry is None:
+            with self._lock:
+                self._entries[path] = (version, data)
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        # callers are free to modify the object's data
+        return self.clazz(path, data=dict(data))
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
@@ -0,0 +1,191 @@
+'''Prometheus style metrics shared by every process of the server.
+
+Values live in a fixed size file, settings.METRICS_FILE, that each process
+mmaps. The file is an open addressed hash table of slots holding a series
+key like 'bya_queue_depth{host_tag="amd64"}' followed by a double. Updates
+lock just the slot they touch, and a scrape is a single read of the file no
+matter how big the data directory gets.
+'''
+import collections
+import struct
+
+from bya import settings
+from bya.lazy import SlotFile, SlotsFullError
+
+log = settings.get_logger()
+
+# functions run once when the metrics file is first created so that gauges
+# can start out with the current state of the system
+SEEDERS = []
+
+
+class Stats(SlotFile):
+    '''Maps series keys to a double. Samples for new series are dropped
+    once the file is full, so metrics can never fail what's recording them.'''
+
+    full = False
+
+    def _dropped(self, key):
+        if not self.full:
+            self.full = True
+            log.error('%s is full, dropping samples for new series like %s. '
+                      'METRICS_SLOTS needs raising.', self.path, key)
+
+    def add(self, key, amount):
+        try:
+            with self._slot(key) as offset:
+                val, = struct.unpack_from('d', self.mm, offset)
+                struct.pack_into('d', self.mm, offset, val + amount)
+        except SlotsFullError:
+            self._dropped(key)
+
+    def set(self, key, value):
+        try:
+            with self._slot(key) as offset:
+                struct.pack_into('d', self.mm, offset, value)
+        except SlotsFullError:
+            self._dropped(key)
+
+    def items(self):
+        for key, val in self.records():
+            yield key, struct.unpack('d', val)[0]
+
+
+_stats = {}
+
+
+def get_stats():
+    path = settings.METRICS_FILE
+    stats = _stats.get(path)
+    if stats is None:
+        stats = _stats[path] = Stats(path, settings.METRICS_SLOTS)
+        if stats.created:
+            for seeder in SEEDERS:
+                seeder()
+    return stats
+
+
+def _escape(val):
+    return str(val).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    labels = ','.join(
+        '%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+    return '%s{%s}' % (name, labels)
+
+
+REGISTRY = collections.OrderedDict()
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        REGISTRY[name] = self
+
+    @property
+    def series(self):
+        return (self.name,)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        get_stats().add(_key(self.name, labels), amount)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        get_stats().add(_key(self.name, labels), amount)
+
+    def dec(self, amount=1, **labels):
+        get_stats().add(_key(self.name, labels), -amount)
+
+    def set(self, value, **labels):
+        get_stats().set(_key(self.name, labels), value)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+               120, 300, 600, 1800, 3600)
+
+    def __init__(self, name, help, buckets=None):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = buckets or self.BUCKETS
+
+    @property
+    def series(self):
+        return (self.name + '_bucket', self.name + '_sum',
+                self.name + '_count')
+
+    def observe(self, value, **labels):
+        stats = get_stats()
+        for b in self.buckets:
+            if value <= b:
+                stats.add(_key(self.name + '_bucket', dict(labels, le=b)), 1)
+        stats.add(_key(self.name + '_bucket', dict(labels, le='+Inf')), 1)
+        stats.add(_key(self.name + '_sum', labels), value)
+        stats.add(_key(self.name + '_count', labels), 1)
+
+
+def _fmt(val):
+    if val.is_integer():
+        return '%d' % val
+    return repr(val)
+
+
+def render():
+    '''Return every metric in the Prometheus text exposition format'''
+    by_series = {}
+    for m in REGISTRY.values():
+        for s in m.series:
+            by_series[s] = m
+    values = collections.defaultdict(list)
+    for key, val in get_stats().items():
+        m = by_series.get(key.split('{', 1)[0])
+        if m:
+            values[m.name].append((key, val))
+
+    lines = []
+    for m in REGISTRY.values():
+        lines.append('# HELP %s %s' % (m.name, m.help))
+        lines.append('# TYPE %s %s' % (m.name, m.TYPE))
+        for key, val in sorted(values[m.name]):
+            lines.append('%s %s' % (key, _fmt(val)))
+    return '\n'.join(lines) + '\n'
+
+
+RUNS_QUEUED = Counter(
+    'bya_runs_queued_total', 'Runs pushed onto the run queue')
+RUNS_DEQUEUED = Counter(
+    'bya_runs_dequeued_total', 'Runs handed out to a host')
+RUNS_COMPLETED = Counter(
+    'bya_runs_completed_total', 'Runs that have finished')
+BUILDS_COMPLETED = Counter(
+    'bya_builds_completed_total', 'Builds that have finished')
+QUEUE_DEPTH = Gauge(
+    'bya_queue_depth', 'Runs waiting in the queue')
+RUNS_IN_FLIGHT = Gauge(
+    'bya_runs_in_flight', 'Runs currently dispatched to a host')
+QUEUE_WAIT = Histogram(
+    'bya_run_queue_wait_seconds', 'Time runs spent queued before dispatch')
+HOST_CHECKINS = Counter(
+    'bya_host_checkins_total', 'Worker check-ins')
+HOST_CHECKIN_INTERVAL = Histogram(
+    'bya_host_checkin_interval_seconds', 'Time between worker check-ins')
+TRIGGER_CHECKS = Counter(
+    'bya_trigger_checks_total', 'Triggers that have been checked')
+TRIGGERED_BUILDS = Counter(
+    'bya_triggered_builds_total', 'Builds created by a trigger')
+REQUEST_LATENCY = Histogram(
+    'bya_request_duration_seconds', 'Time spent handling HTTP requests')
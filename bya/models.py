@@ -1,19 +1,33 @@
+import collections
 import datetime
+import fcntl
+import gzip
+import heapq
+import itertools
 import json
 import os
 import random
+import re
 import shutil
 import string
+import struct
 import tempfile
+import threading
+import time
 
 import yaml
 
-from bya import settings
+from bya import metrics, search, settings
 from bya.lazy import (
+    Counter,
+    FilePool,
+    FileTailers,
     ModelError,
     Property,
     PropsDir,
     PropsFile,
+    SlotFile,
+    SlotsFullError,
     StrChoiceProperty,
 )
 from bya.notifications import NotifyProp
@@ -21,50 +35,321 @@ from bya.triggers import TriggerProp
 
 log = settings.get_logger()
 
+# the console.log files of active runs
+log_files = FilePool(
+    settings.LOG_FD_POOL_SIZE, settings.LOG_SYNC, settings.LOG_SYNC_INTERVAL)
+
+# followers of the logs of active runs
+log_tailers = FileTailers(settings.LOG_TAIL_INTERVAL)
+
+
+class _QueueIndex(object):
+    '''The runs queued in a QUEUE_DIR as a heap of (priority, timestamp,
+    name) for each job, grouped by host tag. It's built by scanning the
+    directory and then kept up to date by reading what every process has
+    pushed from the queue log, so it's only rebuilt when the log is
+    rotated. Entries taken or cancelled by other processes are dropped
+    when take() finds them missing.'''
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.heaps = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        self.limits = {}
+        self.limits_expire = time.time() + settings.QUEUE_INDEX_TTL
+        # opened before the scan so nothing pushed during it is missed
+        fd = os.open(RunQueue._log_path(queue_dir),
+                     os.O_RDONLY | os.O_CREAT, 0o644)
+        self.log = os.fdopen(fd, 'rb')
+        self.log.seek(0, os.SEEK_END)
+        for e in os.scandir(queue_dir):
+            try:
+                run = os.path.join(queue_dir, os.readlink(e.path))
+            except FileNotFoundError:
+                continue  # it was taken while we were looking
+            self.add(e.name, run)
+
+    def add(self, name, run_path):
+        tag, prio, ts = RunQueue._parse_entry(name)
+        heapq.heappush(self.heaps[tag][RunQueue._job_dir(run_path)],
+                       (prio, ts, name))
+
+    def refresh(self):
+        '''Add the runs pushed since the last refresh. Returns False if the
+           log has been rotated, the index then has to be rebuilt.'''
+        if time.time() > self.limits_expire:
+            self.limits = {}
+            self.limits_expire = time.time() + settings.QUEUE_INDEX_TTL
+        if not os.fstat(self.log.fileno()).st_nlink:
+            return False
+        for line in self.log:
+            if not line.endswith(b'\n'):
+                # still being written, it'll be read next time
+                self.log.seek(-len(line), os.SEEK_CUR)
+                break
+            self.add(*json.loads(line.decode()))
+        return True
+
+    def close(self):
+        self.log.close()
+
 
 class RunQueue(object):
+    """Queued runs are symlinks in QUEUE_DIR named:
+         <host tag>#<priority>#<timestamp>
+       where priority is the run's index in settings.RUN_PRIORITIES. They're
+       moved to RUNNING_DIR when taken by a host. Every push is also
+       appended to the queue log, QUEUE_DIR.log, so that each process can
+       keep its index of the queue up to date without rescanning it."""
+    _snapshot = None
+    _index = None
+    _lock = threading.Lock()
+
+    # the queue log is replaced with a new one once it's this big
+    LOG_MAX = 1 << 20
+
+    @staticmethod
+    def push(run, host_tag, priority=None):
+        RunQueue.push_many([(run, host_tag)], priority)
+
     @staticmethod
-    def push(run, host_tag):
-        qname = '%s#%f' % (host_tag, datetime.datetime.now().timestamp())
+    def push_many(entries, priority=None):
+        '''Queue a list of (run, host_tag) in order. The queue is only listed
+           once no matter how many runs are pushed.'''
+        if priority is None:
+            priority = settings.RUN_PRIORITY_DEFAULT
+        prio = settings.RUN_PRIORITIES.index(priority)
         qlen = len(os.listdir(settings.QUEUE_DIR))
-        os.symlink(run.path, os.path.join(settings.QUEUE_DIR, qname))
-        run.append_log('# Queued as: %s. %d Runs waiting in front\n' % (
-                       qname, qlen))
+        ts = datetime.datetime.now().timestamp()
+        queued = []
+        for run, host_tag in entries:
+            while True:
+                qname = '%s#%d#%f' % (host_tag, prio, ts)
+                ts += 0.000001  # keeps entries unique and in order
+                # recorded first so the run can be found in the queue
+                # directories without a scan
+                run.update(queue_entry=qname)
+                try:
+                    os.symlink(run.path,
+                               os.path.join(settings.QUEUE_DIR, qname))
+                    break
+                except FileExistsError:
+                    continue
+            queued.append((run, qname))
+        RunQueue._log_pushed(queued)
+        RunQueue.invalidate()
+        counts = collections.Counter(tag for run, tag in entries)
+        for host_tag, count in counts.items():
+            metrics.RUNS_QUEUED.inc(count, host_tag=host_tag)
+            metrics.QUEUE_DEPTH.inc(count, host_tag=host_tag)
+        for i, (run, qname) in enumerate(queued):
+            run.append_log('# Queued as: %s. %d Runs waiting in front\n' % (
+                           qname, qlen + i))
+
+    @staticmethod
+    def _parse_entry(name):
+        '''Return the (host_tag, priority, timestamp) of a queue entry'''
+        tag, rest = name.split('#', 1)
+        prio, _, ts = rest.rpartition('#')
+        if not prio:  # queued before runs had priorities
+            prio = settings.RUN_PRIORITIES.index(
+                settings.RUN_PRIORITY_DEFAULT)
+        return tag, int(prio), float(ts)
+
+    @staticmethod
+    def _job_dir(run_path):
+        '''Return the builds directory of the job a run belongs to'''
+        return os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.normpath(run_path))))
+
+    @staticmethod
+    def _log_path(queue_dir):
+        return queue_dir.rstrip('/') + '.log'
+
+    @staticmethod
+    def _log_pushed(queued):
+        '''Append the (run, entry name) just queued to the queue log'''
+        path = RunQueue._log_path(settings.QUEUE_DIR)
+        data = ''.join(json.dumps([qname, run.path]) + '\n'
+                       for run, qname in queued).encode()
+        while True:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # rotating takes an exclusive lock, so once this is held
+                # the log is either current or already unlinked
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if not os.fstat(fd).st_nlink:
+                    continue  # rotated after it was opened
+                os.write(fd, data)
+                if os.fstat(fd).st_size > RunQueue.LOG_MAX:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    if os.fstat(fd).st_nlink:
+                        os.unlink(path)
+                return
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _get_index():
+        '''Return the _QueueIndex of QUEUE_DIR, brought up to date. The
+           caller must hold RunQueue._lock.'''
+        index = RunQueue._index
+        if index is not None:
+            if index.queue_dir == settings.QUEUE_DIR and index.refresh():
+                return index
+            index.close()
+        index = RunQueue._index = _QueueIndex(settings.QUEUE_DIR)
+        return index
+
+    @staticmethod
+    def _job_limit(job_dir, limits):
+        if job_dir not in limits:
+            name = os.path.basename(job_dir).replace('#', '/')
+            try:
+                limits[job_dir] = jobs.find_jobdef(name).max_concurrent_runs
+            except ModelError:
+                limits[job_dir] = None  # the job has been deleted
+        return limits[job_dir]
+
+    @staticmethod
+    def _count_running(tag=None, job_dir=None):
+        '''Count the runs in RUNNING_DIR of a host tag or a job'''
+        count = 0
+        for e in os.scandir(settings.RUNNING_DIR):
+            if tag is not None:
+                count += e.name.split('#', 1)[0] == tag
+                continue
+            try:
+                run = os.path.join(settings.QUEUE_DIR, os.readlink(e.path))
+            except FileNotFoundError:
+                continue  # another run completed while we were looking
+            count += RunQueue._job_dir(run) == job_dir
+        return count
+
+    @staticmethod
+    def _in_flight(tag, job_dir):
+        '''Return the counters of running runs for a host tag and a job'''
+        os.makedirs(settings.IN_FLIGHT_DIR, exist_ok=True)
+        return (Counter(os.path.join(settings.IN_FLIGHT_DIR, tag)),
+                Counter(os.path.join(job_dir, 'in_flight')))
+
+    @staticmethod
+    def _reserve(counter, limit, initial):
+        '''Count a run as in flight unless that would take counter over
+           limit'''
+        count = counter.add(1, initial)
+        if limit is not None and count > limit:
+            counter.add(-1)
+            return False
+        return True
 
     @staticmethod
     def take(host, host_tags):
-        '''Find the first queued run that matches one of the host tags'''
-        oldest = None
-        for e in os.scandir(settings.QUEUE_DIR):
-            tag, ts = e.name.split('#', 1)
-            ts = float(ts)
-            if tag == '*' or tag in host_tags:
-                if not oldest or ts < oldest[1]:
-                    oldest = (e, ts)
-        if oldest:
+        '''Find the most urgent, and then oldest, queued run that matches one
+           of the host tags. Host tags and jobs already running their limit
+           of runs are skipped.'''
+        tags = set(host_tags)
+        tags.add('*')
+        full_tags = set()
+        full_jobs = set()
+        while True:
+            with RunQueue._lock:
+                index = RunQueue._get_index()
+                heads = [(heap[0], tag, job)
+                         for tag in tags - full_tags
+                         for job, heap in index.heaps.get(tag, {}).items()
+                         if heap and job not in full_jobs]
+                if not heads:
+                    return None
+                entry, tag, job = min(heads)
+                heap = index.heaps[tag][job]
+                heapq.heappop(heap)
+                limit = RunQueue._job_limit(job, index.limits)
+            prio, ts, name = entry
+            tag_count, job_count = RunQueue._in_flight(tag, job)
+            if not RunQueue._reserve(
+                    tag_count, settings.HOST_TAG_MAX_RUNS.get(tag),
+                    lambda: RunQueue._count_running(tag=tag)):
+                with RunQueue._lock:
+                    heapq.heappush(heap, entry)
+                full_tags.add(tag)
+                continue
+            if not RunQueue._reserve(
+                    job_count, limit,
+                    lambda: RunQueue._count_running(job_dir=job)):
+                with RunQueue._lock:
+                    heapq.heappush(heap, entry)
+                tag_count.add(-1)
+                full_jobs.add(job)
+                continue
+            src = os.path.join(settings.QUEUE_DIR, name)
             try:
-                run = os.path.join(
-                    settings.QUEUE_DIR, os.readlink(oldest[0].path))
-                dst = os.path.join(settings.RUNNING_DIR, oldest[0].name)
-                os.rename(oldest[0].path, dst)
+                run = os.path.join(settings.QUEUE_DIR, os.readlink(src))
+                os.rename(src, os.path.join(settings.RUNNING_DIR, name))
             except FileNotFoundError:
-                log.error('Unexpected race condition handling: %s', run)
-                return
+                # another server process took it first, try the next one
+                log.info('Lost race to dequeue: %s', name)
+                tag_count.add(-1)
+                job_count.add(-1)
+                continue
+            RunQueue.invalidate()
+            metrics.RUNS_DEQUEUED.inc(host_tag=tag)
+            metrics.QUEUE_DEPTH.dec(host_tag=tag)
+            metrics.RUNS_IN_FLIGHT.inc(host_tag=tag)
+            metrics.QUEUE_WAIT.observe(time.time() - ts)
             run = Run(run)
             run.append_log('# Dequeued to: %s\n' % host)
             run.get_build().append_to_summary(
                 'Dequeued %s to: %s' % (run, host))
             return run
 
+    @staticmethod
+    def _find_running(run):
+        if run.queue_entry:
+            return run.queue_entry
+        # runs queued before their entry was recorded
+        for e in os.scandir(settings.RUNNING_DIR):
+            try:
+                path = os.readlink(e.path)
+            except FileNotFoundError:
+                continue  # another run completed while we were looking
+            if path == run.path:
+                return e.name
+
     @staticmethod
     def complete(run, status):
         '''Remove a run's symlink from the RUNNING_DIR'''
         run.get_build().append_to_summary('%s status=%s' % (run, status))
-        for e in os.scandir(settings.RUNNING_DIR):
-            path = os.readlink(e.path)
-            if path == run.path:
-                os.unlink(e.path)
-                break
+        name = RunQueue._find_running(run)
+        if name:
+            try:
+                os.unlink(os.path.join(settings.RUNNING_DIR, name))
+            except FileNotFoundError:
+                return  # it was cancelled before being dequeued
+            RunQueue.invalidate()
+            tag = name.split('#', 1)[0]
+            job = RunQueue._job_dir(run.path)
+            tag_count, job_count = RunQueue._in_flight(tag, job)
+            # a counter created now is started from RUNNING_DIR, which no
+            # longer includes this run
+            tag_count.add(-1, lambda: RunQueue._count_running(tag=tag) + 1)
+            job_count.add(
+                -1, lambda: RunQueue._count_running(job_dir=job) + 1)
+            metrics.RUNS_IN_FLIGHT.dec(host_tag=tag)
+            metrics.RUNS_COMPLETED.inc(status=status)
+
+    @staticmethod
+    def cancel(run):
+        '''Take a run off the queue. Returns False if it's not queued'''
+        if not run.queue_entry:
+            return False
+        try:
+            os.unlink(os.path.join(settings.QUEUE_DIR, run.queue_entry))
+        except FileNotFoundError:
+            return False  # it's been dequeued
+        RunQueue.invalidate()
+        metrics.QUEUE_DEPTH.dec(host_tag=run.queue_entry.split('#', 1)[0])
+        return True
 
     @staticmethod
     def list_running():
@@ -76,21 +361,93 @@ class RunQueue(object):
         for e in os.scandir(settings.QUEUE_DIR):
             yield Run(os.path.join(settings.QUEUE_DIR, os.readlink(e.path)))
 
+    @staticmethod
+    def invalidate():
+        RunQueue._snapshot = None
+
+    @staticmethod
+    def seed_metrics():
+        '''Set the queue gauges from what's currently on disk'''
+        for gauge, path in ((metrics.QUEUE_DEPTH, settings.QUEUE_DIR),
+                            (metrics.RUNS_IN_FLIGHT, settings.RUNNING_DIR)):
+            counts = collections.Counter(
+                x.split('#', 1)[0] for x in os.listdir(path))
+            for tag, count in counts.items():
+                gauge.set(count, host_tag=tag)
+
+    @staticmethod
+    def _scan(path, now):
+        '''Group the entries of a queue directory into builds. Everything
+           needed comes from the entry's name and symlink, so no run has to
+           be loaded.'''
+        entries = []
+        for e in os.scandir(path):
+            try:
+                run = os.path.join(path, os.readlink(e.path))
+            except FileNotFoundError:
+                continue  # it moved while we were looking
+            tag, prio, ts = RunQueue._parse_entry(e.name)
+            build_dir = os.path.dirname(os.path.dirname(run))
+            job = os.path.basename(os.path.dirname(build_dir))
+            entries.append((prio, ts, tag, job.replace('#', '/'),
+                            int(os.path.basename(build_dir)),
+                            os.path.basename(run)))
+        entries.sort()
+
+        builds = collections.OrderedDict()
+        for prio, ts, tag, job, num, run in entries:
+            b = builds.get((job, num))
+            if b is None:
+                b = builds[(job, num)] = {'job': job, 'build': num, 'runs': []}
+            b['runs'].append({
+                'name': run,
+                'host_tag': tag,
+                'priority': settings.RUN_PRIORITIES[prio],
+                'queued': ts,
+                'age': int(now - ts),
+            })
+        return list(builds.values())
+
+    @staticmethod
+    def snapshot():
+        '''Return the running and queued runs grouped by job and build. The
+           result is cached for settings.QUEUE_SNAPSHOT_TTL seconds, but it's
+           thrown out as soon as either queue directory changes.'''
+        now = time.time()
+        mtimes = (os.stat(settings.QUEUE_DIR).st_mtime_ns,
+                  os.stat(settings.RUNNING_DIR).st_mtime_ns)
+        cached = RunQueue._snapshot
+        if cached and cached[0] > now and cached[1] == mtimes:
+            return cached[2]
+        snapshot = {
+            'timestamp': now,
+            'running': RunQueue._scan(settings.RUNNING_DIR, now),
+            'queued': RunQueue._scan(settings.QUEUE_DIR, now),
+        }
+        RunQueue._snapshot = (now + settings.QUEUE_SNAPSHOT_TTL, mtimes,
+                              snapshot)
+        return snapshot
+
 
 class Run(PropsDir):
+    __slots__ = ()
+
     QUEUED = 'QUEUED'
     UNKNOWN = 'UNKNOWN'
     RUNNING = 'RUNNING'
     PASSED = 'PASSED'
     FAILED = 'FAILED'
+    CANCELLED = 'CANCELLED'
+    COMPLETED_STATES = (PASSED, FAILED, CANCELLED)
 
     PROPS = (
         Property('container', str),
         Property('host_tag', str),
         Property('params', dict, required=False),
         Property('api_key', str),
-        StrChoiceProperty('status',
-                          (UNKNOWN, QUEUED, RUNNING, PASSED, FAILED), QUEUED),
+        Property('queue_entry', str, required=False),
+        StrChoiceProperty('status', (UNKNOWN, QUEUED, RUNNING, PASSED, FAILED,
+                                     CANCELLED), QUEUED),
     )
 
     @classmethod
@@ -99,20 +456,120 @@ class Run(PropsDir):
                             str(build_num), 'runs', run)
         return clazz(path)
 
-    def update(self, **kwargs):
-        super(Run, self).update(**kwargs)
+    def update(self, expected_version=None, **kwargs):
+        super(Run, self).update(expected_version, **kwargs)
         status = kwargs.get('status')
-        if status in (Run.FAILED, Run.PASSED):
+        if status in Run.COMPLETED_STATES:
+            log_files.close(self.log_path())
             RunQueue.complete(self, status)
+            if status == Run.FAILED:
+                try:
+                    self._fail_fast()
+                except:
+                    log.exception('unable to fail fast after %s', self.path)
             # force build into updating status if all runs have completed
             self.get_build().status
+            # the runner of a cancelled run may still send the last of its
+            # output, so leave it to the sweeper
+            if status != Run.CANCELLED and settings.LOG_COMPRESS == 'complete':
+                self.compress_log()
+
+    def _fail_fast(self):
+        build = self.get_build()
+        try:
+            jobdef = jobs.find_jobdef(build.name.replace('#', '/'))
+        except ModelError:
+            return  # the job has been deleted
+        if jobdef.fail_fast:
+            build.cancel('fail_fast after %s' % self.name)
+
+    def cancel(self):
+        '''Stop the run. A queued run is taken off the queue. The runner of
+           a running one is told to stop in the response to its next update.
+           Returns False if the run had already completed.'''
+        while True:
+            # the run may complete at any point, so the status is only
+            # changed if it's still the version that was checked
+            version = self.version
+            self._data = None
+            if self.status in Run.COMPLETED_STATES:
+                return False
+            if RunQueue.cancel(self):
+                self.append_log('# Cancelled while queued\n')
+            try:
+                self.update(version, status=Run.CANCELLED)
+                return True
+            except ModelError as e:
+                if e.status_code != 409:
+                    raise
+
+    def log_path(self):
+        return os.path.join(self.path, 'console.log')
 
     def append_log(self, msg):
-        with self.log_fd('a') as f:
-            f.write(msg)
+        '''Append a str, bytes or an iterable of bytes to the run's log'''
+        if isinstance(msg, str):
+            msg = msg.encode()
+        written = log_files.write(self.log_path(), msg)
+        if written:
+            self.get_build().add_disk_usage(written)
+            log_tailers.notify(self.log_path())
+
+    def follow_log(self, offset=0, keepalive=None):
+        '''Yield (offset, bytes) chunks of the log, from offset, as they're
+           appended until the run completes. See lazy.FileTailer.'''
+        def done():
+            try:
+                return Run(self.path).status in Run.COMPLETED_STATES
+            except ModelError:
+                return True  # the build has been deleted
+        return log_tailers.follow(self.log_path(), lambda: self.log_fd('rb'),
+                                  done, offset, keepalive)
 
     def log_fd(self, mode='r'):
-        return self.open_file('console.log', mode)
+        try:
+            return self.open_file('console.log', mode)
+        except FileNotFoundError:
+            if mode not in ('r', 'rb'):
+                raise
+            mode = 'rb' if mode == 'rb' else 'rt'
+            return gzip.open(self.log_path() + '.gz', mode)
+
+    @property
+    def log_compressed(self):
+        return os.path.exists(self.log_path() + '.gz')
+
+    def compress_log(self):
+        '''Replace console.log with a gzip'd copy. Returns the number of
+           bytes saved.'''
+        src = self.log_path()
+        try:
+            f = open(src, 'rb')
+        except FileNotFoundError:
+            return 0  # already compressed
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.console-')
+            try:
+                with os.fdopen(fd, 'wb') as dst:
+                    os.fchmod(fd, 0o644)
+                    with gzip.GzipFile('console.log', 'wb',
+                                       settings.LOG_COMPRESS_LEVEL, dst) as gz:
+                        shutil.copyfileobj(f, gz, 65536)
+                    compressed = dst.tell()
+                os.rename(tmp, src + '.gz')
+            except:
+                os.unlink(tmp)
+                raise
+        os.unlink(src)
+        self.get_build().add_disk_usage(compressed - size)
+        return size - compressed
+
+    def index_log(self, completed=None):
+        '''Add the run's log to the search index'''
+        build = self.get_build()
+        search.get_index().add(build.name.replace('#', '/'), build.number,
+                               self.name, self.log_path(), completed)
 
     def get_build(self):
         bdir = os.path.abspath(os.path.join(self.path, '../..'))
@@ -161,31 +618,26 @@ class Build(object):
     UNKNOWN = 'UNKNOWN'
 
     @classmethod
-    def create(cls, job, runs, trigger_data=None):
-        """Creates a new Build with an increased build number"""
+    def create(cls, job, runs, trigger_data=None, linked=(), priority=None):
+        """Creates a new Build with an increased build number. "linked" are
+           completed runs of another build to include as they are. The runs
+           are queued with the job's priority unless one is given."""
         path = job._get_builds_dir()
-        if not os.path.exists(path):
-            os.mkdir(path)
-        b = job.get_last_build()
-        if not b:
-            b = 0
-        else:
-            b = b.number
-        # try to find the next build number in a concurrently safe way
-        # os.mkdir is atomic, so try up to 10 times before complaining
-        for b in range(b, b+10):
-            b += 1
+        os.makedirs(path, exist_ok=True)
+        while True:
+            b = job.next_build_number()
+            p = os.path.join(path, str(b))
             try:
-                p = os.path.join(path, str(b))
-                os.mkdir(os.path.join(path, str(b)))
-                b = cls(b, p)
-                b.append_to_summary('Build queued')
-                b._create_runs(job, runs, trigger_data)
-                return b
+                os.mkdir(p)
+                break
             except FileExistsError:
-                pass
-        # doubt this could ever happen
-        raise RuntimeError('Unable to find next build number for %s' % job)
+                # only possible for builds created before the job's counter
+                log.warning('Build number %d of %r already in use', b, job)
+        b = cls(b, p)
+        b.append_to_summary('Build queued')
+        b._link_runs(linked)
+        b._create_runs(job, runs, trigger_data, priority or job.priority)
+        return b
 
     def __init__(self, number, build_dir):
         self.number = int(number)
@@ -193,8 +645,10 @@ class Build(object):
         self.name = os.path.basename(os.path.dirname(build_dir))
 
     def append_to_summary(self, msg):
+        msg = '%s UTC: %s\n' % (datetime.datetime.utcnow(), msg)
         with self.summary_fd('a') as f:
-            f.write('%s UTC: %s\n' % (datetime.datetime.utcnow(), msg))
+            f.write(msg)
+        self.add_disk_usage(len(msg.encode()))
 
     def summary_fd(self, mode='r'):
         return open(os.path.join(self.build_dir, 'summary.log'), mode)
@@ -204,14 +658,16 @@ class Build(object):
         with self.summary_fd() as f:
             return f.read()
 
-    def _create_runs(self, job, runs, trigger_data):
+    def _create_runs(self, job, runs, trigger_data, priority):
         with open(os.path.join(self.build_dir, 'trigger_data'), 'w') as f:
             if trigger_data is None:
                 trigger_data = {}
             json.dump(trigger_data, f)
+            usage = f.tell()
         path = os.path.join(self.build_dir, 'runs')
         if not os.path.exists(path):
             os.mkdir(path)
+        queued = []
         for r in runs:
             host_tag = job.get_host_tag(r['container'])
             if not host_tag:
@@ -224,15 +680,90 @@ class Build(object):
                 'host_tag': host_tag,
                 'params': r.get('params'),
                 'api_key': key,
+                'status': Run.QUEUED,
             }
             rp = os.path.join(path, r['name'])
             Run.create(rp, data)
-            RunQueue.push(Run(rp), host_tag)
+            queued.append((Run(rp), host_tag))
+        RunQueue.push_many(queued, priority)
+        # sized after queuing as that records each run's queue entry
+        for run, _ in queued:
+            props = os.path.join(run.path, 'props')
+            if os.path.exists(props):  # not the case for sqlite storage
+                usage += os.path.getsize(props)
+        self.add_disk_usage(usage)
+
+    def _link_runs(self, runs):
+        '''Add copies of runs from another build. Their logs are hardlinked
+           rather than copied.'''
+        path = os.path.join(self.build_dir, 'runs')
+        usage = 0
+        for run in runs:
+            os.makedirs(path, exist_ok=True)
+            rp = os.path.join(path, run.name)
+            data = dict(run._data)
+            data.pop('queue_entry', None)
+            Run.create(rp, data)
+            props = os.path.join(rp, 'props')
+            if os.path.exists(props):  # not the case for sqlite storage
+                usage += os.path.getsize(props)
+            # the log might be compressed while we're looking, but one of
+            # these always exists
+            for name in ('console.log.gz', 'console.log', 'console.log.gz'):
+                dst = os.path.join(rp, name)
+                try:
+                    os.link(os.path.join(run.path, name), dst)
+                except FileNotFoundError:
+                    continue
+                usage += os.path.getsize(dst)
+                break
+        self.add_disk_usage(usage)
+
+    def cancel(self, user='unknown', runs=None):
+        '''Cancel the build's runs, or just the ones named in "runs", that
+           haven't completed. Returns the names of the runs cancelled.'''
+        cancelled = []
+        for run in self.list_runs():
+            if (runs is None or run.name in runs) and run.cancel():
+                cancelled.append(run.name)
+        if cancelled:
+            self.append_to_summary('"%s" cancelled: %s' % (
+                user, ', '.join(cancelled)))
+        return cancelled
 
     def _notify(self, status):
         jobdef = jobs.find_jobdef(self.name.replace('#', '/'))
         NotifyProp.notify_build(jobdef, self, status)
 
+    def _usage_counter(self):
+        return Counter(os.path.join(self.build_dir, 'disk_usage'))
+
+    def _job_usage_counter(self):
+        job_dir = os.path.dirname(self.build_dir)
+        return Counter(os.path.join(job_dir, 'disk_usage'))
+
+    def add_disk_usage(self, nbytes):
+        '''Account for bytes written to (or removed from) the build. The
+           job's total is kept alongside so neither requires a "du".'''
+        if nbytes:
+            self._usage_counter().add(nbytes)
+            self._job_usage_counter().add(nbytes)
+
+    @property
+    def disk_usage(self):
+        return self._usage_counter().value
+
+    def recalculate_disk_usage(self):
+        '''Walk the build to reset its counter. Only needed for builds that
+           were created before disk usage was being tracked.'''
+        total = 0
+        for root, dirs, files in os.walk(self.build_dir):
+            for name in files:
+                if root != self.build_dir or name != 'disk_usage':
+                    total += os.lstat(os.path.join(root, name)).st_size
+        self.add_disk_usage(total - self.disk_usage)
+        return total
+
     @property
     def completion_time(self):
         status_file = os.path.join(self.build_dir, 'status')
@@ -241,6 +772,16 @@ class Build(object):
         except FileNotFoundError:
             return 0
 
+    @property
+    def etag(self):
+        '''A strong validator for the build's runs, logs and summary. None
+           until the build completes, after which they never change.'''
+        try:
+            st = os.stat(os.path.join(self.build_dir, 'status'))
+        except FileNotFoundError:
+            return None
+        return '%x-%x' % (st.st_ino, st.st_mtime_ns)
+
     @property
     def status(self):
         status_file = os.path.join(self.build_dir, 'status')
@@ -254,13 +795,16 @@ class Build(object):
                 if Run.FAILED in states:
                     return 'Running with Failure(s)'
                 return Run.RUNNING
-            if not states - set([Run.PASSED, Run.FAILED]):
+            if not states - set(Run.COMPLETED_STATES):
                 status = 'Completed'
                 if Run.FAILED in states:
                     status = 'Completed with Failure(s)'
+                elif Run.CANCELLED in states:
+                    status = 'Cancelled'
                 # save state for easier future lookups
                 with open(status_file, 'w') as f:
                     f.write(status)
+                metrics.BUILDS_COMPLETED.inc(status=status)
                 self._notify(status)
                 return status
             return self.QUEUED
@@ -292,10 +836,27 @@ class Build(object):
         return Run.get(self.name, self.number, name)
 
     def delete(self):
-        tmpdir = tempfile.mkdtemp(dir=settings.DATA_DIR)
-        dst = os.path.join(tmpdir, 'build')
-        os.rename(self.build_dir, dst)
-        shutil.rmtree(tmpdir)
+        '''Atomically move the build into the trash. The actual removal of
+           the files is handled in the background by clean.TrashReaper'''
+        usage = self.disk_usage
+        trash = os.path.join(settings.TRASH_DIR, self.name)
+        while True:
+            os.makedirs(trash, exist_ok=True)
+            try:
+                tmpdir = tempfile.mkdtemp(
+                    dir=trash, prefix='%d-' % self.number)
+                os.rename(self.build_dir, os.path.join(tmpdir, 'build'))
+                break
+            except FileNotFoundError:
+                # the reaper removed the job's trash directory, or our empty
+                # tmpdir, in between. Try again unless the build is gone.
+                if not os.path.isdir(self.build_dir):
+                    raise
+        Run.get_storage().delete_tree(self.build_dir)
+        self._job_usage_counter().add(-usage)
+        if settings.LOG_SEARCH_INDEX:
+            search.get_index().remove_build(
+                self.name.replace('#', '/'), self.number)
 
     def __repr__(self):
         return 'Build(%d)' % self.number
@@ -340,16 +901,30 @@ class RetentionProp(Property):
         value = super(RetentionProp, self).validate(value)
         if value:
             unit = value.get('unit')
-            if unit not in ('days', 'builds'):
+            if unit not in ('days', 'builds', 'bytes'):
                 raise ModelError(
-                    'Invalid retention unit(%s). Must be "days" or "builds"' %
-                    unit)
+                    'Invalid retention unit(%s). Must be "days", "builds" or '
+                    '"bytes"' % unit)
             v = value.get('value')
             if not v or type(v) != int:
                 raise ModelError(
                     'Invalid retention value(%s). Must be an integer' % v)
 
 
+class PositiveIntProp(Property):
+    validate_empty = True  # so 0 isn't taken to mean unset
+
+    def __init__(self, name):
+        super(PositiveIntProp, self).__init__(name, int, None, False)
+
+    def validate(self, value):
+        value = super(PositiveIntProp, self).validate(value)
+        if value is not None and value < 1:
+            raise ModelError(
+                'Invalid %s(%d). Must be at least 1' % (self.name, value), 400)
+        return value
+
+
 class JobDefinition(PropsFile):
     """Represents the definition of job that's managed by YAML files under
        settings.JOBS_DIR like:
@@ -359,11 +934,17 @@ class JobDefinition(PropsFile):
                job1.yml
                job2.yml
     """
+    __slots__ = ('jobgroup',)
+
     PROPS = (
         Property('description', str),
         Property('timeout', int),
         Property('script', str),
         Property('secrets', list, required=False),
+        Property('fail_fast', bool, False, False),
+        StrChoiceProperty('priority', settings.RUN_PRIORITIES,
+                          settings.RUN_PRIORITY_DEFAULT),
+        PositiveIntProp('max_concurrent_runs'),
         RetentionProp(),
         ContainersProp(),
         ParamsProp(),
@@ -397,6 +978,19 @@ class JobDefinition(PropsFile):
         for b in self.list_builds():
             return b
 
+    def next_build_number(self):
+        """Allocate a build number from a counter kept with the job's builds.
+           Jobs without a counter are seeded from their latest build."""
+        def initial():
+            b = self.get_last_build()
+            return b.number if b else 0
+        path = os.path.join(self._get_builds_dir(), 'build_number')
+        return Counter(path).add(1, initial)
+
+    def get_disk_usage(self):
+        return Counter(
+            os.path.join(self._get_builds_dir(), 'disk_usage')).value
+
     def get_build(self, build_num):
         path = os.path.join(self._get_builds_dir(), str(build_num))
         if not os.path.isdir(path):
@@ -466,10 +1060,20 @@ class JobDefinition(PropsFile):
                             name, choices))
         return params
 
+    # run names become directories, so they can't be things like ".."
+    RUN_NAME = re.compile(r'^\w[\w.-]*$')
+
     def _validate_run(self, run):
         errors = []
+        if type(run) != dict:
+            return ['Run(%r) must be a dict' % (run,)]
         if 'name' not in run:
             errors.append('Run(%s) missing attribute "name"' % run)
+        elif (type(run['name']) != str or
+                not self.RUN_NAME.match(run['name'])):
+            errors.append(
+                'Run name(%s) invalid. Must be letters, digits, "_", "." or '
+                '"-" and not start with "." or "-"' % run['name'])
         container = run.get('container')
         if not container:
             errors.append('Run(%s) missing attribute "container"' % run)
@@ -483,29 +1087,103 @@ class JobDefinition(PropsFile):
 
     def _validate_runs(self, runs):
         errors = []
-        if runs and len(runs) > 0:
+        if type(runs) == list and len(runs) > 0:
             for run in runs:
                 errors.extend(self._validate_run(run))
+            if errors:
+                raise ModelError('\n'.join(errors), 400)
+            names = collections.Counter(x['name'] for x in runs)
+            for name, count in names.items():
+                if count > 1:
+                    errors.append('Run name(%s) used %d times' % (name, count))
         else:
             errors.append('runs must be a non-empty list')
         if errors:
             raise ModelError('\n'.join(errors), 400)
 
-    def create_build(self, runs, trigger_data=None):
+    def expand_matrix(self, matrix):
+        '''Return a run for every combination of the containers and params
+           in matrix, eg:
+             {'containers': ['ubuntu', 'busybox'],
+              'params': {'branch': ['master', 'v2']}}
+           gives 4 runs named like "ubuntu-master". "containers" defaults to
+           all of the job's. "name" is an optional format for the run names
+           like "{container}-{branch}".'''
+        if type(matrix) != dict:
+            raise ModelError('matrix must be a dict', 400)
+        containers = matrix.get('containers')
+        if containers is None:
+            containers = [x['image'] for x in self.containers]
+        params = matrix.get('params') or {}
+        if type(containers) != list or type(params) != dict:
+            raise ModelError(
+                'matrix "containers" must be a list and "params" a dict', 400)
+        for k, v in params.items():
+            if type(v) != list or not v:
+                raise ModelError(
+                    'matrix param(%s) must be a non-empty list' % k, 400)
+        count = len(containers)
+        for v in params.values():
+            count *= len(v)
+        if count > settings.MAX_MATRIX_RUNS:
+            raise ModelError('matrix expands to %d runs. Max is %d' % (
+                count, settings.MAX_MATRIX_RUNS), 400)
+
+        names = sorted(params.keys())
+        fmt = matrix.get('name')
+        runs = []
+        for container in containers:
+            for values in itertools.product(*(params[x] for x in names)):
+                run_params = dict(zip(names, values))
+                if fmt:
+                    try:
+                        name = fmt.format(container=container, **run_params)
+                    except (KeyError, IndexError, ValueError) as e:
+                        raise ModelError(
+                            'Invalid matrix name(%s): %r' % (fmt, e), 400)
+                else:
+                    name = '-'.join([container] + [str(x) for x in values])
+                runs.append({
+                    'name': re.sub(r'[^\w.-]+', '_', name),
+                    'container': container,
+                    'params': run_params,
+                })
+        return runs
+
+    def create_build(self, runs, trigger_data=None, priority=None):
         self._validate_runs(runs)
-        return Build.create(self, runs, trigger_data)
-
-    def rebuild(self, build, user='unknown'):
+        if priority is not None and priority not in settings.RUN_PRIORITIES:
+            raise ModelError('Invalid priority(%s). Must be one of: %s' % (
+                priority, ', '.join(settings.RUN_PRIORITIES)), 400)
+        return Build.create(self, runs, trigger_data, priority=priority)
+
+    def rebuild(self, build, user='unknown', failed_only=False):
+        '''Queue the runs of a build again in a new build. With failed_only
+           just the runs that didn't pass are queued. The passed runs are
+           linked into the new build so its status covers all the runs.'''
         runs = []
+        linked = []
         for run in build.list_runs():
+            if failed_only and run.status == Run.PASSED:
+                linked.append(run)
+                continue
             runs.append({
                 'name': run.name,
                 'params': run.params or {},
                 'container': run.container,
             })
-        b = self.create_build(runs, build.trigger_data)
-        b.append_to_summary(
-            '"%s" triggered rebuild of: %d' % (user, build.number))
+        if failed_only and not runs:
+            raise ModelError(
+                'Build #%d has no failed runs' % build.number, 400)
+        self._validate_runs(runs)
+        b = Build.create(self, runs, build.trigger_data, linked)
+        if failed_only:
+            b.append_to_summary(
+                '"%s" triggered rebuild of the failed runs of: %d' % (
+                    user, build.number))
+        else:
+            b.append_to_summary(
+                '"%s" triggered rebuild of: %d' % (user, build.number))
         return b
 
 
@@ -571,9 +1249,67 @@ class JobGroup(object):
         raise ModelError('JobDefinition(%s) not found' % path, 404)
 
 jobs = JobGroup()
+metrics.SEEDERS.append(RunQueue.seed_metrics)
+
+
+class Heartbeats(SlotFile):
+    '''When each host last checked in along with a ring of its most recent
+    check-in intervals. Every host shares one fixed size file, so it never
+    grows and reading it doesn't require opening a file per host.'''
+
+    INTERVALS = 16
+    RECORD = struct.Struct('=dI%df' % INTERVALS)
+    VALUE_SIZE = RECORD.size
+
+    def beat(self, name, now=None):
+        '''Record a check-in. Returns the seconds since the previous one or
+           None if this is the first.'''
+        if now is None:
+            now = time.time()
+        with self._slot(name) as offset:
+            last, idx, *intervals = self.RECORD.unpack_from(self.mm, offset)
+            interval = None
+            if last:
+                interval = now - last
+                intervals[idx % self.INTERVALS] = interval
+                idx += 1
+            self.RECORD.pack_into(self.mm, offset, now, idx, *intervals)
+        return interval
+
+    def _unpack(self, value):
+        last, idx, *intervals = self.RECORD.unpack(value)
+        if idx > self.INTERVALS:
+            idx %= self.INTERVALS
+            intervals = intervals[idx:] + intervals[:idx]
+        else:
+            intervals = intervals[:idx]
+        return last, intervals
+
+    def lookup(self, name):
+        '''Return the last check-in time and the recent intervals, oldest
+           first, for a host'''
+        value = self._read(name)
+        if value is None:
+            return 0, []
+        return self._unpack(value)
+
+    def all(self):
+        return {k: self._unpack(v) for k, v in self.records()}
+
+
+_heartbeats = {}
+
+
+def get_heartbeats():
+    path = settings.HEARTBEAT_FILE
+    if path not in _heartbeats:
+        _heartbeats[path] = Heartbeats(path, settings.HEARTBEAT_SLOTS)
+    return _heartbeats[path]
 
 
 class Host(PropsDir):
+    __slots__ = ()
+
     PROPS_DIR = settings.HOSTS_DIR
     PROPS = (
         Property('distro', str),
@@ -587,17 +1323,38 @@ class Host(PropsDir):
     )
 
     def ping(self):
-        # TODO limit file size to 1M (>30 days)
-        with self.open_file('pings.log', mode='a') as f:
-            f.write('%d\n' % datetime.datetime.now().timestamp())
+        try:
+            interval = get_heartbeats().beat(self.name)
+        except SlotsFullError:
+            # too many hosts for the heartbeat file, so fall back to the
+            # mtime of a file in the host's directory
+            log.exception('Unable to record check-in of %s', self.name)
+            with self.open_file('last_ping', mode='w') as f:
+                f.write('%d\n' % time.time())
+            interval = None
+        metrics.HOST_CHECKINS.inc()
+        if interval is not None:
+            metrics.HOST_CHECKIN_INTERVAL.observe(interval)
+
+    @property
+    def last_seen(self):
+        last = get_heartbeats().lookup(self.name)[0]
+        if not last:
+            try:
+                last = os.stat(os.path.join(self.path, 'last_ping')).st_mtime
+            except FileNotFoundError:
+                pass
+        return last
+
+    @property
+    def checkin_intervals(self):
+        return get_heartbeats().lookup(self.name)[1]
 
     @property
     def online(self):
         """Online means we've been "pinged" in the last 3 minutes."""
-        try:
-            with self.open_file('pings.log') as f:
-                mtime = os.fstat(f.fileno()).st_mtime
-                now = datetime.datetime.now().timestamp()
-                return now - mtime < 180  # pinged in last 3 minutes
-        except FileNotFoundError:
-            return False
+        return time.time() - self.last_seen < 180
+
+    def delete(self):
+        get_heartbeats().remove(self.name)
+        super(Host, self).delete()
@@ -0,0 +1,198 @@
+'''A trigram index over the console logs of completed runs.
+
+Each run's log is broken into the distinct (lower cased) 3 byte sequences
+it contains. A search for a pattern looks up the runs containing all of the
+pattern's trigrams and then only has to read those logs to confirm the
+match and pull out the matching lines.
+'''
+import datetime
+import gzip
+import os
+import sqlite3
+import threading
+
+from bya import settings
+from bya.lazy import ModelError
+
+
+def trigrams(data):
+    '''Return the set of trigrams, as integers, in a lower cased bytes'''
+    tris = set()
+    # logs repeat lines a lot, so only look at each distinct line once
+    for line in set(data.splitlines()):
+        tris.update(zip(line, line[1:], line[2:]))
+    return {(a << 16) | (b << 8) | c for a, b, c in tris}
+
+
+def _open_log(path):
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return gzip.open(path + '.gz', 'rb')
+
+
+def _parse_date(val):
+    if not val:
+        return None
+    try:
+        return datetime.datetime.strptime(val, '%Y-%m-%d').timestamp()
+    except ValueError:
+        raise ModelError('Invalid date(%s). Must be YYYY-MM-DD' % val, 400)
+
+
+class LogIndex(object):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY,
+            job TEXT NOT NULL,
+            build INTEGER NOT NULL,
+            run TEXT NOT NULL,
+            completed REAL NOT NULL,
+            UNIQUE (job, build, run)
+        );
+        CREATE INDEX IF NOT EXISTS logs_completed ON logs(completed);
+        CREATE TABLE IF NOT EXISTS trigrams (
+            tri INTEGER NOT NULL,
+            log INTEGER NOT NULL,
+            PRIMARY KEY (tri, log)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS trigrams_log ON trigrams(log);
+        CREATE TABLE IF NOT EXISTS progress (
+            job TEXT PRIMARY KEY,
+            build INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, job, build, run, log_path, completed=None):
+        '''Index the log of a run, replacing any previous entry for it'''
+        with _open_log(log_path) as f:
+            data = f.read(settings.LOG_SEARCH_MAX_BYTES).lower()
+        tris = trigrams(data)
+        if completed is None:
+            completed = datetime.datetime.now().timestamp()
+        with self._conn() as conn:
+            self._remove(conn, 'job=? AND build=? AND run=?',
+                         (job, build, run))
+            cur = conn.execute(
+                'INSERT INTO logs (job, build, run, completed) '
+                'VALUES (?, ?, ?, ?)', (job, build, run, completed))
+            log_id = cur.lastrowid
+            conn.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                             ((x, log_id) for x in tris))
+        return len(tris)
+
+    @staticmethod
+    def _remove(conn, where, args):
+        conn.execute('DELETE FROM trigrams WHERE log IN '
+                     '(SELECT id FROM logs WHERE %s)' % where, args)
+        conn.execute('DELETE FROM logs WHERE %s' % where, args)
+
+    def indexed(self, job, build):
+        '''Return the names of the runs of a build that have been indexed'''
+        return {x[0] for x in self._conn().execute(
+            'SELECT run FROM logs WHERE job=? AND build=?', (job, build))}
+
+    def indexed_through(self, job):
+        '''Return the build number up to which every build of a job has
+           been indexed'''
+        row = self._conn().execute(
+            'SELECT build FROM progress WHERE job=?', (job,)).fetchone()
+        return row[0] if row else 0
+
+    def set_indexed_through(self, job, build):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO progress VALUES (?, ?)',
+                         (job, build))
+
+    def remove_build(self, job, build):
+        with self._conn() as conn:
+            self._remove(conn, 'job=? AND build=?', (job, build))
+
+    def _candidates(self, pattern, job, since, until):
+        where = []
+        args = []
+        if job:
+            where.append('job=?')
+            args.append(job)
+        if since:
+            where.append('completed>=?')
+            args.append(since)
+        if until:
+            where.append('completed<?')
+            args.append(until)
+        tris = sorted(trigrams(pattern))
+        where.append(
+            'id IN (SELECT log FROM trigrams WHERE tri IN (%s) '
+            'GROUP BY log HAVING COUNT(*)=?)' % ','.join('?' * len(tris)))
+        args.extend(tris)
+        args.append(len(tris))
+        sql = ('SELECT job, build, run, completed FROM logs WHERE %s '
+               'ORDER BY completed DESC' % ' AND '.join(where))
+        return self._conn().execute(sql, args)
+
+    def search(self, pattern, job=None, since=None, until=None, limit=50,
+               max_lines=5):
+        '''Return the most recent runs whose logs contain pattern, case
+           insensitive, along with up to max_lines matching lines. "since"
+           and "until" are dates formatted as YYYY-MM-DD.'''
+        needle = pattern.encode().lower()
+        if len(needle) < 3 or b'\n' in needle:
+            raise ModelError(
+                'Search pattern must be a single line of at least 3 '
+                'characters', 400)
+        since = _parse_date(since)
+        until = _parse_date(until)
+        if until:
+            until += 24 * 60 * 60  # include the whole day
+
+        results = []
+        for job_, build, run, completed in self._candidates(
+                needle, job, since, until):
+            path = os.path.join(settings.BUILDS_DIR, job_.replace('/', '#'),
+                                str(build), 'runs', run, 'console.log')
+            lines = []
+            try:
+                with _open_log(path) as f:
+                    for line in f:
+                        if needle in line.lower():
+                            lines.append(line.decode(errors='replace'))
+                            if len(lines) == max_lines:
+                                break
+            except FileNotFoundError:
+                continue  # deleted since it was indexed
+            if lines:  # trigrams can give false positives
+                results.append({
+                    'job': job_,
+                    'build': build,
+                    'run': run,
+                    'completed': completed,
+                    'lines': lines,
+                })
+                if len(results) == limit:
+                    break
+        return results
+
+
+_indexes = {}
+
+
+def get_index():
+    db = settings.LOG_SEARCH_DB
+    if db not in _indexes:
+        _indexes[db] = LogIndex(db)
+    return _indexes[db]
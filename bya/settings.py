@@ -18,6 +18,104 @@ AUTO_ENLIST_HOSTS = False
 
 TRIGGER_INTERVAL = 120  # 120s / every 2 minutes
 
+# the most runs a build matrix started through the API can expand to
+MAX_MATRIX_RUNS = 1000
+
+# seconds the grouped view of the run queues is cached for
+QUEUE_SNAPSHOT_TTL = 5
+
+# the priority classes runs can be queued with, most urgent first. Jobs can
+# set one with "priority" and builds started through the API can override it
+RUN_PRIORITIES = ('high', 'normal', 'low')
+RUN_PRIORITY_DEFAULT = 'normal'
+
+# the most runs of a host tag that can be running at once, like:
+#   HOST_TAG_MAX_RUNS = {'aarch64': 4}
+# jobs can also limit their own runs with "max_concurrent_runs"
+HOST_TAG_MAX_RUNS = {}
+
+# each server process dequeues from its own sorted index of the run queue
+# and caches the max_concurrent_runs of the jobs in it for this many seconds
+QUEUE_INDEX_TTL = 1
+
+# used by clean.py. Deleted builds are moved into TRASH_DIR and removed in
+# the background by the TrashReaper at a limited rate of unlinks/second
+CLEAN_REAP_RATE = 1000
+CLEAN_REAP_WORKERS = 4
+
+# When the combined size of all builds goes over DISK_HIGH_WATER_MARK bytes,
+# clean_builds deletes the oldest completed builds of any job until the usage
+# is under DISK_LOW_WATER_MARK (or 90% of the high water mark if not set).
+# 0 disables the purge.
+DISK_HIGH_WATER_MARK = 0
+DISK_LOW_WATER_MARK = 0
+
+# "file" keeps the properties of hosts and runs in json files. "sqlite"
+# keeps them in STORAGE_SQLITE_DB. Use "manage.py migrate-storage" to switch.
+STORAGE_ENGINE = 'file'
+
+# How updates to hosts and runs are made durable: "none", "fsync" or "group".
+# "group" lets updates arriving within PROPS_GROUP_COMMIT_MS of each other
+# share a single sync of a journal in PROPS_JOURNAL_DIR.
+PROPS_SYNC = 'none'
+PROPS_GROUP_COMMIT_MS = 5
+
+# Number of series the shared metrics file (METRICS_FILE) can hold
+METRICS_SLOTS = 4096
+
+# Number of hosts the shared check-in file (HEARTBEAT_FILE) can hold
+HEARTBEAT_SLOTS = 1024
+
+# Number of hosts and runs whose credentials the API caches per process
+API_CACHE_SIZE = 4096
+
+# Logs of active runs are kept open, up to LOG_FD_POOL_SIZE per process.
+# LOG_SYNC is when they're fsync'd: "none" (left to the OS), "close" (when
+# the run completes), "interval" (every LOG_SYNC_INTERVAL seconds and on
+# close) or "always" (every write).
+LOG_FD_POOL_SIZE = 256
+LOG_SYNC = 'none'
+LOG_SYNC_INTERVAL = 1
+
+# Live views of a log poll for data appended by other processes every
+# LOG_TAIL_INTERVAL seconds, and send a keepalive to idle clients every
+# LOG_TAIL_KEEPALIVE seconds.
+LOG_TAIL_INTERVAL = 1
+LOG_TAIL_KEEPALIVE = 15
+
+# Logs of completed runs are gzip'd. "complete" does it as soon as a run
+# completes, "sweep" leaves it to "manage.py compress-logs", None disables.
+LOG_COMPRESS = 'complete'
+LOG_COMPRESS_LEVEL = 6
+
+# Index the logs of completed runs so they can be searched. Only the first
+# LOG_SEARCH_MAX_BYTES of each log are indexed. Indexing a big log takes too
+# long to do in a runner's request, so it's done by "manage.py index-logs",
+# which should be run periodically like from cron.
+LOG_SEARCH_INDEX = True
+LOG_SEARCH_MAX_BYTES = 16 * 1024 * 1024
+
+# Save the HTML of completed build pages, as seen by anonymous users, in
+# the build so they don't have to be rendered again
+BUILD_PAGE_CACHE = True
+
+# How logs and the worker script are sent. None streams them from the app
+# with wsgi.file_wrapper, which gunicorn sends with sendfile. "x-sendfile"
+# hands them to Apache or lighttpd, and "x-accel-redirect" to nginx. nginx
+# needs the directories files are served from mapped to internal locations:
+#   X_ACCEL_LOCATIONS = {DATA_DIR: '/bya-data/'}
+FILE_SERVER = None
+X_ACCEL_LOCATIONS = {}
+
+# Requests taking longer than this many seconds are logged (0 disables).
+# REQUEST_FS_TIMING adds a breakdown of the filesystem calls they made.
+SLOW_REQUEST_SECONDS = 2
+REQUEST_FS_TIMING = False
+
+# Run cProfile on one request in PROFILE_SAMPLE_RATE (0 disables) and dump
+# the stats into PROFILE_DIR
+PROFILE_SAMPLE_RATE = 0
+
 LOCAL_SETTINGS = os.path.join(_here, '../../local_settings.py')
 _settings_files = (
     '/etc/bya.conf.py',
@@ -32,8 +130,16 @@ JOBS_DIR = os.path.join(DATA_DIR, 'job-defs')
 BUILDS_DIR = os.path.join(DATA_DIR, 'builds')
 QUEUE_DIR = os.path.join(DATA_DIR, 'run-queue')
 RUNNING_DIR = os.path.join(DATA_DIR, 'active-runs')
+IN_FLIGHT_DIR = os.path.join(DATA_DIR, 'in-flight')
 HOSTS_DIR = os.path.join(DATA_DIR, 'hosts')
 TRIGGERS_DIR = os.path.join(DATA_DIR, 'triggers')
+TRASH_DIR = os.path.join(DATA_DIR, 'trash')
+STORAGE_SQLITE_DB = os.path.join(DATA_DIR, 'bya.db')
+METRICS_FILE = os.path.join(DATA_DIR, 'metrics')
+HEARTBEAT_FILE = os.path.join(DATA_DIR, 'heartbeats')
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+LOG_SEARCH_DB = os.path.join(DATA_DIR, 'search.db')
+PROPS_JOURNAL_DIR = os.path.join(DATA_DIR, 'journal')
 
 SECRETS_FILE = os.path.join(_here, '../../secrets.yml')
 
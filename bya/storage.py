@@ -0,0 +1,489 @@
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from bya import settings
+
+
+class VersionError(Exception):
+    '''Raised when an object has changed since the version a caller read'''
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter(object):
+    '''Moves written temp files into place in batches. The contents of a
+    batch are appended to a journal and made durable with one fsync before
+    the files are renamed, so a batch costs one fsync however many files
+    it holds. Once the journal reaches CHECKPOINT_SIZE the renamed files
+    are synced and the journal is emptied. Callers block until their file
+    is in place.
+
+    Every process has its own journal, locked for as long as it runs. When
+    a committer starts it replays the journals of processes that have
+    died. A file older than its journal entry lost that write in a crash
+    and is written again.'''
+
+    CHECKPOINT_SIZE = 1 << 20
+
+    def __init__(self, window, journal_dir):
+        self.window = window
+        self.journal_dir = journal_dir
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._dirty = set()
+        os.makedirs(journal_dir, exist_ok=True)
+        self._recover()
+        # lock it before it's given a name _recover looks for
+        fd, tmp = tempfile.mkstemp(dir=journal_dir, prefix='.new-')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.journal = os.path.join(
+            journal_dir, 'props-' + os.path.basename(tmp)[5:])
+        os.rename(tmp, self.journal)
+        _fsync_dir(journal_dir)
+        self._journal = os.fdopen(fd, 'wb')
+
+    def _recover(self):
+        '''Replay the journals left behind by processes that died'''
+        for entry in os.scandir(self.journal_dir):
+            if not entry.name.startswith('props-'):
+                continue
+            try:
+                fd = os.open(entry.path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # another committer may have replayed it while we waited
+                if os.fstat(fd).st_nlink:
+                    with os.fdopen(os.dup(fd), 'rb') as f:
+                        self._replay(f)
+                    os.unlink(entry.path)
+            except BlockingIOError:
+                pass  # its process is still running
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _replay(journal):
+        dirs = set()
+        for line in journal:
+            try:
+                dst, mtime, text = json.loads(line.decode())
+            except ValueError:
+                break  # torn by the crash, so it was never acknowledged
+            dirname = os.path.dirname(dst)
+            if not os.path.isdir(dirname):
+                continue  # the object has since been deleted
+            try:
+                stale = os.stat(dst).st_mtime_ns < mtime
+            except FileNotFoundError:
+                stale = True
+            if stale:
+                fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.props-')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        os.fchmod(fd, 0o644)
+                        f.write(text)
+                        f.flush()
+                        # so later entries for the file count as newer
+                        os.utime(fd, ns=(mtime, mtime))
+                        os.fsync(fd)
+                    os.replace(tmp, dst)
+                except:
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+            else:
+                # the write survived but may not be on disk yet
+                with open(dst) as f:
+                    os.fsync(f.fileno())
+            dirs.add(dirname)
+        for d in dirs:
+            _fsync_dir(d)
+
+    def commit(self, tmp, dst, text):
+        item = [tmp, dst, text, threading.Event(), None]
+        with self._cond:
+            self._pending.append(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        item[3].wait()
+        if item[4]:
+            raise item[4]
+
+    def _commit(self, batch):
+        records = []
+        for item in batch:
+            try:
+                mtime = os.stat(item[0]).st_mtime_ns
+                records.append(json.dumps([item[1], mtime, item[2]]) + '\n')
+            except Exception as e:
+                item[4] = e
+        self._journal.write(''.join(records).encode())
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        for item in batch:
+            if item[4] is None:
+                try:
+                    os.replace(item[0], item[1])
+                    self._dirty.add(item[1])
+                except Exception as e:
+                    item[4] = e
+        if self._journal.tell() >= self.CHECKPOINT_SIZE:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        '''Sync the files the journal covers so that it can be emptied'''
+        dirs = set()
+        for path in self._dirty:
+            try:
+                with open(path) as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                continue
+            dirs.add(os.path.dirname(path))
+        for d in dirs:
+            try:
+                _fsync_dir(d)
+            except FileNotFoundError:
+                pass
+        self._dirty.clear()
+        self._journal.seek(0)
+        self._journal.truncate()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            try:
+                self._commit(batch)
+            except Exception as e:
+                for item in batch:
+                    item[4] = item[4] or e
+            for item in batch:
+                item[3].set()
+
+
+_committers = {}
+
+
+def _get_committer():
+    key = (settings.PROPS_GROUP_COMMIT_MS / 1000.0, settings.PROPS_JOURNAL_DIR)
+    if key not in _committers:
+        _committers[key] = GroupCommitter(*key)
+    return _committers[key]
+
+
+class FileStorage(object):
+    '''The original storage engine: each object's properties live in their
+    own file. For PropsDir objects that's <path>/<filename>.
+
+    Files are replaced atomically by writing a temp file and renaming it.
+    settings.PROPS_SYNC controls durability: "none" leaves flushing to the
+    OS, "fsync" syncs every write and "group" journals writes that arrive
+    close together with a single sync using a GroupCommitter.'''
+
+    def __init__(self, filename=None, loader=json.load):
+        self.filename = filename
+        self.loader = loader
+
+    def _file(self, path):
+        if self.filename:
+            return os.path.join(path, self.filename)
+        return path
+
+    def exists(self, path):
+        return os.path.exists(self._file(path))
+
+    def load(self, path):
+        with open(self._file(path)) as f:
+            return self.loader(f)
+
+    def version(self, path):
+        st = os.stat(self._file(path))
+        return '%d.%d' % (st.st_ino, st.st_mtime_ns)
+
+    def create(self, path, data, kind=None):
+        self.save(path, data)
+
+    def save(self, path, data):
+        fname = self._file(path)
+        dirname = os.path.dirname(fname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.props-')
+        try:
+            text = json.dumps(data)
+            with os.fdopen(fd, 'w') as f:
+                os.fchmod(fd, 0o644)
+                f.write(text)
+                if settings.PROPS_SYNC == 'fsync':
+                    f.flush()
+                    os.fsync(fd)
+            if settings.PROPS_SYNC == 'group':
+                _get_committer().commit(tmp, fname, text)
+            else:
+                os.replace(tmp, fname)
+                if settings.PROPS_SYNC == 'fsync':
+                    _fsync_dir(dirname)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    @contextlib.contextmanager
+    def _locked(self, path):
+        # lock the directory, the props file itself gets replaced on writes
+        if self.filename:
+            lockpath = path
+        else:
+            lockpath = os.path.dirname(path)
+        fd = os.open(lockpath, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def modify(self, path, func, version=None):
+        '''Atomically replace an object's data with func(data). If version
+           is given, VersionError is raised when the object has changed.'''
+        with self._locked(path):
+            if version is not None and version != self.version(path):
+                raise VersionError(path)
+            data = func(self.load(path))
+            self.save(path, data)
+            return data
+
+    def delete(self, path):
+        try:
+            os.unlink(self._file(path))
+        except FileNotFoundError:
+            pass
+
+    def delete_tree(self, path):
+        '''Objects under a directory are removed along with the directory'''
+        pass
+
+    def list(self, parent):
+        '''Yield (path, data) for each object under parent. Data is None
+           when it can't be loaded cheaply.'''
+        for entry in os.scandir(parent):
+            if entry.is_dir():
+                yield entry.path, None
+
+    def query(self, parent, kind=None, **filters):
+        if parent is None:
+            raise ValueError('FileStorage can only query under a directory')
+        for path, data in self.list(parent):
+            try:
+                data = self.load(path)
+            except FileNotFoundError:
+                continue
+            if all(data.get(k) == v for k, v in filters.items()):
+                yield path, data
+
+
+def _indexes(path, data):
+    '''Return the values for the indexed columns of an object'''
+    parent = os.path.dirname(path)
+    build = None
+    if os.path.basename(parent) == 'runs':
+        build = os.path.dirname(parent)
+    return parent, build, data.get('status'), data.get('host_tag')
+
+
+class SqliteStorage(object):
+    '''Keeps every object's properties in one SQLite database so that
+    listing and filtering become a single indexed query. The object's
+    directory still exists on disk for things like console.log.'''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS props (
+            path TEXT PRIMARY KEY,
+            kind TEXT,
+            parent TEXT NOT NULL,
+            build TEXT,
+            status TEXT,
+            host_tag TEXT,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS props_kind ON props(kind);
+        CREATE INDEX IF NOT EXISTS props_parent ON props(parent);
+        CREATE INDEX IF NOT EXISTS props_build ON props(build);
+        CREATE INDEX IF NOT EXISTS props_status ON props(status);
+        CREATE INDEX IF NOT EXISTS props_host_tag ON props(host_tag);
+    '''
+    INDEXED = ('build', 'status', 'host_tag')
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL mode already group commits, so only "none" differs
+            if settings.PROPS_SYNC == 'none':
+                conn.execute('PRAGMA synchronous=NORMAL')
+            else:
+                conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+
+    def exists(self, path):
+        cur = self._conn().execute(
+            'SELECT 1 FROM props WHERE path=?', (os.path.abspath(path),))
+        return cur.fetchone() is not None
+
+    def load(self, path):
+        cur = self._conn().execute(
+            'SELECT data FROM props WHERE path=?', (os.path.abspath(path),))
+        row = cur.fetchone()
+        if row is None:
+            raise FileNotFoundError(path)
+        return json.loads(row[0])
+
+    def create(self, path, data, kind=None):
+        path = os.path.abspath(path)
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    'INSERT INTO props VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                    (path, kind) + _indexes(path, data) + (json.dumps(data),))
+        except sqlite3.IntegrityError:
+            raise FileExistsError(path)
+
+    def save(self, path, data):
+        path = os.path.abspath(path)
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO props VALUES (?, NULL, ?, ?, ?, ?, ?, 0) '
+                'ON CONFLICT(path) DO UPDATE SET build=excluded.build, '
+                'status=excluded.status, host_tag=excluded.host_tag, '
+                'data=excluded.data, version=version+1',
+                (path,) + _indexes(path, data) + (json.dumps(data),))
+
+    def version(self, path):
+        cur = self._conn().execute(
+            'SELECT version FROM props WHERE path=?', (os.path.abspath(path),))
+        row = cur.fetchone()
+        if row is None:
+            raise FileNotFoundError(path)
+        return str(row[0])
+
+    def modify(self, path, func, version=None):
+        path = os.path.abspath(path)
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT data, version FROM props WHERE path=?',
+                (path,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(path)
+            if version is not None and version != str(row[1]):
+                raise VersionError(path)
+            data = func(json.loads(row[0]))
+            conn.execute(
+                'UPDATE props SET parent=?, build=?, status=?, host_tag=?, '
+                'data=?, version=version+1 WHERE path=?',
+                _indexes(path, data) + (json.dumps(data), path))
+            return data
+
+    def delete(self, path):
+        with self._conn() as conn:
+            conn.execute(
+                'DELETE FROM props WHERE path=?', (os.path.abspath(path),))
+
+    def delete_tree(self, path):
+        # '0' sorts right after '/' so this is an index range scan
+        path = os.path.abspath(path)
+        with self._conn() as conn:
+            conn.execute('DELETE FROM props WHERE path=? OR '
+                         '(path >= ? AND path < ?)',
+                         (path, path + '/', path + '0'))
+
+    def list(self, parent):
+        return self.query(parent)
+
+    def query(self, parent, kind=None, **filters):
+        where = []
+        args = []
+        if kind is not None:
+            where.append('kind=?')
+            args.append(kind)
+        if parent is not None:
+            where.append('parent=?')
+            args.append(os.path.abspath(parent))
+        for k in self.INDEXED:
+            if k in filters:
+                v = filters.pop(k)
+                if k == 'build':
+                    v = os.path.abspath(v)
+                where.append('%s=?' % k)
+                args.append(v)
+        sql = 'SELECT path, data FROM props'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        for path, data in self._conn().execute(sql + ' ORDER BY path', args):
+            data = json.loads(data)
+            if all(data.get(k) == v for k, v in filters.items()):
+                yield path, data
+
+
+_engines = {}
+
+
+def get_storage():
+    '''Return the storage engine configured by settings.STORAGE_ENGINE'''
+    if settings.STORAGE_ENGINE == 'sqlite':
+        key = ('sqlite', settings.STORAGE_SQLITE_DB)
+        if key not in _engines:
+            _engines[key] = SqliteStorage(settings.STORAGE_SQLITE_DB)
+        return _engines[key]
+    elif settings.STORAGE_ENGINE == 'file':
+        key = ('file',)
+        if key not in _engines:
+            _engines[key] = FileStorage('props')
+        return _engines[key]
+    raise ValueError('Unknown STORAGE_ENGINE: %s' % settings.STORAGE_ENGINE)
+
+
+def migrate(root, dst, kind, src=None):
+    '''Copy every object found under root from the file based layout into
+       the dst engine. Returns the number of objects migrated.'''
+    if src is None:
+        src = FileStorage('props')
+    count = 0
+    for path, dirs, files in os.walk(root):
+        if 'props' in files:
+            data = src.load(path)
+            try:
+                dst.create(path, data, kind)
+            except FileExistsError:
+                dst.save(path, data)
+            count += 1
+    return count
@@ -4,7 +4,7 @@ import os
 
 import requests
 
-from bya import settings
+from bya import metrics, settings
 from bya.lazy import ModelError, Property
 
 log = settings.get_logger()
@@ -139,7 +139,9 @@ class TriggerManager(object):
                     t = TRIGGERS[trigger['type']]
                     checker = t.get_checker(job_def, trigger)
                     props = checker.changed()
+                    metrics.TRIGGER_CHECKS.inc(type=trigger['type'])
                     if props is not None:
+                        metrics.TRIGGERED_BUILDS.inc(type=trigger['type'])
                         props['BYA_TRIGGER'] = trigger['type']
                         b = job_def.create_build(trigger['runs'], props)
                         b.append_to_summary(
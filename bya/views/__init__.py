@@ -11,3 +11,4 @@ login_manager.login_view = 'login'
 import bya.views.user_auth  # NOQA
 import bya.views.api  # NOQA
 import bya.views.ui  # NOQA
+import bya.views.timing  # NOQA
@@ -1,17 +1,33 @@
 import functools
 import os
 
-from flask import jsonify, request
+from flask import Response, jsonify, request, url_for
+from flask_login import current_user
 
-from bya import settings
+from bya import metrics, search, settings
 from bya.views import app
+from bya.lazy import PropsCache
 from bya.models import (
     Host,
     ModelError,
     Run,
     RunQueue,
+    jobs,
 )
 
+# credentials and state for the hosts and runs hitting the API
+_host_cache = PropsCache(Host, settings.API_CACHE_SIZE)
+_run_cache = PropsCache(Run, settings.API_CACHE_SIZE)
+
+
+def _get_host(name):
+    return _host_cache.get(os.path.join(Host.PROPS_DIR, name))
+
+
+def _get_run(bname, bnum, run):
+    return _run_cache.get(
+        os.path.join(settings.BUILDS_DIR, bname, str(bnum), 'runs', run))
+
 
 def _is_host_authenticated(host):
     key = request.headers.get('Authorization', None)
@@ -35,11 +51,12 @@ def host_authenticated(f):
             resp = jsonify({'Message': 'Invalid Authorization header'})
             resp.status_code = 401
             return resp
-        host = Host.get(kwargs['name'])
+        host = _get_host(kwargs['name'])
         if parts[1] != host.api_key:
             resp = jsonify({'Message': 'Incorrect API key for host'})
             resp.status_code = 401
             return resp
+        request.host = host
         return f(*args, **kwargs)
     return wrapper
 
@@ -57,7 +74,7 @@ def run_authenticated(f):
             resp = jsonify({'Message': 'Invalid Authorization header'})
             resp.status_code = 401
             return resp
-        run = Run.get(kwargs['bname'], kwargs['bnum'], kwargs['run'])
+        run = _get_run(kwargs['bname'], kwargs['bnum'], kwargs['run'])
         if parts[1] != run.api_key:
             resp = jsonify({'Message': 'Incorrect API key for run'})
             resp.status_code = 401
@@ -71,6 +88,13 @@ def run_authenticated(f):
     return wrapper
 
 
+@app.before_first_request
+def _open_metrics():
+    # the first process to open the metrics file seeds its gauges. Do that
+    # now rather than in the middle of a request that changes the queue
+    metrics.get_stats()
+
+
 @app.errorhandler(ModelError)
 def _model_error_handler(error):
     return str(error) + '\n', error.status_code
@@ -103,21 +127,20 @@ def host_update(name):
     if 'enlisted' in request.json:
         raise ModelError('"enlisted" field cannot be updated via API', 403)
 
-    Host.get(name).update(**request.json)
+    request.host.update(**request.json)
     return jsonify({})
 
 
 @app.route('/api/v1/host/<string:name>/', methods=['DELETE'])
 @host_authenticated
 def host_delete(name):
-    Host.get(name).delete()
+    request.host.delete()
     return jsonify({})
 
 
 @app.route('/api/v1/host/<string:name>/', methods=['GET'])
 def host_get(name):
-    h = Host.get(name)
-    h.cpu_type  # force data to be loaded
+    h = _get_host(name)
     h._data['worker_version'] = str(os.stat(settings.WORKER_SCRIPT).st_mtime)
     if _is_host_authenticated(h) and h.enlisted:
         h.ping()
@@ -132,14 +155,112 @@ def host_get(name):
     return jsonify(h._data)
 
 
+def _not_allowed():
+    resp = jsonify({'Message': 'Not allowed to start builds of this job'})
+    resp.status_code = 401
+    return resp
+
+
+def _build_created(path, build, runs):
+    resp = jsonify({'build': build.number, 'runs': runs})
+    resp.status_code = 201
+    name = path.rsplit('/', 1)
+    resp.headers['Location'] = url_for(
+        'build', name=name[-1], jobgroup=name[0] if len(name) > 1 else None,
+        build_num=build.number)
+    return resp
+
+
+@app.route('/api/v1/jobs/<path:path>/builds', methods=['POST'])
+def build_create(path):
+    '''Start a build of the job from a list of "runs", or a "matrix" that's
+       expanded into them. See JobDefinition.expand_matrix. An optional
+       "priority" overrides the job's.'''
+    job = jobs.find_jobdef(path)
+    if not job.can_rebuild(current_user):
+        return _not_allowed()
+    data = request.get_json(force=True, silent=True)
+    if type(data) != dict:
+        raise ModelError('Request body must be a JSON object', 400)
+    runs = data.get('runs')
+    if 'matrix' in data:
+        if runs:
+            raise ModelError('Only one of "runs" or "matrix" can be given',
+                             400)
+        runs = job.expand_matrix(data['matrix'])
+    trigger_data = data.get('trigger_data')
+    if trigger_data is not None and type(trigger_data) != dict:
+        raise ModelError('trigger_data must be a dict', 400)
+
+    build = job.create_build(runs, trigger_data, data.get('priority'))
+    build.append_to_summary('"%s" started build via API' % current_user.id)
+    return _build_created(path, build, [x['name'] for x in runs])
+
+
+@app.route('/api/v1/jobs/<path:path>/builds/<int:build_num>/rebuild',
+           methods=['POST'])
+def build_rebuild(path, build_num):
+    '''Queue a build again. With {"failed_only": true} only the runs that
+       didn't pass are run again.'''
+    job = jobs.find_jobdef(path)
+    if not job.can_rebuild(current_user):
+        return _not_allowed()
+    data = request.get_json(force=True, silent=True) or {}
+    build = job.rebuild(job.get_build(build_num), current_user.id,
+                        bool(data.get('failed_only')))
+    return _build_created(path, build, [x.name for x in build.list_runs()])
+
+
+@app.route('/api/v1/queues/', methods=['GET'])
+def queues_list():
+    return jsonify(RunQueue.snapshot())
+
+
+@app.route('/api/v1/search/', methods=['GET'])
+def search_logs():
+    limit = request.args.get('limit', '50')
+    if not limit.isdigit() or int(limit) < 1:
+        raise ModelError('Invalid limit(%s). Must be a positive integer' %
+                         limit, 400)
+    results = search.get_index().search(
+        request.args.get('q', ''), request.args.get('job'),
+        request.args.get('since'), request.args.get('until'), int(limit))
+    return jsonify({'results': results})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/v1/build/<string:bname>/<int:bnum>/<string:run>/',
            methods=['POST'])
 @run_authenticated
 def run_update(bname, bnum, run):
+    if request.run.status == Run.CANCELLED:
+        # the runner should stop. Its output and last status don't matter
+        # and the log may already be compressed and cached by clients
+        return jsonify({'cancel': True})
+    # stream the body to disk as is, and before any status change so a
+    # completed run's log is complete
+    chunks = iter(functools.partial(request.stream.read, 65536), b'')
+    request.run.append_log(chunks)
     status = request.headers.get('X-BYA-STATUS')
     if status:
         request.run.update(status=status)
-    log_data = request.data.decode()
-    if log_data:
-        request.run.append_log(log_data)
     return jsonify({})
+
+
+@app.route('/api/v1/jobs/<path:path>/builds/<int:build_num>/cancel',
+           methods=['POST'])
+def build_cancel(path, build_num):
+    '''Cancel the runs of a build that haven't completed. {"runs": [...]}
+       can limit it to the named runs.'''
+    job = jobs.find_jobdef(path)
+    if not job.can_rebuild(current_user):
+        return _not_allowed()
+    data = request.get_json(force=True, silent=True) or {}
+    build = job.get_build(build_num)
+    cancelled = build.cancel(current_user.id, data.get('runs'))
+    return jsonify({'cancelled': cancelled})
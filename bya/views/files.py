@@ -0,0 +1,80 @@
+'''Serve files without copying them through Python.
+
+By default files go back as a wsgi.file_wrapper, which gunicorn sends with
+sendfile(2). When settings.FILE_SERVER names a front proxy the response is
+just a header telling the proxy which file to send.
+'''
+import datetime
+import os
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+from bya import settings
+
+
+def _accel_location(path):
+    for directory, location in settings.X_ACCEL_LOCATIONS.items():
+        directory = os.path.join(os.path.realpath(directory), '')
+        if path.startswith(directory):
+            return location.rstrip('/') + '/' + path[len(directory):]
+    return None
+
+
+# for responses that will never change, like the logs of completed builds
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def is_fresh(etag=None, mtime=None):
+    '''Return True if the conditional headers of the request show the client
+       already has the current version of a resource'''
+    if etag and request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return bool(mtime and since and since >= mtime)
+
+
+def serve_file(path, mimetype, content_encoding=None, growing=False,
+               etag=None):
+    '''Return a response for the file at path that honours If-Modified-Since.
+       "growing" files, like the logs of active runs, aren't given a
+       Content-Length or Last-Modified as more may be written while, or
+       within a second of, them being sent. Files given an etag are
+       immutable and are cached for good, growing files are never given
+       one.'''
+    if growing:
+        etag = None
+    path = os.path.realpath(path)
+    f = open(path, 'rb')
+    st = os.fstat(f.fileno())
+    mtime = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+    if is_fresh(etag, None if growing else mtime):
+        f.close()
+        resp = Response(status=304)
+    else:
+        location = None
+        if settings.FILE_SERVER == 'x-accel-redirect':
+            location = _accel_location(path)
+        if location:
+            f.close()
+            resp = Response(mimetype=mimetype)
+            resp.headers['X-Accel-Redirect'] = location
+            resp.content_length = st.st_size
+        elif settings.FILE_SERVER == 'x-sendfile':
+            f.close()
+            resp = Response(mimetype=mimetype)
+            resp.headers['X-Sendfile'] = path
+            resp.content_length = st.st_size
+        else:
+            resp = Response(wrap_file(request.environ, f), mimetype=mimetype,
+                            direct_passthrough=True)
+            if not growing:
+                resp.content_length = st.st_size
+        if content_encoding:
+            resp.headers['Content-Encoding'] = content_encoding
+    if not growing:
+        resp.last_modified = mtime
+    if etag:
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = IMMUTABLE
+    return resp
@@ -0,0 +1,115 @@
+'''Per-endpoint request timing and sampled profiling.
+
+Every request's latency is recorded in the bya_request_duration_seconds
+histogram. Requests slower than settings.SLOW_REQUEST_SECONDS are logged,
+and when settings.REQUEST_FS_TIMING is on the log includes how many
+filesystem calls the request made and how long they took. Setting
+settings.PROFILE_SAMPLE_RATE to N runs cProfile on one request in N and
+dumps the result into settings.PROFILE_DIR.
+'''
+import builtins
+import collections
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+
+from flask import g, request
+
+from bya import metrics, settings
+from bya.views import app
+
+log = settings.get_logger()
+
+FS_CALLS = ('stat', 'lstat', 'scandir', 'listdir', 'open', 'readlink',
+            'symlink', 'rename', 'replace', 'unlink', 'mkdir', 'rmdir',
+            'fsync')
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+_local = threading.local()
+_fs_timers_installed = False
+
+
+def _timed(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        calls = getattr(_local, 'fs_calls', None)
+        if calls is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call = calls[name]
+            call[0] += 1
+            call[1] += time.perf_counter() - start
+    return wrapper
+
+
+def install_fs_timers():
+    '''Wrap the filesystem calls the models use so their time can be
+       attributed to the request running on the calling thread. The
+       wrappers only do a thread-local lookup when no request is timed.'''
+    global _fs_timers_installed
+    if _fs_timers_installed:
+        return
+    for name in FS_CALLS:
+        setattr(os, name, _timed('os.' + name, getattr(os, name)))
+    builtins.open = _timed('open', builtins.open)
+    _fs_timers_installed = True
+
+
+def _fs_summary(calls):
+    return ', '.join(
+        '%s=%d/%.3fs' % (name, count, elapsed)
+        for name, (count, elapsed) in sorted(
+            calls.items(), key=lambda x: x[1][1], reverse=True))
+
+
+@app.before_request
+def _start_request():
+    g.request_start = time.monotonic()
+    if settings.REQUEST_FS_TIMING:
+        install_fs_timers()
+        _local.fs_calls = collections.defaultdict(lambda: [0, 0.0])
+    rate = settings.PROFILE_SAMPLE_RATE
+    if rate and random.randrange(rate) == 0:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.teardown_request
+def _end_request(exc):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return
+    elapsed = time.monotonic() - start
+    endpoint = request.endpoint or 'unknown'
+    calls = getattr(_local, 'fs_calls', None)
+    _local.fs_calls = None
+
+    profiler = getattr(g, 'profiler', None)
+    if profiler:
+        profiler.disable()
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(settings.PROFILE_DIR, '%s-%d-%d.prof' % (
+            endpoint, time.time() * 1000, os.getpid()))
+        profiler.dump_stats(path)
+
+    # the method comes from the client, so anything unusual is lumped
+    # together rather than given its own series in the metrics file
+    method = request.method
+    if method not in METHODS:
+        method = 'other'
+    metrics.REQUEST_LATENCY.observe(elapsed, endpoint=endpoint, method=method)
+    slow = settings.SLOW_REQUEST_SECONDS
+    if slow and elapsed >= slow:
+        if calls:
+            log.warning('slow request %s %s: %.3fs, fs calls: %s',
+                        request.method, request.path, elapsed,
+                        _fs_summary(calls))
+        else:
+            log.warning('slow request %s %s: %.3fs',
+                        request.method, request.path, elapsed)
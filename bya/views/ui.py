@@ -1,4 +1,8 @@
+import codecs
+import hashlib
 import os
+import re
+import tempfile
 
 from flask import (
     abort,
@@ -7,18 +11,21 @@ from flask import (
     render_template,
     request,
     Response,
+    session,
 )
 from flask_login import current_user
 
-from bya import settings
+from bya import search, settings
 from bya.models import (
     jobs,
     Host,
     ModelError,
+    Run,
     RunQueue,
 )
 from bya.version import VERSION
 from bya.views import app
+from bya.views.files import IMMUTABLE, is_fresh, serve_file
 CSS_ACTIVE = 'pure-menu-selected'
 
 
@@ -49,18 +56,29 @@ def hosts():
 
 @app.route('/queues/')
 def queues():
-    running = {}
-    queued = {}
-    for run in RunQueue.list_running():
-        b = run.get_build()
-        run.jobname = b.name.replace('#', '/')
-        run.buildnum = b.number
-        running.setdefault(b, []).append(run)
-    for run in RunQueue.list_queued():
-        b = run.get_build()
-        queued.setdefault(b, []).append(run)
+    snapshot = RunQueue.snapshot()
     return render_template('queues.html', queues_css_active=CSS_ACTIVE,
-                           running=running, queued=queued)
+                           running=snapshot['running'],
+                           queued=snapshot['queued'])
+
+
+@app.route('/search/')
+def search_logs_ui():
+    q = request.args.get('q', '')
+    results = []
+    error = None
+    if q:
+        try:
+            results = search.get_index().search(
+                q, request.args.get('job') or None,
+                request.args.get('since'), request.args.get('until'))
+        except ModelError as e:
+            error = str(e)
+    for r in results:
+        r['jobgroup'], r['name'] = os.path.split(r['job'])
+        r['jobgroup'] = r['jobgroup'] or None
+    return render_template('search.html', search_css_active=CSS_ACTIVE,
+                           args=request.args, results=results, error=error)
 
 
 @app.route('/<name>.job')
@@ -85,6 +103,29 @@ def job_def(name, jobgroup=None):
         'job.html', start=nstart, jobgroup=jobgroup, job=job, builds=builds)
 
 
+def _cached_page(build, key, render):
+    '''Return the HTML of a completed build's page from the copy saved in
+       the build, rendering and saving it if it's missing or stale'''
+    path = os.path.join(build.build_dir, 'page.html')
+    try:
+        with open(path, 'rb') as f:
+            if f.readline().decode().strip() == key:
+                return f.read()
+            old = os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        old = 0
+    page = render().encode()
+    fd, tmp = tempfile.mkstemp(dir=build.build_dir, prefix='.page-')
+    with os.fdopen(fd, 'wb') as f:
+        os.fchmod(fd, 0o644)
+        f.write(key.encode() + b'\n')
+        f.write(page)
+        new = f.tell()
+    os.rename(tmp, path)
+    build.add_disk_usage(new - old)
+    return page
+
+
 @app.route('/<name>.job/builds/<int:build_num>/', methods=['GET', 'POST'])
 @app.route('/<path:jobgroup>/<name>.job/builds/<int:build_num>/',
            methods=['GET', 'POST'])
@@ -99,24 +140,122 @@ def build(name, build_num, jobgroup=None):
     if request.method == 'POST':
         if not can_rebuild:
             abort(401)
-        job.rebuild(build, current_user.id)
+        action = request.form.get('action')
+        if action == 'cancel':
+            cancelled = build.cancel(current_user.id)
+            flash('Cancelled: %s' % ', '.join(cancelled))
+            return redirect(request.path)
+        job.rebuild(build, current_user.id, action == 'rebuild-failed')
         flash('Queued: %s' % build.name)
         return redirect('queues')
 
-    return render_template('build.html', jobname=name, jobgroup=jobgroup,
-                           build=build, trigger_data=build.trigger_data,
-                           can_rebuild=can_rebuild)
+    def render():
+        return render_template(
+            'build.html', jobname=name, jobgroup=jobgroup, build=build,
+            trigger_data=build.trigger_data, can_rebuild=can_rebuild)
+
+    etag = build.etag
+    if not etag or '_flashes' in session:
+        return render()
+    # the page of a completed build only changes with the user and version
+    user = current_user.id if current_user.is_authenticated else ''
+    etag = hashlib.sha1(
+        ('%s\0%s\0%s' % (etag, VERSION, user)).encode()).hexdigest()
+    if is_fresh(etag):
+        resp = Response(status=304)
+    elif user or not settings.BUILD_PAGE_CACHE:
+        resp = Response(render(), mimetype='text/html')
+    else:
+        resp = Response(_cached_page(build, etag, render),
+                        mimetype='text/html')
+    resp.set_etag(etag)
+    # revalidate each time, as a new version of bya changes the page
+    resp.headers['Cache-Control'] = '%s, no-cache' % (
+        'private' if user else 'public')
+    return resp
+
+
+def _read_chunks(f, size=65536):
+    '''Yield the contents of a file and close it. Used for GzipFiles which
+       can't be given to wsgi.file_wrapper as it would sendfile the fd.'''
+    with f:
+        for chunk in iter(lambda: f.read(size), b''):
+            yield chunk
 
 
 @app.route('/<name>.job/builds/<int:build_num>/<run>/')
 @app.route('/<path:jobgroup>/<name>.job/builds/<int:build_num>/<run>/')
 def run(name, build_num, run, jobgroup=None):
     path = name
+    if jobgroup:
+        path = os.path.join(jobgroup, name)
+    build = jobs.find_jobdef(path).get_build(build_num)
+    run = build.get_run(run)
+    # the runner of a cancelled run may still be writing to its log, so only
+    # logs of runs that finished on their own are cached for good
+    growing = run.status not in (Run.PASSED, Run.FAILED)
+    etag = None if growing else build.etag
+    if not run.log_compressed:
+        try:
+            return serve_file(run.log_path(), 'text/plain', growing=growing,
+                              etag=etag)
+        except FileNotFoundError:
+            pass  # compressed since it was checked
+    if 'gzip' in request.accept_encodings:
+        # the client can decompress it, so send the file as is
+        resp = serve_file(run.log_path() + '.gz', 'text/plain', 'gzip',
+                          etag=etag and etag + '-gzip')
+    elif is_fresh(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(_read_chunks(run.log_fd('rb')),
+                        mimetype='text/plain', direct_passthrough=True)
+    if etag and not resp.headers.get('ETag'):
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = IMMUTABLE
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+
+def _sse_log(run, chunks):
+    '''Frame chunks of a log as Server-Sent Events. The id of each event is
+       the offset of the log it ends at so clients can resume from it.'''
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for offset, data in chunks:
+        if not data:
+            yield b': keepalive\n\n'
+            continue
+        lines = re.split('\r\n|\r|\n', decoder.decode(data))
+        event = ''.join('data: %s\n' % x for x in lines)
+        yield ('id: %d\n%s\n' % (offset + len(data), event)).encode()
+    try:
+        status = Run(run.path).status
+    except ModelError:
+        status = Run.UNKNOWN  # the build was deleted
+    yield ('event: end\ndata: %s\n\n' % status).encode()
+
+
+@app.route('/<name>.job/builds/<int:build_num>/<run>/live')
+@app.route('/<path:jobgroup>/<name>.job/builds/<int:build_num>/<run>/live')
+def run_live(name, build_num, run, jobgroup=None):
+    '''Stream the log of a run as it's appended. EventSource clients get
+       Server-Sent Events, anything else gets the raw log.'''
+    path = name
     if jobgroup:
         path = os.path.join(jobgroup, name)
     run = jobs.find_jobdef(path).get_build(build_num).get_run(run)
-    with run.log_fd() as f:
-        return Response(f.read(), mimetype='text/plain')
+    offset = request.headers.get('Last-Event-ID', request.args.get('offset'))
+    offset = offset or '0'
+    if not offset.isdigit():
+        raise ModelError('Invalid offset(%s)' % offset, 400)
+    chunks = run.follow_log(int(offset), settings.LOG_TAIL_KEEPALIVE)
+    if request.accept_mimetypes.best == 'text/event-stream':
+        resp = Response(_sse_log(run, chunks), mimetype='text/event-stream')
+    else:
+        resp = Response((x[1] for x in chunks), mimetype='text/plain')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # don't let nginx buffer it
+    return resp
 
 
 @app.route('/<path:path>/')
@@ -132,5 +271,4 @@ def job_group(path=None):
 
 @app.route('/bya_worker.py')
 def client_py():
-    with open(settings.WORKER_SCRIPT, 'rb') as f:
-        return f.read()
+    return serve_file(settings.WORKER_SCRIPT, 'text/x-python')
@@ -12,6 +12,13 @@ def user_loader(username):
 
 @login_manager.request_loader
 def request_loader(request):
+    auth = request.authorization
+    if auth:
+        # HTTP basic auth for API clients
+        u = User.get(auth.username)
+        if u is not None:
+            u.authenticate(auth.password)
+        return u
     u = User.get(request.form.get('user'))
     if u is None:
         return
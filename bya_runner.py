@@ -21,6 +21,10 @@ log = logging.getLogger('bya-runner')
 RUNNER_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
+class Cancelled(Exception):
+    '''Raised when the server asks for the run to be stopped'''
+
+
 def _get_params():
     '''A simple way to make this script easier to mock and test'''
     return os.environ
@@ -60,8 +64,18 @@ def _stream_output(args, data):
     return _update_run(args, data, retry=2)
 
 
-def _cmd_output(cmd):
-    '''Simple non-blocking way to stream the output of a command'''
+def _cancelled(resp):
+    '''True if the response to an update says the run was cancelled'''
+    try:
+        return bool(resp.json().get('cancel'))
+    except (AttributeError, ValueError):
+        return False
+
+
+def _cmd_output(cmd, idle=20):
+    '''Simple non-blocking way to stream the output of a command. An empty
+       buffer is yielded if there's no output for "idle" seconds. Closing
+       the generator terminates the command.'''
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     fds = [p.stdout, p.stderr]
 
@@ -69,13 +83,22 @@ def _cmd_output(cmd):
         fl = fcntl.fcntl(fd, fcntl.F_GETFL)
         fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
-    while len(fds) > 0:
-        for fd in select.select(fds, [], [])[0]:
-            buff = fd.read(1024)
-            if buff == b'':
-                fds.remove(fd)
-                break
-            yield buff
+    try:
+        while len(fds) > 0:
+            ready = select.select(fds, [], [], idle)[0]
+            if not ready:
+                yield b''
+            for fd in ready:
+                buff = fd.read(1024)
+                if buff == b'':
+                    fds.remove(fd)
+                    break
+                yield buff
+    except GeneratorExit:
+        # "timeout" passes this on to docker which stops the container
+        p.terminate()
+        p.wait()
+        raise
     p.wait()
     if p.returncode != 0:
         raise Exception('Error running command: rc=%d' % p.returncode)
@@ -86,15 +109,20 @@ def _run_cmd(args, *cmd):
     with open('console.log', 'wb') as f:
         last_update = 0
         last_buff = b''
-        for buff in _cmd_output(cmd):
+        output = _cmd_output(cmd)
+        for buff in output:
             f.write(buff)
             now = time.time()
             # stream data every 20s or if we have a 1M of data
             if now - last_update > 20 or len(buff) > 1048576:
-                if not _stream_output(args, last_buff + buff):
+                resp = _stream_output(args, last_buff + buff)
+                if not resp:
                     last_buff += buff
                 else:
                     last_buff = b''
+                    if _cancelled(resp):
+                        output.close()
+                        raise Cancelled()
             else:
                 last_buff += buff
         if last_buff:
@@ -120,6 +148,8 @@ def main(args):
             ['-v', '%s:/bya' % os.getcwd(), args.container, '/bya/executable'])
         _run_cmd(args, *cmd)
         _update_status(args, 'PASSED', 'bya_runner completed')
+    except Cancelled:
+        _update_status(args, 'CANCELLED', 'bya_runner was cancelled')
     except:
         stack = traceback.format_exc()
         log.error(stack)
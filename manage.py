@@ -2,9 +2,11 @@
 import argparse
 import sys
 
-from bya.clean import clean_builds
+from bya.clean import TrashReaper, clean_builds, compress_logs, index_logs
 from bya.daemon import SmartDaemonRunner
+from bya import settings
 from bya.models import ModelError, jobs
+from bya.storage import SqliteStorage, migrate
 from bya.views import app
 
 
@@ -25,6 +27,7 @@ def _gunicorn(args):
     cmd = [
         'gunicorn',
         '-w', str(args.workers),
+        '--threads', str(args.threads),
         '-b', '%s:%d' % (args.host, args.port),
         'bya.views:app',
     ]
@@ -65,6 +68,37 @@ def _triggers(args):
 
 def _clean_builds(args):
     clean_builds()
+    if not args.no_reap:
+        TrashReaper(args.rate, args.workers).run()
+
+
+def _disk_usage(args):
+    for job in jobs:
+        if args.recalculate:
+            for b in job.list_builds():
+                b.recalculate_disk_usage()
+        print('%12d %s' % (job.get_disk_usage(), job._get_builds_dir()))
+
+
+def _migrate_storage(args):
+    dst = SqliteStorage(args.db or settings.STORAGE_SQLITE_DB)
+    count = migrate(settings.HOSTS_DIR, dst, 'Host')
+    print('Migrated %d hosts' % count)
+    count = migrate(settings.BUILDS_DIR, dst, 'Run')
+    print('Migrated %d runs' % count)
+    print('Set STORAGE_ENGINE = "sqlite" to start using: %s' % dst.db)
+
+
+def _compress_logs(args):
+    print('Saved %d bytes' % compress_logs())
+
+
+def _index_logs(args):
+    print('Indexed %d logs' % index_logs())
+
+
+def _reap_trash(args):
+    TrashReaper(args.rate, args.workers).run()
 
 
 def main():
@@ -87,6 +121,8 @@ def main():
     p.add_argument('--host', default='0.0.0.0')
     p.add_argument('-p', '--port', type=int, default=8000)
     p.add_argument('-w', '--workers', type=int, default=1)
+    p.add_argument('-t', '--threads', type=int, default=1,
+                   help='Threads per worker. Each live log viewer holds one')
     p.add_argument('action', choices=('start', 'stop', 'restart', 'status'))
     p.set_defaults(func=_gunicorn)
 
@@ -97,8 +133,39 @@ def main():
     p.set_defaults(func=_triggers)
 
     p = sub.add_parser('clean-builds', help='Clean up old builds')
+    p.add_argument('--no-reap', action='store_true',
+                   help='Only move old builds to the trash')
+    p.add_argument('--rate', type=int,
+                   help='Max file deletions per second. 0 means unlimited')
+    p.add_argument('-w', '--workers', type=int,
+                   help='Number of jobs to reap in parallel')
     p.set_defaults(func=_clean_builds)
 
+    p = sub.add_parser('disk-usage', help='Show disk usage of each job')
+    p.add_argument('--recalculate', action='store_true',
+                   help='Walk each build to reset its disk usage counter')
+    p.set_defaults(func=_disk_usage)
+
+    p = sub.add_parser('migrate-storage',
+                       help='Copy hosts and runs into the sqlite storage')
+    p.add_argument('--db', help='default=settings.STORAGE_SQLITE_DB')
+    p.set_defaults(func=_migrate_storage)
+
+    p = sub.add_parser('reap-trash', help='Remove builds moved to the trash')
+    p.add_argument('--rate', type=int,
+                   help='Max file deletions per second. 0 means unlimited')
+    p.add_argument('-w', '--workers', type=int,
+                   help='Number of jobs to reap in parallel')
+    p.set_defaults(func=_reap_trash)
+
+    p = sub.add_parser('compress-logs',
+                       help='Compress the logs of completed runs')
+    p.set_defaults(func=_compress_logs)
+
+    p = sub.add_parser('index-logs',
+                       help='Add the logs of completed runs to the search')
+    p.set_defaults(func=_index_logs)
+
     args = parser.parse_args()
     if getattr(args, 'func', None):
         args.func(args)
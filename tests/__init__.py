@@ -5,7 +5,7 @@ import unittest
 
 import yaml
 
-from bya import settings
+from bya import metrics, settings
 from bya.models import Host, JobDefinition
 
 
@@ -21,7 +21,7 @@ class ModelTest(TempDirTest):
         super(ModelTest, self).setUp()
         self.mocked_dirs = (
             'JOBS_DIR', 'BUILDS_DIR', 'QUEUE_DIR', 'RUNNING_DIR', 'HOSTS_DIR',
-            'TRIGGERS_DIR')
+            'TRIGGERS_DIR', 'TRASH_DIR', 'IN_FLIGHT_DIR')
 
         for attr in self.mocked_dirs:
             setattr(self, attr, getattr(settings, attr))
@@ -29,6 +29,12 @@ class ModelTest(TempDirTest):
             os.mkdir(getattr(settings, attr))
 
         settings.SECRETS_FILE = os.path.join(self.tempdir, 'secrets.yml')
+        settings.STORAGE_SQLITE_DB = os.path.join(self.tempdir, 'bya.db')
+        settings.METRICS_FILE = os.path.join(self.tempdir, 'metrics')
+        settings.HEARTBEAT_FILE = os.path.join(self.tempdir, 'heartbeats')
+        settings.LOG_SEARCH_DB = os.path.join(self.tempdir, 'search.db')
+        settings.PROPS_JOURNAL_DIR = os.path.join(self.tempdir, 'journal')
+        metrics.get_stats()
         Host.PROPS_DIR = settings.HOSTS_DIR
 
         self.jobdef = {
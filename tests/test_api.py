@@ -1,9 +1,17 @@
+import base64
+import gzip
 import json
+import os
+
+from unittest.mock import Mock, patch
 
 from tests import ModelTest
 
+from bya import settings
+from bya.clean import index_logs
 from bya.views import app
-from bya.models import Host, JobGroup, Run
+from bya.models import Host, JobGroup, Run, RunQueue
+from bya.user import User
 
 h1 = {
     'name': 'host_1',
@@ -97,9 +105,21 @@ class ApiTests(ModelTest):
         self.post_json(url, data, status_code=200, headers=headers)
         run = list(build.list_runs())[0]
         self.assertEqual(Run.PASSED, run.status)
+        self.assertTrue(run.log_compressed)
         with run.log_fd() as f:
             self.assertIn(data, f.read())
 
+        url = '/name.job/builds/%d/foo/' % build.number
+        # gunicorn's file_wrapper would sendfile the compressed data
+        wrapper = Mock(side_effect=AssertionError('GzipFile was wrapped'))
+        resp = self.app.get(
+            url, environ_overrides={'wsgi.file_wrapper': wrapper})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(data.encode(), resp.data)
+        resp = self.app.get(url, headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertIn(data.encode(), gzip.decompress(resp.data))
+
     def test_run_update_no_status(self):
         self._write_job('name', self.jobdef)
         jobs = JobGroup()
@@ -171,3 +191,363 @@ class ApiTests(ModelTest):
         data = 'logmessage1'
         url = '/api/v1/build/%s/%d/%s/' % (build.name, build.number, run.name)
         self.post_json(url, data, status_code=401, headers=headers)
+
+    def test_queues(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().get_jobdefs()[0]
+        job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                          {'name': 'bar', 'container': 'ubuntu'}])
+        data = self.get_json('/api/v1/queues/')
+        self.assertEqual([], data['running'])
+        self.assertEqual(1, len(data['queued']))
+        self.assertEqual('name', data['queued'][0]['job'])
+        self.assertEqual(1, data['queued'][0]['build'])
+        runs = [x['name'] for x in data['queued'][0]['runs']]
+        self.assertEqual(['foo', 'bar'], runs)
+
+        RunQueue.take('host1', ['*'])
+        data = self.get_json('/api/v1/queues/')
+        runs = [x['name'] for x in data['running'][0]['runs']]
+        self.assertEqual(['foo'], runs)
+        runs = [x['name'] for x in data['queued'][0]['runs']]
+        self.assertEqual(['bar'], runs)
+
+        resp = self.app.get('/queues/')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(b'name #1', resp.data)
+
+    def test_metrics(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().get_jobdefs()[0]
+        job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                          {'name': 'bar', 'container': 'ubuntu'}])
+        RunQueue.take('host1', ['*'])
+
+        resp = self.app.get('/metrics')
+        self.assertEqual(200, resp.status_code)
+        lines = resp.data.decode().splitlines()
+        self.assertIn('# TYPE bya_queue_depth gauge', lines)
+        self.assertIn('bya_runs_queued_total{host_tag="*"} 2', lines)
+        self.assertIn('bya_queue_depth{host_tag="*"} 1', lines)
+        self.assertIn('bya_runs_in_flight{host_tag="*"} 1', lines)
+        self.assertIn('bya_run_queue_wait_seconds_count 1', lines)
+
+    def test_search(self):
+        self._write_job('grp/name', self.jobdef)
+        job = JobGroup().find_jobdef('grp/name')
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                                  {'name': 'bar', 'container': 'ubuntu'}])
+        for run in build.list_runs():
+            run.append_log('building %s\nError: Widget Missing\n' % run.name)
+            if run.name == 'foo':
+                run.update(status=Run.FAILED)
+        self.assertEqual(0, len(
+            self.get_json('/api/v1/search/?q=widget+missing')['results']))
+        with patch('bya.clean.jobs', JobGroup()):  # it caches the listing
+            self.assertEqual(1, index_logs())
+            self.assertEqual(0, index_logs())
+
+        data = self.get_json('/api/v1/search/?q=widget+missing')
+        self.assertEqual(1, len(data['results']))
+        result = data['results'][0]
+        self.assertEqual('grp/name', result['job'])
+        self.assertEqual(build.number, result['build'])
+        self.assertEqual('foo', result['run'])
+        self.assertEqual(['Error: Widget Missing\n'], result['lines'])
+
+        data = self.get_json('/api/v1/search/?q=building+foo&job=grp/name')
+        self.assertEqual(1, len(data['results']))
+        data = self.get_json('/api/v1/search/?q=building+bar')
+        self.assertEqual(0, len(data['results']))
+        data = self.get_json('/api/v1/search/?q=widget&job=other')
+        self.assertEqual(0, len(data['results']))
+        data = self.get_json('/api/v1/search/?q=widget&since=2001-01-01')
+        self.assertEqual(1, len(data['results']))
+        data = self.get_json('/api/v1/search/?q=widget&until=2001-01-01')
+        self.assertEqual(0, len(data['results']))
+        self.assertEqual(400, self.app.get('/api/v1/search/?q=wi').status_code)
+        for limit in ('x', '-1', '0'):
+            resp = self.app.get('/api/v1/search/?q=widget&limit=' + limit)
+            self.assertEqual(400, resp.status_code)
+        data = self.get_json('/api/v1/search/?q=widget&limit=1')
+        self.assertEqual(1, len(data['results']))
+
+        resp = self.app.get('/search/?q=widget')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(
+            b'/grp/name.job/builds/%d/foo/' % build.number, resp.data)
+
+        build.delete()
+        data = self.get_json('/api/v1/search/?q=widget')
+        self.assertEqual(0, len(data['results']))
+
+    def test_run_live(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().get_jobdefs()[0]
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'}])
+        run = list(build.list_runs())[0]
+        run.append_log('line 1\nline 2\n')
+        run.update(status=Run.PASSED)
+
+        with run.log_fd('rb') as f:
+            log = f.read()
+        end = len(log)
+
+        url = '/name.job/builds/%d/foo/live' % build.number
+        resp = self.app.get(url, headers=[('Accept', 'text/event-stream')])
+        self.assertEqual('text/event-stream', resp.mimetype)
+        data = resp.data.decode()
+        self.assertIn('data: line 1\ndata: line 2\ndata: \n\n', data)
+        self.assertTrue(data.endswith('event: end\ndata: PASSED\n\n'))
+        self.assertNotIn('keepalive', data)
+
+        headers = [('Last-Event-ID', str(end - 7)),
+                   ('Accept', 'text/event-stream')]
+        resp = self.app.get(url, headers=headers)
+        self.assertEqual(
+            'id: %d\ndata: line 2\ndata: \n\nevent: end\ndata: PASSED\n\n'
+            % end, resp.data.decode())
+
+        resp = self.app.get(url)
+        self.assertEqual(log, resp.data)
+
+        self.assertEqual(400, self.app.get(url + '?offset=-1').status_code)
+        resp = self.app.get(url, headers=[('Last-Event-ID', 'x')])
+        self.assertEqual(400, resp.status_code)
+
+    def test_serve_file(self):
+        resp = self.app.get('/bya_worker.py')
+        self.assertEqual(200, resp.status_code)
+        with open(settings.WORKER_SCRIPT, 'rb') as f:
+            self.assertEqual(f.read(), resp.data)
+        self.assertEqual(len(resp.data), resp.content_length)
+
+        headers = [('If-Modified-Since', resp.headers['Last-Modified'])]
+        resp = self.app.get('/bya_worker.py', headers=headers)
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b'', resp.data)
+
+        path = os.path.realpath(settings.WORKER_SCRIPT)
+        with patch.object(settings, 'FILE_SERVER', 'x-sendfile'):
+            resp = self.app.get('/bya_worker.py')
+        self.assertEqual(path, resp.headers['X-Sendfile'])
+        self.assertEqual(b'', resp.data)
+
+        locations = {os.path.dirname(path): '/internal/'}
+        with patch.multiple(settings, FILE_SERVER='x-accel-redirect',
+                            X_ACCEL_LOCATIONS=locations):
+            resp = self.app.get('/bya_worker.py')
+        self.assertEqual('/internal/bya_worker.py',
+                         resp.headers['X-Accel-Redirect'])
+
+    def test_completed_build_caching(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().get_jobdefs()[0]
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'}])
+        run = list(build.list_runs())[0]
+        run.append_log('logmessage1\n')
+
+        url = '/name.job/builds/%d/' % build.number
+        resp = self.app.get(url)
+        self.assertNotIn('ETag', resp.headers)
+        resp = self.app.get(url + 'foo/')
+        self.assertNotIn('ETag', resp.headers)
+
+        run.update(status=Run.PASSED)
+        resp = self.app.get(url)
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(b'Completed', resp.data)
+        self.assertEqual('public, no-cache', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        page = os.path.join(build.build_dir, 'page.html')
+        self.assertTrue(os.path.exists(page))
+
+        resp = self.app.get(url, headers=[('If-None-Match', etag)])
+        self.assertEqual(304, resp.status_code)
+
+        # the saved copy of the page is what gets served
+        with open(page, 'rb') as f:
+            key = f.readline()
+        with open(page, 'wb') as f:
+            f.write(key + b'cached page')
+        self.assertEqual(b'cached page', self.app.get(url).data)
+
+        resp = self.app.get(url + 'foo/')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        resp = self.app.get(url + 'foo/', headers=[('If-None-Match', etag)])
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b'', resp.data)
+
+        headers = [('If-None-Match', etag), ('Accept-Encoding', 'gzip')]
+        resp = self.app.get(url + 'foo/', headers=headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(etag, resp.headers['ETag'])
+
+    def _user_headers(self):
+        self.addCleanup(patch.stopall)
+        patch.object(User, 'authenticate', return_value=True).start()
+        auth = base64.b64encode(b'root:password').decode()
+        return [('Authorization', 'Basic ' + auth)]
+
+    def test_build_create(self):
+        self._write_job('grp/name', self.jobdef)
+        url = '/api/v1/jobs/grp/name/builds'
+        runs = {'runs': [{'name': 'foo', 'container': 'ubuntu'},
+                         {'name': 'bar', 'container': 'busybox'}]}
+        self.post_json(url, runs, 401)
+
+        headers = self._user_headers()
+        resp = self.post_json(url, runs, headers=headers)
+        data = json.loads(resp.data.decode())
+        self.assertEqual(1, data['build'])
+        self.assertEqual(['foo', 'bar'], data['runs'])
+        self.assertEqual('http://localhost/grp/name.job/builds/1/',
+                         resp.location)
+        queued = [x.name for x in RunQueue.list_queued()]
+        self.assertEqual(['bar', 'foo'], sorted(queued))
+
+        # duplicate run names
+        runs['runs'][1]['name'] = 'foo'
+        self.post_json(url, runs, 400, headers)
+
+        # names that aren't safe to use as a directory
+        for name in ('../../../escaped', '..', '.', 'a/b', ''):
+            bad = {'runs': [{'name': name, 'container': 'ubuntu'}]}
+            self.post_json(url, bad, 400, headers)
+        self.assertFalse(os.path.exists(
+            os.path.join(settings.BUILDS_DIR, '..', 'escaped')))
+        self.post_json(url, {'runs': ['foo']}, 400, headers)
+        self.post_json(url, {'runs': {'name': 'foo'}}, 400, headers)
+        matrix = {'params': {}, 'name': '..'}
+        self.post_json(url, {'matrix': matrix}, 400, headers)
+        self.post_json('/api/v1/jobs/grp/nope/builds', runs, 404, headers)
+
+    def test_build_create_priority(self):
+        self.jobdef['priority'] = 'low'
+        self._write_job('name', self.jobdef)
+        url = '/api/v1/jobs/name/builds'
+        headers = self._user_headers()
+        self.post_json(url, {'runs': [{'name': 'low', 'container': 'ubuntu'}]},
+                       headers=headers)
+        runs = {'runs': [{'name': 'high', 'container': 'ubuntu'}],
+                'priority': 'high'}
+        self.post_json(url, runs, headers=headers)
+        runs['priority'] = 'urgent'
+        self.post_json(url, runs, 400, headers)
+
+        self.assertEqual('high', RunQueue.take('host1', ['*']).name)
+        self.assertEqual('low', RunQueue.take('host1', ['*']).name)
+
+    def test_build_create_matrix(self):
+        self.jobdef['params'] = [{'name': 'branch'}, {'name': 'arch'}]
+        self._write_job('name', self.jobdef)
+        url = '/api/v1/jobs/name/builds'
+        headers = self._user_headers()
+        matrix = {
+            'params': {'branch': ['master', 'v2'], 'arch': ['arm']},
+        }
+        resp = self.post_json(url, {'matrix': matrix}, headers=headers)
+        data = json.loads(resp.data.decode())
+        expected = ['ubuntu-arm-master', 'ubuntu-arm-v2',
+                    'busybox-arm-master', 'busybox-arm-v2']
+        self.assertEqual(expected, data['runs'])
+
+        build = JobGroup().find_jobdef('name').get_build(data['build'])
+        run = build.get_run('busybox-arm-v2')
+        self.assertEqual({'branch': 'v2', 'arch': 'arm'}, run.params)
+        self.assertEqual('busybox', run.container)
+        # all the runs were queued in order
+        queued = RunQueue.snapshot()['queued'][0]['runs']
+        self.assertEqual(expected, [x['name'] for x in queued])
+
+        matrix['containers'] = ['ubuntu']
+        matrix['name'] = '{branch}/{container}'
+        resp = self.post_json(url, {'matrix': matrix}, headers=headers)
+        data = json.loads(resp.data.decode())
+        self.assertEqual(['master_ubuntu', 'v2_ubuntu'], data['runs'])
+
+        matrix['name'] = '{missing}'
+        self.post_json(url, {'matrix': matrix}, 400, headers)
+        matrix['containers'] = ['nope']
+        del matrix['name']
+        self.post_json(url, {'matrix': matrix}, 400, headers)
+        with patch.object(settings, 'MAX_MATRIX_RUNS', 1):
+            self.post_json(url, {'matrix': {}}, 400, headers)
+
+    def test_build_rebuild_failed(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().find_jobdef('name')
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                                  {'name': 'bar', 'container': 'ubuntu'}])
+        RunQueue.take('host1', ['*']).update(status=Run.PASSED)
+        RunQueue.take('host1', ['*']).update(status=Run.FAILED)
+
+        url = '/api/v1/jobs/name/builds/%d/rebuild' % build.number
+        self.post_json(url, {'failed_only': True}, 401)
+        headers = self._user_headers()
+        resp = self.post_json(url, {'failed_only': True}, headers=headers)
+        data = json.loads(resp.data.decode())
+        self.assertEqual(['bar', 'foo'], sorted(data['runs']))
+        self.assertEqual(['bar'], [x.name for x in RunQueue.list_queued()])
+
+        resp = self.app.get('/name.job/builds/%d/' % build.number,
+                            headers=headers)
+        self.assertIn(b'rebuild-failed', resp.data)
+
+    def test_build_cancel(self):
+        self._write_job('name', self.jobdef)
+        job = JobGroup().find_jobdef('name')
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                                  {'name': 'bar', 'container': 'ubuntu'}])
+        run = RunQueue.take('host1', ['*'])
+
+        url = '/api/v1/jobs/name/builds/%d/cancel' % build.number
+        self.post_json(url, {}, 401)
+        headers = self._user_headers()
+        resp = self.post_json(url, {}, 200, headers=headers)
+        data = json.loads(resp.data.decode())
+        self.assertEqual(['bar', 'foo'], sorted(data['cancelled']))
+        self.assertEqual([], list(RunQueue.list_queued()))
+        self.assertEqual('Cancelled', build.status)
+
+        # the runner finds out with its next update
+        headers = [
+            ('Authorization', 'Token ' + run.api_key),
+            ('X-BYA-STATUS', Run.RUNNING),
+        ]
+        url = '/api/v1/build/%s/%d/%s/' % (build.name, build.number, run.name)
+        resp = self.post_json(url, 'more', status_code=200, headers=headers)
+        self.assertEqual({'cancel': True}, json.loads(resp.data.decode()))
+        self.assertEqual(Run.CANCELLED, build.get_run(run.name).status)
+        with run.log_fd() as f:
+            self.assertNotIn('more', f.read())
+
+        # the build is complete, but the logs of cancelled runs aren't final
+        self.assertIsNotNone(build.etag)
+        resp = self.app.get('/name.job/builds/%d/%s/' % (
+            build.number, run.name))
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertNotIn('immutable', resp.headers.get('Cache-Control', ''))
+
+    def test_fail_fast(self):
+        self.jobdef['fail_fast'] = True
+        self._write_job('name', self.jobdef)
+        job = JobGroup().find_jobdef('name')
+        build = job.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                                  {'name': 'bar', 'container': 'ubuntu'}])
+        foo = RunQueue.take('host1', ['*'])
+        bar = RunQueue.take('host1', ['*'])
+        bar.update(status=Run.RUNNING)
+        bar.append_log('bar running\n')
+        foo.update(status=Run.FAILED)
+        self.assertEqual(Run.CANCELLED, build.get_run('bar').status)
+
+        url = '/name.job/builds/%d/bar/' % build.number
+        resp = self.app.get(url)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn(b'bar running', resp.data)
+        self.assertNotIn('immutable', resp.headers.get('Cache-Control', ''))
+        resp = self.app.get('/name.job/builds/%d/foo/' % build.number)
+        self.assertEqual(build.etag, resp.headers['ETag'].strip('"'))
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import time
+
+from unittest.mock import PropertyMock, patch
+
+from tests import ModelTest
+
+from bya import settings
+from bya.clean import (
+    RateLimiter, TrashReaper, clean_builds, compress_logs, index_logs,
+    purge_high_water
+)
+from bya.models import JobGroup, Run, jobs
+from bya.search import LogIndex
+
+
+class CleanBuildsTest(ModelTest):
+    def setUp(self):
+        super(CleanBuildsTest, self).setUp()
+        self.jobdef['retention'] = {'unit': 'builds', 'value': 1}
+        self._write_job('jobname', self.jobdef)
+        self.job = jobs.find_jobdef('jobname')
+        for x in range(4):
+            b = self.job.create_build([{'name': 'foo', 'container': 'ubuntu'}])
+            with open(os.path.join(b.build_dir, 'status'), 'w') as f:
+                f.write('Completed')
+
+    def test_clean(self):
+        clean_builds()
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+        trash = os.path.join(settings.TRASH_DIR, 'jobname')
+        self.assertEqual(2, len(os.listdir(trash)))
+
+        TrashReaper(rate=0).run()
+        self.assertEqual([], os.listdir(settings.TRASH_DIR))
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+
+    def test_clean_skips_kept(self):
+        """Only the builds past the newest ones kept are looked at"""
+        with patch('bya.models.Build.completion_time',
+                   new_callable=PropertyMock, return_value=1) as completed:
+            clean_builds()
+        self.assertEqual(2, completed.call_count)
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+
+    def test_clean_days(self):
+        self.jobdef['retention'] = {'unit': 'days', 'value': 5}
+        self._write_job('jobname', self.jobdef)
+        now = time.time()
+        for num, days in ((1, 10), (2, 8), (3, 1)):
+            status = os.path.join(self.job.get_build(num).build_dir, 'status')
+            os.utime(status, (now - days * 86400, now - days * 86400))
+        clean_builds()
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+
+    def test_delete_reaped_trash(self):
+        """The reaper removing the job's trash dir doesn't fail a delete"""
+        mkdtemp = tempfile.mkdtemp
+        trash = os.path.join(settings.TRASH_DIR, 'jobname')
+
+        def reaped(**kwargs):
+            if mkdtemp_mock.call_count == 1:
+                os.rmdir(trash)
+            return mkdtemp(**kwargs)
+
+        with patch('bya.models.tempfile.mkdtemp',
+                   side_effect=reaped) as mkdtemp_mock:
+            self.job.get_build(1).delete()
+        self.assertEqual(2, mkdtemp_mock.call_count)
+        self.assertEqual([4, 3, 2], [x.number for x in self.job.list_builds()])
+        self.assertEqual(1, len(os.listdir(trash)))
+
+    def test_clean_bytes(self):
+        b = self.job.get_build(3)
+        self.jobdef['retention'] = {'unit': 'bytes', 'value': b.disk_usage}
+        self._write_job('jobname', self.jobdef)
+        clean_builds()
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+
+    def test_high_water(self):
+        usage = self.job.get_disk_usage()
+        b = self.job.get_build(4)
+        settings.DISK_HIGH_WATER_MARK = usage - 1
+        settings.DISK_LOW_WATER_MARK = b.disk_usage * 2
+        self.addCleanup(setattr, settings, 'DISK_HIGH_WATER_MARK', 0)
+        self.addCleanup(setattr, settings, 'DISK_LOW_WATER_MARK', 0)
+        purge_high_water()
+        self.assertEqual([4, 3], [x.number for x in self.job.list_builds()])
+        self.assertGreaterEqual(b.disk_usage * 2, self.job.get_disk_usage())
+
+    def test_reap_resume(self):
+        """Ensure a partially deleted trash entry is finished off"""
+        clean_builds()
+        trash = os.path.join(settings.TRASH_DIR, 'jobname')
+        entry = os.path.join(trash, os.listdir(trash)[0])
+        os.unlink(os.path.join(entry, 'build/summary.log'))
+
+        TrashReaper(rate=0).run()
+        self.assertFalse(os.path.exists(trash))
+
+    @patch('bya.clean.time.sleep')
+    def test_rate_limit(self, sleep):
+        limiter = RateLimiter(10)
+        limiter.wait(10)
+        limiter.wait(10)
+        self.assertTrue(sleep.called)
+        self.assertGreater(sleep.call_args[0][0], 0.5)
+
+    @patch('bya.models.Build._notify')
+    def test_compress_logs(self, notify):
+        settings.LOG_COMPRESS = 'sweep'
+        self.addCleanup(setattr, settings, 'LOG_COMPRESS', 'complete')
+        run = list(self.job.get_build(4).list_runs())[0]
+        run.append_log('compress me\n' * 1000)
+        self.assertEqual(0, compress_logs())  # still queued
+
+        run.update(status='PASSED')
+        self.assertFalse(run.log_compressed)
+        self.assertGreater(compress_logs(), 10000)
+        self.assertTrue(run.log_compressed)
+
+    @patch('bya.models.Build._notify')
+    def test_index_logs(self, notify):
+        for b in self.job.list_builds():
+            for run in b.list_runs():
+                run.append_log('log of %d\n' % b.number)
+                run.update(status=Run.PASSED)
+        b = self.job.create_build([{'name': 'foo', 'container': 'ubuntu'}])
+        indexed = patch.object(LogIndex, 'indexed', autospec=True,
+                               side_effect=LogIndex.indexed)
+        with patch('bya.clean.jobs', JobGroup()):  # it caches the listing
+            self.assertEqual(4, index_logs())
+            # only the build that's still running is looked at again
+            with indexed as m:
+                self.assertEqual(0, index_logs())
+            self.assertEqual([b.number], [x[0][2] for x in m.call_args_list])
+
+            list(b.list_runs())[0].update(status=Run.PASSED)
+            self.assertEqual(1, index_logs())
+            with indexed as m:
+                self.assertEqual(0, index_logs())
+            m.assert_not_called()
+
+            settings.LOG_SEARCH_INDEX = False
+            self.addCleanup(setattr, settings, 'LOG_SEARCH_INDEX', True)
+            with patch('bya.clean.search.get_index') as get_index:
+                self.assertEqual(0, index_logs())
+            get_index.assert_not_called()
@@ -1,8 +1,18 @@
 import json
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 from tests import TempDirTest
-from bya.lazy import ModelError, PropsFile, PropsDir, Property
+from bya import settings
+from bya.lazy import (
+    Counter, FilePool, FileTailers, ModelError, PropsCache, PropsFile,
+    PropsDir, Property, StrChoiceProperty
+)
+from bya.storage import (
+    GroupCommitter, SqliteStorage, VersionError, _get_committer, migrate
+)
 
 
 class FooModel(PropsFile):
@@ -17,6 +27,18 @@ class BarModel(PropsDir):
     PROPS = (Property('required_str', str),)
 
 
+class CachedModel(PropsDir):
+    PROPS = (Property('required_str', str),)
+
+
+class SlotModel(PropsFile):
+    __slots__ = ()
+    PROPS = (
+        StrChoiceProperty('choice', ('A', 'B'), 'A'),
+        Property('optional_list', list, required=False),
+    )
+
+
 class PropsFileTest(TempDirTest):
     def test_simple(self):
         data = {
@@ -60,12 +82,106 @@ class PropsFileTest(TempDirTest):
         self.assertEqual(1, p.required_int)
         self.assertTrue(p.optional_bool)
 
+    def test_compiled(self):
+        SlotModel.validate({'choice': 'B', 'optional_list': []})
+        with self.assertRaisesRegex(ModelError, 'choice\\) must be in'):
+            SlotModel.validate({'choice': 'C'})
+        with self.assertRaisesRegex(ModelError, 'optional_list\\) must be'):
+            SlotModel.validate({'optional_list': 'C'})
+
+        p = SlotModel('pname', 'unused', data={'optional_list': [1]})
+        self.assertEqual('A', p.choice)
+        self.assertEqual([1], p.optional_list)
+        with self.assertRaises(AttributeError):
+            p.not_a_slot = True
+
     def test_does_not_exist(self):
         with self.assertRaisesRegex(ModelError, 'pname does not exist'):
             FooModel('pname', 'path does not exist')
 
 
 class PropsDirTest(TempDirTest):
+    def _create(self, name='obj'):
+        path = os.path.join(self.tempdir, name)
+        os.mkdir(path)
+        with open(os.path.join(path, 'props'), 'w') as f:
+            json.dump({'required_str': 'y'}, f)
+        return BarModel(path)
+
+    def test_update(self):
+        p = self._create()
+        version = p.version
+        p.update(required_str='z')
+        self.assertEqual('z', p.required_str)
+        self.assertEqual(['props'], os.listdir(p.path))
+        self.assertEqual('z', BarModel(p.path).required_str)
+
+        # the update above changed the version
+        with self.assertRaisesRegex(ModelError, 'has been modified'):
+            p.update(version, required_str='a')
+        p.update(p.version, required_str='a')
+        self.assertEqual('a', BarModel(p.path).required_str)
+
+    def test_update_invalid(self):
+        p = self._create()
+        with self.assertRaises(ModelError):
+            p.update(required_str=1)
+        self.assertEqual('y', BarModel(p.path).required_str)
+        self.assertEqual(['props'], os.listdir(p.path))
+
+    def _group_commit(self):
+        settings.PROPS_SYNC = 'group'
+        self.addCleanup(setattr, settings, 'PROPS_SYNC', 'none')
+        journal = settings.PROPS_JOURNAL_DIR
+        self.addCleanup(setattr, settings, 'PROPS_JOURNAL_DIR', journal)
+        settings.PROPS_JOURNAL_DIR = os.path.join(self.tempdir, 'journal')
+
+    @patch('bya.storage.GroupCommitter._commit', autospec=True,
+           side_effect=GroupCommitter._commit)
+    @patch('os.fsync', wraps=os.fsync)
+    @patch('os.sync')
+    def test_group_commit(self, sync, fsync, commit):
+        self._group_commit()
+        _get_committer()
+        fsync.reset_mock()
+        objs = [self._create('obj%d' % x) for x in range(10)]
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(lambda x: x.update(required_str='z'), objs))
+        for x in objs:
+            self.assertEqual('z', BarModel(x.path).required_str)
+        sync.assert_not_called()
+        # one fsync of the journal covers each batch
+        self.assertEqual(commit.call_count, fsync.call_count)
+        journal = _get_committer().journal
+        with open(journal) as f:
+            self.assertEqual(len(objs), len(f.readlines()))
+
+        with patch.object(GroupCommitter, 'CHECKPOINT_SIZE', 1):
+            objs[0].update(required_str='a')
+        self.assertEqual(0, os.path.getsize(journal))
+
+    def test_group_commit_recover(self):
+        """Writes a dead process journaled but lost are replayed"""
+        self._group_commit()
+        lost, kept = self._create('lost'), self._create('kept')
+        kept.update(required_str='new')
+        mtime = os.stat(os.path.join(kept.path, 'props')).st_mtime_ns
+        journal = os.path.join(settings.PROPS_JOURNAL_DIR, 'props-dead')
+        with open(journal, 'w') as f:
+            for obj, val, ts in ((lost, 'a', 1), (lost, 'b', 2),
+                                 (kept, 'old', -1)):
+                path = os.path.join(obj.path, 'props')
+                data = json.dumps({'required_str': val})
+                f.write(json.dumps([path, mtime + ts, data]) + '\n')
+            f.write('["torn')
+
+        # a new process starting up, the running one's journal is left alone
+        GroupCommitter(0, settings.PROPS_JOURNAL_DIR)
+        self.assertTrue(os.path.exists(_get_committer().journal))
+        self.assertEqual('b', BarModel(lost.path).required_str)
+        self.assertEqual('new', BarModel(kept.path).required_str)
+        self.assertFalse(os.path.exists(journal))
+
     def test_simple(self):
         data = {'required_str': 'y'}
         fname = os.path.join(self.tempdir, 'props')
@@ -78,3 +194,240 @@ class PropsDirTest(TempDirTest):
             f.write('testing')
         with p.open_file('blah') as f:
             self.assertEqual('testing', f.read())
+
+
+class PropsCacheTest(TempDirTest):
+    def setUp(self):
+        super(PropsCacheTest, self).setUp()
+        self.cache = PropsCache(CachedModel, 2)
+        self.addCleanup(setattr, CachedModel, '_caches', ())
+        self.paths = []
+        for x in range(3):
+            path = os.path.join(self.tempdir, str(x))
+            CachedModel.create(path, {'required_str': str(x)})
+            self.paths.append(path)
+
+    def test_hit(self):
+        self.assertEqual('0', self.cache.get(self.paths[0]).required_str)
+        with patch('bya.storage.FileStorage.load') as load:
+            p = self.cache.get(self.paths[0])
+            self.assertEqual('0', p.required_str)
+            self.assertFalse(load.called)
+            p._data['required_str'] = 'changed'
+            self.assertEqual('0', self.cache.get(self.paths[0]).required_str)
+
+    def test_changed(self):
+        self.cache.get(self.paths[0])
+        # changes from another process are seen via the version
+        CachedModel(self.paths[0]).update(required_str='z')
+        self.assertEqual('z', self.cache.get(self.paths[0]).required_str)
+
+        with patch.object(self.cache, 'invalidate') as invalidate:
+            self.cache.get(self.paths[0]).update(required_str='y')
+            invalidate.assert_called_with(self.paths[0])
+
+    def test_lru(self):
+        for p in self.paths:
+            self.cache.get(p)
+        self.assertEqual(self.paths[1:], list(self.cache._entries.keys()))
+        self.cache.get(self.paths[1])
+        self.assertEqual([self.paths[2], self.paths[1]],
+                         list(self.cache._entries.keys()))
+
+    def test_delete(self):
+        p = self.cache.get(self.paths[0])
+        p.delete()
+        self.assertEqual([], list(self.cache._entries.keys()))
+        with self.assertRaises(ModelError) as cm:
+            self.cache.get(self.paths[0])
+        self.assertEqual(404, cm.exception.status_code)
+
+
+class FilePoolTest(TempDirTest):
+    def _read(self, name):
+        with open(os.path.join(self.tempdir, name), 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        pool = FilePool(2)
+        path = os.path.join(self.tempdir, 'a')
+        self.assertEqual(3, pool.write(path, b'foo'))
+        self.assertEqual(6, pool.write(path, iter([b'bar', b'bam'])))
+        self.assertEqual(b'foobarbam', self._read('a'))
+        pool.close(path)
+        self.assertEqual({}, pool._files)
+
+    def test_evict(self):
+        pool = FilePool(2)
+        paths = [os.path.join(self.tempdir, x) for x in 'abc']
+        for p in paths:
+            pool.write(p, b'x')
+        self.assertEqual(paths[1:], list(pool._files.keys()))
+
+        # files being written to aren't closed
+        entry = pool._acquire(paths[1])
+        pool.write(paths[0], b'y')
+        self.assertEqual([paths[1], paths[0]], list(pool._files.keys()))
+        pool.close(paths[1])
+        self.assertIn(paths[1], pool._files)
+        pool._release(entry, paths[1])
+        self.assertEqual([paths[0]], list(pool._files.keys()))
+        self.assertEqual(b'xy', self._read('a'))
+
+    def test_stale(self):
+        pool = FilePool(2)
+        path = os.path.join(self.tempdir, 'a')
+        pool.write(path, b'x')
+        # another process compresses it or moves it to the trash
+        os.rename(path, path + '.moved')
+        pool.write(path, b'y')
+        self.assertEqual(b'y', self._read('a'))
+        os.unlink(path)
+        pool.write(path, b'z')
+        self.assertEqual(b'z', self._read('a'))
+        self.assertEqual(1, len(pool._files))
+        self.assertEqual(b'x', self._read('a.moved'))
+
+    @patch('bya.lazy.os.fsync')
+    def test_sync(self, fsync):
+        path = os.path.join(self.tempdir, 'a')
+        pool = FilePool(2, 'close')
+        pool.write(path, b'x')
+        self.assertFalse(fsync.called)
+        pool.close(path)
+        self.assertEqual(1, fsync.call_count)
+
+        pool = FilePool(2, 'always')
+        pool.write(path, b'x')
+        pool.write(path, b'x')
+        self.assertEqual(3, fsync.call_count)
+
+
+class FileTailersTest(TempDirTest):
+    def setUp(self):
+        super(FileTailersTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'log')
+        self.done = False
+        self.tailers = FileTailers(0.01)
+
+    def _write(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.tailers.notify(self.path)
+
+    def _follow(self, offset=0):
+        chunks = self.tailers.follow(self.path, lambda: open(self.path, 'rb'),
+                                     lambda: self.done, offset, 0.05)
+        return b''.join(x[1] for x in chunks)
+
+    def test_follow(self):
+        self._write(b'before\n')
+        with ThreadPoolExecutor(4) as executor:
+            readers = [executor.submit(self._follow) for x in range(3)]
+            readers.append(executor.submit(self._follow, 3))
+            for x in range(20):
+                self._write(b'line %d\n' % x)
+            self.done = True
+        expected = b'before\n' + b''.join(b'line %d\n' % x for x in range(20))
+        self.assertEqual([expected] * 3 + [expected[3:]],
+                         [x.result(5) for x in readers])
+        self.assertEqual({}, self.tailers._tailers)
+
+    def test_follow_missing(self):
+        '''Readers can start following before the file exists'''
+        chunks = self.tailers.follow(self.path, lambda: open(self.path, 'rb'),
+                                     lambda: self.done, 0, 0.05)
+        self.assertEqual((0, b''), next(chunks))
+        self._write(b'foo')
+        self.done = True
+        self.assertEqual(b'foo', b''.join(x[1] for x in chunks))
+        self.assertEqual({}, self.tailers._tailers)
+
+    def test_buffer_overrun(self):
+        '''Readers that fall behind the buffer read the file instead'''
+        self._write(b'')
+        chunks = self.tailers.follow(self.path, lambda: open(self.path, 'rb'),
+                                     lambda: self.done, 0, 0.05)
+        self.assertEqual((0, b''), next(chunks))
+        tailer = self.tailers._tailers[self.path]
+        tailer.chunks = type(tailer.chunks)(maxlen=2)
+        for x in range(5):
+            self._write(b'%d' % x)
+            with tailer.cond:
+                tailer.cond.wait_for(lambda: tailer.offset == x + 1, 5)
+        self.done = True
+        self.assertEqual(b'01234', b''.join(x[1] for x in chunks))
+
+
+class CounterTest(TempDirTest):
+    def test_simple(self):
+        c = Counter(os.path.join(self.tempdir, 'counter'))
+        self.assertEqual(0, c.value)
+        self.assertEqual(12, c.add(12))
+        self.assertEqual(2, c.add(-10))
+        self.assertEqual(2, c.value)
+
+    def test_initial(self):
+        c = Counter(os.path.join(self.tempdir, 'counter'))
+        self.assertEqual(43, c.add(1, lambda: 42))
+        self.assertEqual(44, c.add(1, lambda: 42))
+
+
+class SqliteStorageTest(TempDirTest):
+    def setUp(self):
+        super(SqliteStorageTest, self).setUp()
+        self.storage = SqliteStorage(os.path.join(self.tempdir, 'bya.db'))
+
+    def test_simple(self):
+        path = os.path.join(self.tempdir, 'obj')
+        self.assertFalse(self.storage.exists(path))
+        self.storage.create(path, {'required_str': 'y'}, 'BarModel')
+        self.assertTrue(self.storage.exists(path))
+        with self.assertRaises(FileExistsError):
+            self.storage.create(path, {'required_str': 'y'})
+
+        self.storage.save(path, {'required_str': 'z'})
+        self.assertEqual({'required_str': 'z'}, self.storage.load(path))
+
+        version = self.storage.version(path)
+        self.storage.modify(path, lambda x: {'required_str': 'a'}, version)
+        with self.assertRaises(VersionError):
+            self.storage.modify(path, lambda x: x, version)
+
+        self.storage.delete(path)
+        with self.assertRaises(FileNotFoundError):
+            self.storage.load(path)
+
+    def test_query(self):
+        build = os.path.join(self.tempdir, 'job/1')
+        for name, status in (('a', 'QUEUED'), ('b', 'PASSED')):
+            path = os.path.join(build, 'runs', name)
+            self.storage.create(path, {'status': status}, 'Run')
+        path = os.path.join(self.tempdir, 'job/2/runs/a')
+        self.storage.create(path, {'status': 'QUEUED'}, 'Run')
+
+        found = self.storage.query(None, 'Run', status='QUEUED')
+        self.assertEqual(2, len(list(found)))
+        found = self.storage.query(None, 'Run', build=build)
+        self.assertEqual(['a', 'b'], [os.path.basename(x[0]) for x in found])
+        found = self.storage.list(os.path.join(build, 'runs'))
+        self.assertEqual(2, len(list(found)))
+
+        self.storage.delete_tree(build)
+        found = self.storage.query(None, 'Run')
+        self.assertEqual([path], [x[0] for x in found])
+
+    def test_migrate(self):
+        for name in ('a', 'b'):
+            path = os.path.join(self.tempdir, 'hosts', name)
+            os.makedirs(path)
+            with open(os.path.join(path, 'props'), 'w') as f:
+                json.dump({'required_str': name}, f)
+        root = os.path.join(self.tempdir, 'hosts')
+        self.assertEqual(2, migrate(root, self.storage, 'BarModel'))
+
+        with patch.object(BarModel, 'STORAGE', self.storage):
+            objs = list(BarModel.list(root))
+            self.assertEqual(['a', 'b'], [x.required_str for x in objs])
+            objs = BarModel.query(root, required_str='b')
+            self.assertEqual(['b'], [x.name for x in objs])
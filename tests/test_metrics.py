@@ -0,0 +1,81 @@
+import os
+
+from unittest.mock import patch
+
+from tests import TempDirTest
+
+from bya import metrics
+
+
+class StatsTest(TempDirTest):
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'metrics')
+
+    def test_shared(self):
+        """Ensure separate mappings of the file see each other's updates"""
+        a = metrics.Stats(self.path, 16)
+        b = metrics.Stats(self.path, 16)
+        self.assertTrue(a.created)
+        self.assertFalse(b.created)
+
+        a.add('foo', 2)
+        b.add('foo', 3)
+        b.set('bar{x="1"}', 1.5)
+        self.assertEqual({'foo': 5, 'bar{x="1"}': 1.5}, dict(a.items()))
+
+    def test_full(self):
+        stats = metrics.Stats(self.path, 2)
+        stats.add('a', 1)
+        stats.add('b', 1)
+        with patch('bya.metrics.log') as log:
+            stats.add('c', 1)
+            stats.set('d', 1)
+            stats.add('a', 1)
+        self.assertEqual(1, log.error.call_count)
+        self.assertEqual({'a': 2, 'b': 1}, dict(stats.items()))
+
+    def test_concurrent_add(self):
+        """A key another process adds after the probe missed it isn't
+           given a second slot"""
+        a = metrics.Stats(self.path, 16)
+        b = metrics.Stats(self.path, 16)
+        probe = b._probe
+
+        def add_first(kb):
+            found = probe(kb)
+            if not a._slot_cache:
+                a.add('foo', 1)
+            return found
+
+        with patch.object(b, '_probe', add_first):
+            b.add('foo', 2)
+        self.assertEqual([('foo', 3)], list(a.items()))
+
+    def test_remove(self):
+        """Removed keys leave tombstones that are reused and compacted"""
+        stats = metrics.Stats(self.path, 4)
+        for x in range(20):
+            stats.add('keep', 1)
+            stats.add('tmp%d' % x, 1)
+            self.assertIn(('tmp%d' % x, 1), list(stats.items()))
+            stats.remove('tmp%d' % x)
+        self.assertEqual([('keep', 20)], list(stats.items()))
+
+        b = metrics.Stats(self.path, 4)
+        self.assertEqual(20, dict(b.items())['keep'])
+        b.add('keep', 1)
+        self.assertEqual([('keep', 21)], list(stats.items()))
+
+    def test_old_file(self):
+        """A file without a header is replaced"""
+        with open(self.path, 'wb') as f:
+            f.write(bytes(16 * 128))
+        stats = metrics.Stats(self.path, 16)
+        self.assertTrue(stats.created)
+        self.assertEqual(17 * 128, os.path.getsize(self.path))
+
+    def test_key(self):
+        self.assertEqual('foo', metrics._key('foo', {}))
+        self.assertEqual('foo{a="\\"",b="1"}',
+                         metrics._key('foo', {'b': 1, 'a': '"'}))
@@ -1,7 +1,8 @@
 import os
 import time
 
-from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import call, patch
 
 import yaml
 
@@ -9,12 +10,13 @@ from tests import TempDirTest, ModelTest
 
 from bya import settings
 from bya.models import (
-    Build, Host, JobDefinition, JobGroup, ModelError, Run, RunQueue, jobs
+    Build, Heartbeats, Host, JobDefinition, JobGroup, ModelError, Run,
+    RunQueue, get_heartbeats, jobs
 )
 
 
 class TestRun(ModelTest):
-    def _create(self, name, host_tag='*'):
+    def _create(self, name, host_tag='*', priority=None):
         data = {
             'container': 'container_foo',
             'host_tag': host_tag,
@@ -27,7 +29,7 @@ class TestRun(ModelTest):
         path = os.path.join(path, name)
         Run.create(path, data)
         r = Run(path)
-        RunQueue.push(r, host_tag)
+        RunQueue.push(r, host_tag, priority)
         return r
 
     def test_create(self):
@@ -77,6 +79,108 @@ class TestRun(ModelTest):
         RunQueue.complete(r, Run.PASSED)
         self.assertEqual(2, len(list(RunQueue.list_running())))
 
+    def test_queue_priority(self):
+        self._create('run_low', host_tag='tag', priority='low')
+        self._create('run_normal', host_tag='tag')
+        self._create('run_any', priority='normal')
+        self._create('run_high', host_tag='tag', priority='high')
+        # queued before priorities, treated as normal
+        legacy = self._create('run_legacy', host_tag='tag')
+        os.unlink(os.path.join(settings.QUEUE_DIR, legacy.queue_entry))
+        os.symlink(legacy.path, os.path.join(settings.QUEUE_DIR, 'tag#1.0'))
+        RunQueue._index = None
+
+        queued = RunQueue.snapshot()['queued']
+        self.assertEqual('high', queued[0]['runs'][0]['priority'])
+
+        names = [RunQueue.take('host1', ['tag']).name for _ in range(5)]
+        self.assertEqual(
+            ['run_high', 'run_legacy', 'run_normal', 'run_any', 'run_low'],
+            names)
+        self.assertIsNone(RunQueue.take('host1', ['tag']))
+
+    def test_queue_index(self):
+        """Runs queued and taken by other processes are picked up"""
+        foo = self._create('run_foo', host_tag='tag')
+        self._create('run_bar', host_tag='tag')
+        self.assertIsNone(RunQueue.take('host1', ['nosuchtag']))
+
+        # another process takes run_foo and queues run_bam
+        os.unlink(os.path.join(settings.QUEUE_DIR, foo.queue_entry))
+        path = os.path.join(os.path.dirname(foo.path), 'run_bam')
+        Run.create(path, {'container': 'c', 'host_tag': 'tag2',
+                          'api_key': '1'})
+        bam = Run(path)
+        os.symlink(path, os.path.join(settings.QUEUE_DIR, 'tag2#1#1.0'))
+        with patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertIsNone(RunQueue.take('host1', ['tag2']))
+            RunQueue._log_pushed([(bam, 'tag2#1#1.0')])
+            self.assertEqual('run_bam', RunQueue.take('host1', ['tag2']).name)
+            self.assertEqual('run_bar', RunQueue.take('host1', ['tag']).name)
+        self.assertNotIn(call(settings.QUEUE_DIR), scandir.call_args_list)
+
+    def test_queue_log_rotate(self):
+        with patch.object(RunQueue, 'LOG_MAX', 1):
+            self._create('run_foo', host_tag='tag')
+            self.assertEqual('run_foo', RunQueue.take('host1', ['tag']).name)
+            # pushed to logs that replaced the one the index has open
+            self._create('run_bar', host_tag='tag')
+            self._create('run_bam', host_tag='tag')
+            self.assertEqual('run_bar', RunQueue.take('host1', ['tag']).name)
+        self.assertEqual('run_bam', RunQueue.take('host1', ['tag']).name)
+        self.assertIsNone(RunQueue.take('host1', ['tag']))
+
+    def test_queue_take_threads(self):
+        for x in range(20):
+            self._create('run%d' % x, host_tag='tag')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            runs = list(executor.map(
+                lambda x: RunQueue.take('host1', ['tag']), range(24)))
+        names = [x.name for x in runs if x]
+        self.assertEqual(20, len(names))
+        self.assertEqual(20, len(set(names)))
+
+    def test_queue_limits(self):
+        self.jobdef['max_concurrent_runs'] = 1
+        self._write_job('capped', self.jobdef)
+        jobs.find_jobdef('capped').create_build(
+            [{'name': 'foo', 'container': 'ubuntu'},
+             {'name': 'bar', 'container': 'ubuntu'}])
+        self._create('run_other', host_tag='tag')
+        self._create('run_arm', host_tag='arm')
+
+        r = RunQueue.take('host1', ['tag'])
+        self.assertEqual('foo', r.name)
+        # the capped job's next run is skipped for the newer one
+        self.assertEqual('run_other', RunQueue.take('host1', ['tag']).name)
+        self.assertIsNone(RunQueue.take('host1', ['tag']))
+        r.update(status=Run.PASSED)
+        self.assertEqual('bar', RunQueue.take('host1', ['tag']).name)
+
+        with patch.dict(settings.HOST_TAG_MAX_RUNS, {'arm': 0}):
+            self.assertIsNone(RunQueue.take('host1', ['arm']))
+        self.assertEqual('run_arm', RunQueue.take('host1', ['arm']).name)
+
+    def test_queue_race(self):
+        """Ensure losing the race for the oldest run takes the next one"""
+        self._create('run_foo', host_tag='tag')
+        self._create('run_bar', host_tag='tag')
+
+        rename = os.rename
+        calls = []
+
+        def racy_rename(src, dst):
+            calls.append(src)
+            if len(calls) == 1:
+                os.unlink(src)  # another process got it
+                raise FileNotFoundError(src)
+            return rename(src, dst)
+
+        with patch('bya.models.os.rename', side_effect=racy_rename):
+            r = RunQueue.take('host1', ['tag'])
+        self.assertEqual('run_bar', r.name)
+        self.assertEqual(2, len(calls))
+
     def test_full_run(self):
         jobname = 'jobname_foo'
         self._write_job(jobname, self.jobdef)
@@ -110,18 +214,114 @@ class TestRun(ModelTest):
         d = RunQueue.take('host1', ['tag']).get_rundef()
         self.assertIn(jobname, d['args'])
 
+    def test_rebuild_failed(self):
+        self._write_job('jobname', self.jobdef)
+        j = jobs.find_jobdef('jobname')
+        b = j.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                            {'name': 'bar', 'container': 'ubuntu'}])
+        for run in b.list_runs():
+            RunQueue.take('host1', ['tag'])
+            run.append_log('%s log\n' % run.name)
+        b.get_run('foo').update(status=Run.PASSED)
+        b.get_run('bar').update(status=Run.FAILED)
+        self.assertEqual('Completed with Failure(s)', b.status)
+
+        b2 = j.rebuild(b, failed_only=True)
+        self.assertEqual(['bar'], [x.name for x in RunQueue.list_queued()])
+        foo = b2.get_run('foo')
+        self.assertEqual(Run.PASSED, foo.status)
+        self.assertTrue(foo.log_compressed)
+        self.assertEqual(
+            os.stat(b.get_run('foo').log_path() + '.gz').st_ino,
+            os.stat(foo.log_path() + '.gz').st_ino)
+        with foo.log_fd() as f:
+            self.assertIn('foo log', f.read())
+
+        run = RunQueue.take('host1', ['tag'])
+        self.assertEqual('bar', run.name)
+        run.update(status=Run.PASSED)
+        self.assertEqual('Completed', b2.status)
+        with self.assertRaisesRegex(ModelError, 'no failed runs'):
+            j.rebuild(b2, failed_only=True)
+
+    def test_cancel(self):
+        self._write_job('jobname', self.jobdef)
+        j = jobs.find_jobdef('jobname')
+        b = j.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                            {'name': 'bar', 'container': 'ubuntu'}])
+        running = RunQueue.take('host1', ['tag'])
+        running.update(status=Run.RUNNING)
+        self.assertEqual(['bar'], b.cancel(runs=['bar']))
+        self.assertEqual([], list(RunQueue.list_queued()))
+        self.assertEqual(Run.CANCELLED, b.get_run('bar').status)
+        self.assertEqual(Run.RUNNING, b.status)
+
+        self.assertEqual(['foo'], b.cancel())
+        self.assertEqual([], os.listdir(settings.RUNNING_DIR))
+        self.assertEqual(Run.CANCELLED, b.get_run(running.name).status)
+        self.assertEqual('Cancelled', b.status)
+        self.assertEqual([], b.cancel())
+
+    def test_cancel_completed(self):
+        """A run completing while it's cancelled keeps its status"""
+        self._write_job('jobname', self.jobdef)
+        j = jobs.find_jobdef('jobname')
+        b = j.create_build([{'name': 'foo', 'container': 'ubuntu'}])
+        run = RunQueue.take('host1', ['tag'])
+        run.update(status=Run.RUNNING)
+
+        def complete(run_):
+            b.get_run('foo').update(status=Run.PASSED)
+            return False
+
+        with patch('bya.models.RunQueue.cancel', side_effect=complete):
+            self.assertFalse(b.get_run('foo').cancel())
+        self.assertEqual(Run.PASSED, b.get_run('foo').status)
+        self.assertEqual([], b.cancel())
+
+    def test_fail_fast(self):
+        self.jobdef['fail_fast'] = True
+        self._write_job('jobname', self.jobdef)
+        j = jobs.find_jobdef('jobname')
+        b = j.create_build([{'name': 'foo', 'container': 'ubuntu'},
+                            {'name': 'bar', 'container': 'ubuntu'},
+                            {'name': 'bam', 'container': 'ubuntu'}])
+        foo = RunQueue.take('host1', ['tag'])
+        RunQueue.take('host1', ['tag']).update(status=Run.RUNNING)
+        foo.update(status=Run.FAILED)
+        self.assertEqual([], list(RunQueue.list_queued()))
+        self.assertEqual([], os.listdir(settings.RUNNING_DIR))
+        self.assertEqual({Run.CANCELLED},
+                         {b.get_run(x).status for x in ('bar', 'bam')})
+        self.assertEqual('Completed with Failure(s)', b.status)
+
 
 class TestBuild(TempDirTest):
     @patch('bya.models.Build._notify')
     def test_build(self, notify):
-        b = Build(12, self.tempdir)
-        os.mkdir(os.path.join(self.tempdir, 'runs'))
+        path = os.path.join(self.tempdir, '12')
+        os.makedirs(os.path.join(path, 'runs'))
+        b = Build(12, path)
         b.append_to_summary('hello there')
         with b.summary_fd() as f:
             self.assertIn('hello there', f.read())
         self.assertEqual('Completed', b.status)
         self.assertGreater(time.time(), b.started)
 
+    def test_disk_usage(self):
+        path = os.path.join(self.tempdir, 'job/12')
+        os.makedirs(path)
+        b = Build(12, path)
+        b.append_to_summary('hello there')
+        size = os.path.getsize(os.path.join(path, 'summary.log'))
+        self.assertEqual(size, b.disk_usage)
+
+        b.add_disk_usage(100)
+        self.assertEqual(size, b.recalculate_disk_usage())
+        self.assertEqual(size, b.disk_usage)
+        with open(os.path.join(self.tempdir, 'job/disk_usage')) as f:
+            self.assertEqual(size, int(f.read()))
+
 
 class TestValidator(ModelTest):
     def test_simple_pass(self):
@@ -272,6 +472,14 @@ class TestValidator(ModelTest):
             with open(p) as f:
                 JobDefinition.validate(yaml.load(f.read()))
 
+    def test_max_concurrent_runs(self):
+        for val in (0, -1):
+            self.jobdef['max_concurrent_runs'] = val
+            with self.assertRaisesRegex(ModelError, 'Must be at least 1'):
+                JobDefinition.validate(self.jobdef)
+        self.jobdef['max_concurrent_runs'] = 2
+        JobDefinition.validate(self.jobdef)
+
 
 class TestAll(ModelTest):
     def setUp(self):
@@ -284,6 +492,47 @@ class TestAll(ModelTest):
     def test_list(self):
         self.assertEqual(['foo'], [x.name for x in self.build.list_runs()])
 
+    def test_disk_usage(self):
+        job = jobs.find_jobdef('simple')
+        usage = self.build.disk_usage
+        self.assertEqual(usage, job.get_disk_usage())
+        self.assertEqual(usage, self.build.recalculate_disk_usage())
+
+        r = list(self.build.list_runs())[0]
+        r.append_log('1234567890')
+        self.assertEqual(usage + 10, self.build.disk_usage)
+        self.assertEqual(usage + 10, job.get_disk_usage())
+
+        r.append_log('1234567890' * 1000)
+        usage = self.build.disk_usage
+        saved = r.compress_log()
+        self.assertGreater(saved, 9000)
+        self.assertEqual(usage - saved, self.build.disk_usage)
+        with r.log_fd() as f:
+            self.assertTrue(f.read().endswith('1234567890' * 1001))
+        self.assertEqual(0, r.compress_log())
+
+        self.build.delete()
+        self.assertEqual(0, job.get_disk_usage())
+
+    def test_build_numbers(self):
+        job = jobs.find_jobdef('simple')
+        runs = [{'name': 'foo', 'container': 'ubuntu'}]
+        b = job.create_build(runs)
+        self.assertEqual(2, b.number)
+
+        # deleting the latest build must not cause its number to be reused
+        b.delete()
+        self.assertEqual(3, job.create_build(runs).number)
+
+    def test_build_numbers_concurrent(self):
+        job = jobs.find_jobdef('simple')
+        runs = [{'name': 'foo', 'container': 'ubuntu'}]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            builds = list(executor.map(
+                lambda x: job.create_build(runs), range(20)))
+        self.assertEqual(list(range(2, 22)), sorted(x.number for x in builds))
+
     def test_status(self):
         r = list(self.build.list_runs())[0]
         self.assertEqual('QUEUED', r.status)
@@ -292,6 +541,19 @@ class TestAll(ModelTest):
         self.assertEqual('RUNNING', r.status)
 
 
+class TestAllSqlite(TestAll):
+    def setUp(self):
+        settings.STORAGE_ENGINE = 'sqlite'
+        self.addCleanup(setattr, settings, 'STORAGE_ENGINE', 'file')
+        super(TestAllSqlite, self).setUp()
+
+    def test_query(self):
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build.build_dir, 'runs/foo/props')))
+        runs = Run.query(build=self.build.build_dir, status=Run.QUEUED)
+        self.assertEqual(['foo'], [x.name for x in runs])
+
+
 class HostTest(ModelTest):
     def setUp(self):
         super(HostTest, self).setUp()
@@ -307,6 +569,7 @@ class HostTest(ModelTest):
         Host.create('host1', props)
         props['cpu_type'] = 'aarch64'
         Host.create('host2', props)
+        self.props = props
 
     def test_list(self):
         hosts = [x.name for x in Host.list()]
@@ -322,9 +585,44 @@ class HostTest(ModelTest):
         self.assertFalse(h.online)
         h.ping()
         self.assertTrue(h.online)
-        with h.open_file('pings.log') as f:
-            os.utime(f.name, (time.time(), time.time() - 181))
+        get_heartbeats().beat('host1', time.time() - 181)
         self.assertFalse(h.online)
+        self.assertFalse(os.path.exists(os.path.join(h.path, 'pings.log')))
+
+    def test_ping_slots_reused(self):
+        """Hosts that are deleted free their heartbeat slots for new hosts"""
+        with patch.object(settings, 'HEARTBEAT_SLOTS', 4):
+            for x in range(3 * settings.HEARTBEAT_SLOTS):
+                Host.create('tmp%d' % x, self.props)
+                h = Host.get('tmp%d' % x)
+                h.ping()
+                self.assertNotEqual(0, get_heartbeats().lookup(h.name)[0])
+                h.delete()
+            Host.get('host1').ping()
+        self.assertEqual(['host1'], list(get_heartbeats().all()))
+
+    def test_ping_full(self):
+        """A full heartbeat file falls back to a file in the host's dir"""
+        with patch.object(settings, 'HEARTBEAT_SLOTS', 1):
+            Host.get('host1').ping()
+            h = Host.get('host2')
+            with patch('bya.models.log'):
+                h.ping()
+        self.assertTrue(h.online)
+        self.assertEqual(['host1'], list(get_heartbeats().all()))
+
+    def test_checkin_intervals(self):
+        hb = get_heartbeats()
+        for x in range(Heartbeats.INTERVALS + 3):
+            hb.beat('host1', 1000 + x * x)
+        intervals = Host.get('host1').checkin_intervals
+        self.assertEqual(Heartbeats.INTERVALS, len(intervals))
+        self.assertEqual(2 * Heartbeats.INTERVALS + 3, intervals[-1])
+        self.assertEqual(5, intervals[0])
+        self.assertEqual([], Host.get('host2').checkin_intervals)
+
+        Host.get('host1').delete()
+        self.assertEqual((0, []), hb.lookup('host1'))
 
     def test_delete(self):
         self.assertEqual(2, len(list(Host.list())))
@@ -1,9 +1,11 @@
 import importlib.util
+import json
 import os
 import shutil
+import subprocess
 import unittest
 
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from tests import ModelTest
 
@@ -29,12 +31,16 @@ class RunnerTests(ModelTest):
         self.runner = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(self.runner)
         self.runner._post = self._post
+        self.statuses = []
         self._create_run()
 
     def _post(self, url, data, headers, retry=1):
+        self.statuses.append(headers.get('X-BYA-STATUS'))
         resp = self.app.post(
             url, data=data, headers=headers, content_type='application/json')
-        return resp.status_code == 200
+        if resp.status_code != 200:
+            return False
+        return Mock(json=lambda: json.loads(resp.data.decode()))
 
     def _create_run(self):
         jobname = 'jobname_foo'
@@ -64,3 +70,21 @@ class RunnerTests(ModelTest):
         self._exec(self.args, "#!/bin/sh\necho hello world\n")
         run = Run(self.run.path)
         self.assertEqual(Run.PASSED, run.status)
+
+    def test_cancel(self):
+        """The runner stops the command when the server says to cancel"""
+        procs = []
+        popen = subprocess.Popen
+
+        def command(cmd, **kwargs):
+            procs.append(popen(['sh', '-c', 'echo started; sleep 60'],
+                               **kwargs))
+            return procs[-1]
+
+        self.assertTrue(self.run.cancel())
+        with patch.object(self.runner.subprocess, 'Popen', command):
+            self._exec(self.args, "#!/bin/sh\necho hello world\n")
+        self.assertEqual(1, len(procs))
+        self.assertEqual(-15, procs[0].returncode)
+        self.assertEqual('CANCELLED', self.statuses[-1])
+        self.assertEqual(Run.CANCELLED, Run(self.run.path).status)
@@ -0,0 +1,49 @@
+import os
+
+from unittest.mock import patch
+
+from tests import ModelTest
+
+from bya import metrics, settings
+from bya.views import app
+
+
+class TimingTests(ModelTest):
+    def setUp(self):
+        super(TimingTests, self).setUp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+
+    def _set(self, name, value):
+        self.addCleanup(setattr, settings, name, getattr(settings, name))
+        setattr(settings, name, value)
+
+    def test_latency(self):
+        self.app.get('/api/v1/queues/')
+        series = dict(metrics.get_stats().items())
+        key = 'bya_request_duration_seconds_count{endpoint="queues_list",' \
+              'method="GET"}'
+        self.assertEqual(1, series[key])
+
+        self.app.open('/api/v1/queues/', method='FOO')
+        series = dict(metrics.get_stats().items())
+        key = 'bya_request_duration_seconds_count{endpoint="unknown",' \
+              'method="other"}'
+        self.assertEqual(1, series[key])
+
+    @patch('bya.views.timing.log')
+    def test_slow_fs(self, log):
+        self._set('SLOW_REQUEST_SECONDS', 0.000001)
+        self._set('REQUEST_FS_TIMING', True)
+        self.app.get('/api/v1/queues/')
+        msg = log.warning.call_args[0][0] % log.warning.call_args[0][1:]
+        self.assertIn('slow request GET /api/v1/queues/', msg)
+        self.assertIn('os.scandir=2/', msg)
+
+    def test_profile(self):
+        self._set('PROFILE_SAMPLE_RATE', 1)
+        self._set('PROFILE_DIR', os.path.join(self.tempdir, 'profiles'))
+        self.app.get('/api/v1/queues/')
+        profiles = os.listdir(settings.PROFILE_DIR)
+        self.assertEqual(1, len(profiles))
+        self.assertTrue(profiles[0].startswith('queues_list-'))